@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Run multitask generator tasks on an asyncio event loop.
+
+The AsyncioTaskManager class is a multitask.TaskManager that does not run its own select/poll loop. Instead, I/O waits of
+the tasks become loop.add_reader()/add_writer() callbacks, timeouts and sleep() become a loop timer, and runnable tasks are
+stepped from loop.call_soon(). Everything else, i.e., child tasks, Queue and SmartQueue actions and PersistentFD, behaves
+exactly as with the legacy TaskManager, so the existing generators such as Protocol.parse, Protocol.write and
+FlashServer.serverlistener run unmodified.
+
+On Python 2 the trollius backport provides asyncio. A different event loop implementation can be used by installing its
+event loop policy before calling install().
+
+To run the RTMP server on asyncio:
+>>> import aiomultitask, multitask, rtmp
+>>> manager = aiomultitask.install()   # becomes the default multitask TaskManager
+>>> agent = rtmp.FlashServer()
+>>> agent.start()
+>>> multitask.run()                    # runs the asyncio event loop until there is nothing left to do
+
+or use the -a option of rtmp.py.
+'''
+
+try: import asyncio
+except ImportError: import trollius as asyncio # Python 2 backport of asyncio
+
+import os, sys, time, errno, multitask
+
+class LoopReactor(object):
+    '''A multitask reactor that waits for I/O using the add_reader() and add_writer() callbacks of an asyncio event loop.
+    The loop calls back on_ready(waiters) with the FDReady instances that became ready; poll() is never used.
+    Attached descriptors keep their loop callbacks installed between waits, which are removed lazily when the descriptor
+    becomes ready with no waiter. asyncio has no exceptional condition, so an exc wait is treated as a read wait.'''
+    def __init__(self, loop, on_ready):
+        self._loop, self._on_ready = loop, on_ready
+        self._readers, self._writers = {}, {} # fd => set of FDReady
+        self._reading, self._writing, self._attached = set(), set(), set() # descriptors with loop callbacks installed
+
+    def __len__(self):
+        return len(set(self.waiters()))
+
+    def has_waits(self):
+        return bool(self._readers or self._writers)
+
+    def waiters(self):
+        result = []
+        for waits in self._readers.values() + self._writers.values(): result.extend(waits)
+        return result
+
+    def register(self, fdready):
+        fd = fdready.fd
+        if fdready.read or fdready.exc:
+            if fd not in self._reading:
+                self._loop.add_reader(fd, self._ready, self._readers, self._reading, self._loop.remove_reader, fd)
+                self._reading.add(fd)
+            self._readers.setdefault(fd, set()).add(fdready)
+        if fdready.write:
+            if fd not in self._writing:
+                self._loop.add_writer(fd, self._ready, self._writers, self._writing, self._loop.remove_writer, fd)
+                self._writing.add(fd)
+            self._writers.setdefault(fd, set()).add(fdready)
+
+    def unregister(self, fdready):
+        fd = fdready.fd
+        for waits, installed, remove in ((self._readers, self._reading, self._loop.remove_reader),
+                                         (self._writers, self._writing, self._loop.remove_writer)):
+            if fdready in waits.get(fd, ()):
+                waits[fd].discard(fdready)
+                if not waits[fd]:
+                    del waits[fd]
+                    if fd not in self._attached:
+                        remove(fd); installed.discard(fd)
+
+    def _ready(self, waits, installed, remove, fd):
+        if fd in waits: self._on_ready(list(waits[fd]))
+        else: remove(fd); installed.discard(fd) # an attached descriptor that nobody waits for
+
+    def attach(self, fd):
+        self._attached.add(fd)
+
+    def detach(self, fd):
+        self._attached.discard(fd)
+        waits = self._readers.pop(fd, set()) | self._writers.pop(fd, set()) # fd is about to be closed, so the caller resumes them
+        if fd in self._reading: self._loop.remove_reader(fd); self._reading.discard(fd)
+        if fd in self._writing: self._loop.remove_writer(fd); self._writing.discard(fd)
+        return list(waits)
+
+    def attached(self):
+        return list(self._attached)
+
+    def poll(self, timeout):
+        raise NotImplementedError('the event loop polls for I/O')
+
+    def remove_bad_file_descriptors(self):
+        return []
+
+    def close(self):
+        for fd in list(self._reading): self._loop.remove_reader(fd)
+        for fd in list(self._writing): self._loop.remove_writer(fd)
+        self._reading.clear(); self._writing.clear()
+
+class AsyncioTaskManager(multitask.TaskManager):
+    '''A TaskManager that runs its tasks on an asyncio event loop, by default asyncio.get_event_loop().'''
+    io_check_interval = 0 # the loop polls for I/O, not the TaskManager
+    def __init__(self, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        multitask.TaskManager.__init__(self, reactor=LoopReactor(self._loop, self._handle_ready))
+        self._scheduled, self._timer, self._timer_expiration, self._stop_when_idle = False, None, None, False
+        self._stop_after_step, self._stopping = False, False
+
+    @property
+    def loop(self):
+        return self._loop
+
+    def run(self):
+        '''Run the event loop until there are no tasks that are runnable, waiting for I/O or waiting to time out.'''
+        if self.has_runnable() or self.has_io_waits() or self.has_timeouts():
+            self._stop_when_idle = True
+            try: self._run_loop()
+            finally: self._stop_when_idle = False
+
+    def run_next(self, timeout=None):
+        '''Run the event loop until it has run the runnable tasks, like TaskManager.run_next(). When no task is runnable,
+        wait for one to become so, for at most timeout seconds if timeout is not None. With nothing to wait for, or a
+        timeout of 0, run a single iteration of the loop.'''
+        if timeout == 0 or self.has_runnable() or not (self.has_io_waits() or self.has_timeouts()):
+            self._stop()
+            self._run_loop()
+            return
+        self._stop_after_step = True
+        timer = (self._loop.call_later(timeout, self._stop) if timeout is not None else None)
+        try: self._run_loop()
+        finally:
+            self._stop_after_step = False
+            if timer is not None: timer.cancel()
+
+    def _run_loop(self):
+        try: self._loop.run_forever()
+        finally: self._stopping = False
+
+    def _stop(self):
+        # trollius stops the loop with a callback, so a second stop() would end the next run_forever() too
+        if not self._stopping:
+            self._stopping = True
+            self._loop.stop()
+
+    def _enqueue(self, task, input=None, exc_info=()):
+        multitask.TaskManager._enqueue(self, task, input, exc_info)
+        if not self._scheduled:
+            self._scheduled = True
+            self._loop.call_soon(self._step)
+
+    def _step(self):
+        self._scheduled = False
+        self._run_queue()
+        if self._stop_after_step: self._stop()
+        self._stop_if_idle()
+
+    def _stop_if_idle(self):
+        if self._stop_when_idle and not (self.has_runnable() or self.has_io_waits() or self.has_timeouts()):
+            self._stop()
+
+    def _handle_fdready(self, task, output):
+        try: multitask.TaskManager._handle_fdready(self, task, output)
+        except (EnvironmentError, ValueError), e: # the loop refuses a bad descriptor: the task gets the error right away
+            exc_info = sys.exc_info() if isinstance(e, EnvironmentError) else (IOError, IOError(errno.EBADF, os.strerror(errno.EBADF)), None)
+            self._reactor.unregister(output)
+            if isinstance(output, multitask._PersistentAction): output._reset() # the PersistentFD can wait again
+            self._enqueue(task, exc_info=exc_info)
+
+    def _add_timeout(self, item, handler):
+        multitask.TaskManager._add_timeout(self, item, handler)
+        self._arm_timer()
+
+    def _arm_timer(self):
+        '''Make sure the loop timer fires no later than the first expiration.'''
+        if not self.has_timeouts(): return
+        expiration = self._timeouts.first_expiration()
+        if self._timer is not None:
+            if self._timer_expiration <= expiration: return
+            self._timer.cancel()
+        self._timer, self._timer_expiration = self._loop.call_later(max(0.0, expiration - time.time()), self._expire), expiration
+
+    def _expire(self):
+        self._timer = None
+        self._handle_timeouts(0.0) # expired items are enqueued, which schedules a _step()
+        self._arm_timer()
+        self._stop_if_idle()
+
+def install(loop=None):
+    '''Create an AsyncioTaskManager on loop and make it the default multitask TaskManager. Returns the new manager.'''
+    manager = AsyncioTaskManager(loop)
+    multitask.set_default_task_manager(manager)
+    return manager
@@ -0,0 +1,854 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Micro-benchmarks for the multitask scheduler and the RTMP server. Each benchmark is a function named bench_<name> that
+prints its own results. To list the available benchmarks and run some of them:
+$ python benchmark.py -l
+$ python benchmark.py reactor
+$ python benchmark.py          # runs everything
+'''
+
+import os, sys, time, errno, heapq, struct, signal, socket, select, resource
+import multiprocessing
+import multitask, rtmp, amf, cluster
+
+_corpus_file = None # a file of RTMP chunks received after the handshake, for bench_codec, set by the -c option
+
+def _raise_fd_limit(count):
+    '''Raise the soft limit of open files so that count descriptors can be created, as far as the hard limit allows.'''
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = count + 64
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        soft = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    return soft
+
+def _timeit(func, repeat):
+    start = time.time()
+    for i in xrange(repeat): func()
+    return (time.time() - start) / repeat
+
+def bench_reactor():
+    '''Cost of one TaskManager loop iteration with 100, 1k and 10k idle sockets waiting for data, per reactor.'''
+    reactors = [(name, cls) for name, cls in [('select', multitask.SelectReactor), ('poll', multitask.PollReactor), ('epoll', multitask.EpollReactor)]
+                if hasattr(select, name)]
+    print '%-8s %10s %14s' % ('reactor', 'sockets', 'usec/iteration')
+    for count in (100, 1000, 10000):
+        if _raise_fd_limit(count) < count + 64:
+            print 'skipping %d sockets: open file limit too low' % (count,); continue
+        socks = []
+        for i in xrange(count): # idle UDP sockets need one descriptor each and never become readable
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); s.bind(('127.0.0.1', 0)); socks.append(s)
+        def idle(sock):
+            yield multitask.recv(sock, 1)
+        try:
+            for name, cls in reactors:
+                tm = multitask.TaskManager(cls())
+                for s in socks: tm.add(idle(s))
+                tm.run_next(0.0) # park every task on its socket
+                # with nothing ready, each run_next(0.0) is exactly one non-blocking poll of the reactor
+                cost = _timeit(lambda: tm.run_next(0.0), 200 if count < 10000 else 50)
+                lost = count - len(tm._reactor)
+                # select() cannot handle descriptors above FD_SETSIZE, so those are dropped as bad descriptors
+                print '%-8s %10d %14.1f%s' % (name, count, cost * 1e6, ' (dropped %d sockets)' % (lost,) if lost else '')
+                tm._reactor.close()
+        finally:
+            for s in socks: s.close()
+
+def bench_timeouts():
+    '''Cost of cancelling a timeout with 50k pending timers: idle-connection timeouts on queues plus sleep pacing timers.'''
+    idle, pacing, wakeups = 40000, 10000, 5000
+    tm = multitask.TaskManager()
+    queues = [multitask.Queue() for i in xrange(idle)]
+    def waiter(queue):
+        try: yield queue.get(timeout=3600)
+        except multitask.Timeout: pass
+    def pacer():
+        yield multitask.sleep(3600)
+    for queue in queues: tm.add(waiter(queue))
+    for i in xrange(pacing): tm.add(pacer())
+    tm.run_next(0.0)
+    print 'pending timers:', len(tm._timeouts)
+    def putter():
+        for queue in queues[:wakeups]: yield queue.put(None) # each wakeup cancels the waiter's timeout
+    tm.add(putter())
+    start = time.time(); tm.run_next(0.0); elapsed = time.time() - start
+    print 'TaskManager: %d wakeups with timeout cancellation in %.3fs (%.1f usec each)' % (wakeups, elapsed, elapsed / wakeups * 1e6)
+
+    # the previous implementation: a plain heap of (expiration, item) searched and re-heapified on each cancellation
+    heap = [(time.time() + 3600 + i * 1e-6, object()) for i in xrange(idle + pacing)]
+    heapq.heapify(heap)
+    victims = heap[:]; victims.reverse()
+    count = 200
+    start = time.time()
+    for entry in victims[:count]:
+        heap.remove(entry); heapq.heapify(heap)
+    elapsed = time.time() - start
+    print 'list.remove + heapify: %d cancellations in %.3fs (%.1f usec each)' % (count, elapsed, elapsed / count * 1e6)
+
+def bench_queue():
+    '''Passing 100k items from a producer task to a consumer task: put()/get() versus put_nowait() and get_many().'''
+    count = 100000
+    def run(producer, consumer):
+        tm = multitask.TaskManager(); queue = multitask.Queue()
+        tm.add(consumer(queue, count)); tm.add(producer(queue, count))
+        start = time.time(); tm.run(); return time.time() - start
+    def put(queue, count):
+        for i in xrange(count): yield queue.put(i)
+    def put_nowait(queue, count):
+        for i in xrange(count):
+            if not queue.put_nowait(i): yield queue.put(i)
+            if i % 64 == 63: yield # let the consumer run now and then, like a task handling a burst of input
+    def get(queue, count):
+        for i in xrange(count): yield queue.get()
+    def get_many(queue, count):
+        while count > 0: count -= len((yield queue.get_many(64)))
+    for name, producer, consumer in (('put/get', put, get), ('put_nowait/get', put_nowait, get), ('put_nowait/get_many', put_nowait, get_many)):
+        elapsed = run(producer, consumer)
+        print '%-20s %8.3fs %8.2f usec/item' % (name, elapsed, elapsed / count * 1e6)
+
+def bench_smartqueue():
+    '''1k tasks each waiting for the items of its own key, such as a stream id, while 10k items are put: criteria versus
+    keyed mode. Then 10k items of 1k keys taken by a get() without key, i.e. oldest first, in keyed mode.'''
+    waiters, items = 1000, 10000
+    def run(queue, get):
+        tm = multitask.TaskManager()
+        def waiter(key):
+            for i in xrange(items / waiters): yield get(queue, key)
+        def producer():
+            for i in xrange(items): yield queue.put((i % waiters, i))
+        for key in xrange(waiters): tm.add(waiter(key))
+        tm.run_next(0.0) # park every waiter
+        tm.add(producer())
+        start = time.time(); tm.run(); return time.time() - start
+    for name, queue, get in (('criteria', multitask.SmartQueue(), lambda queue, key: queue.get(criteria=lambda item: item[0] == key)),
+                             ('keyed', multitask.SmartQueue(key=lambda item: item[0]), lambda queue, key: queue.get(key=key))):
+        elapsed = run(queue, get)
+        print '%-10s %8.3fs %8.1f usec/item' % (name, elapsed, elapsed / items * 1e6)
+    tm, queue = multitask.TaskManager(), multitask.SmartQueue([(i % waiters, i) for i in xrange(items)], key=lambda item: item[0])
+    def oldest():
+        for i in xrange(items): yield queue.get()
+    tm.add(oldest())
+    start = time.time(); tm.run(); elapsed = time.time() - start
+    print '%-10s %8.3fs %8.1f usec/item' % ('any key', elapsed, elapsed / items * 1e6)
+
+class _StringSockStream(rtmp.SockStream):
+    '''The previous SockStream.read(), which appends every recv() to a str and slices the rest of it off on each read.'''
+    def __init__(self, sock):
+        rtmp.SockStream.__init__(self, sock)
+        self.buffer = ''
+    def read(self, count):
+        while len(self.buffer) < count:
+            data = (yield self.fd.recv(4096))
+            self.recvCalls += 1
+            if not data: raise rtmp.ConnectionClosed
+            self.bytesRead += len(data)
+            self.buffer += data
+        data, self.buffer = self.buffer[:count], self.buffer[count:]
+        raise StopIteration(data)
+
+def bench_sockstream():
+    '''Bytes/sec and recv calls through SockStream.read() in 128, 4096 and 65536 byte pieces from a socket pair: adaptive
+    bytearray buffer versus str buffer with 4 KB receives.'''
+    def run(cls, count, total):
+        multitask.set_default_task_manager(multitask.TaskManager())
+        a, b = socket.socketpair()
+        def writer(fd):
+            block, left = 'x' * 65536, total
+            while left > 0: left -= (yield fd.send(block[:left]))
+        def reader(stream):
+            for i in xrange(total / count): yield stream.read(count)
+        writing, reading = multitask.PersistentFD(a), cls(b)
+        multitask.add(writer(writing)); multitask.add(reader(reading))
+        start = time.time(); multitask.run(); elapsed = time.time() - start
+        writing.close(); reading.close(); a.close()
+        return elapsed, reading.recvCalls
+    default = multitask.get_default_task_manager()
+    print '%-10s %8s %12s %12s' % ('buffer', 'read', 'MB/s', 'recv/MB')
+    for count, total in ((128, 8 << 20), (4096, 64 << 20), (65536, 64 << 20)):
+        for name, cls in (('str', _StringSockStream), ('bytearray', rtmp.SockStream)):
+            elapsed, calls = run(cls, count, total)
+            print '%-10s %8d %12.1f %12.1f' % (name, count, total / elapsed / (1 << 20), calls / float(total >> 20))
+    multitask.set_default_task_manager(default)
+
+class _ReadHeader(rtmp.Header):
+    '''A Header that can also keep the extended time, as the previous parser stored it.'''
+
+class _YieldingProtocol(rtmp.Protocol):
+    '''The previous chunk parser, which reads every header field with its own SockStream.read().'''
+    def __init__(self, sock):
+        rtmp.Protocol.__init__(self, sock)
+        self.incompletePackets = dict()
+
+    def parseMessages(self):
+        while True:
+            hdrsize = ord((yield self.stream.read(1))[0])
+            channel = hdrsize & 0x3F
+            if channel == 0: channel = 64 + ord((yield self.stream.read(1))[0])
+            elif channel == 1:
+                data = (yield self.stream.read(2))
+                channel = 64 + ord(data[0]) + 256 * ord(data[1])
+            hdrtype = hdrsize & rtmp.Header.MASK
+            if hdrtype == rtmp.Header.FULL or channel not in self.lastReadHeaders:
+                header = self.lastReadHeaders[channel] = _ReadHeader(channel)
+            else: header = self.lastReadHeaders[channel]
+            if hdrtype < rtmp.Header.SEPARATOR: header.time = struct.unpack('!I', '\x00' + (yield self.stream.read(3)))[0]
+            if hdrtype < rtmp.Header.TIME:
+                header.size = struct.unpack('!I', '\x00' + (yield self.stream.read(3)))[0]
+                header.type = ord((yield self.stream.read(1))[0])
+            if hdrtype < rtmp.Header.MESSAGE: header.streamId = struct.unpack('<I', (yield self.stream.read(4)))[0]
+            if header.time == 0xFFFFFF: header.extendedTime = struct.unpack('!I', (yield self.stream.read(4)))[0]
+            data = self.incompletePackets.get(channel, '')
+            data += (yield self.stream.read(min(header.size - len(data), self.readChunkSize)))
+            if len(data) < header.size: self.incompletePackets[channel] = data
+            else:
+                self.incompletePackets.pop(channel, None)
+                yield self.parseMessage(rtmp.Message(header.dup(), data))
+
+def bench_parse():
+    '''Chunks/sec parsed by Protocol.parseMessages() from a socket pair at the default 128 byte chunk size, for 20k video
+    messages of 1000 bytes (8 chunks each): synchronous header decoding versus a SockStream.read() per header field.'''
+    count, size, chunk = 20000, 1000, rtmp.Protocol.DEFAULT_CHUNK_SIZE
+    hdr, payload, parts = rtmp.Header(channel=6, time=0, size=size, type=rtmp.Message.VIDEO, streamId=1), 'v' * size, []
+    for i in xrange(count):
+        control = rtmp.Header.FULL if i == 0 else rtmp.Header.TIME
+        hdr.time = 0 if i == 0 else 33
+        for offset in xrange(0, size, chunk):
+            parts.append(hdr.toBytes(control)); parts.append(payload[offset:offset+chunk])
+            control = rtmp.Header.SEPARATOR
+    data, chunks = ''.join(parts), len(parts) / 2
+    def run(cls):
+        multitask.set_default_task_manager(multitask.TaskManager())
+        a, b = socket.socketpair()
+        protocol, received = cls(b), [0]
+        def parseMessage(msg):
+            received[0] += 1
+        protocol.parseMessage = parseMessage
+        def writer():
+            stream = rtmp.SockStream(a)
+            yield stream.write(data); stream.close()
+        def reader():
+            try: yield protocol.parseMessages()
+            except rtmp.ConnectionClosed: protocol.stream.close()
+        multitask.add(writer()); multitask.add(reader())
+        start = time.time(); multitask.run(); elapsed = time.time() - start
+        assert received[0] == count, received[0]
+        return elapsed
+    default = multitask.get_default_task_manager()
+    print '%-10s %12s %12s' % ('parser', 'chunks/s', 'messages/s')
+    for name, cls in (('yielding', _YieldingProtocol), ('buffered', rtmp.Protocol)):
+        elapsed = run(cls)
+        print '%-10s %12.0f %12.0f' % (name, chunks / elapsed, count / elapsed)
+    multitask.set_default_task_manager(default)
+
+def bench_reassembly():
+    '''Milliseconds to reassemble one message from 128 byte chunks, for messages of 8 kB, 64 kB and 512 kB: the partial
+    message kept as a str in a per-channel dict and extended by += per chunk, versus a list of the chunk payloads joined
+    once.'''
+    chunk = rtmp.Protocol.DEFAULT_CHUNK_SIZE
+    def concat(size, payload):
+        incomplete = dict()
+        for offset in xrange(0, size, chunk):
+            data = incomplete.get(6, '')
+            data += payload[offset:offset+chunk]
+            if len(data) < size: incomplete[6] = data
+            else: del incomplete[6]
+        return data
+    def collect(size, payload):
+        packet, received = [], 0
+        for offset in xrange(0, size, chunk):
+            count = min(size - received, chunk)
+            packet.append(payload[offset:offset+count])
+            received += count
+        return ''.join(packet)
+    print '%-10s %12s %12s' % ('size', 'concat ms', 'list ms')
+    for size in (8192, 65536, 524288):
+        payload, repeat, times = 'k' * size, max(1, 2097152 / size), []
+        for reassemble in (concat, collect):
+            assert reassemble(size, payload) == payload
+            start = time.time()
+            for i in xrange(repeat): reassemble(size, payload)
+            times.append((time.time() - start) * 1000 / repeat)
+        print '%-10d %12.3f %12.3f' % (size, times[0], times[1])
+
+def _sliceAggregate(header, data):
+    '''The previous aggregate splitting, which re-slices the rest of the data past every field.'''
+    channel, aggdata = header.channel, data
+    while len(aggdata) > 0:
+        subtype = ord(aggdata[0])
+        subsize = struct.unpack('!I', '\x00' + aggdata[1:4])[0]
+        subtime = struct.unpack('!I', aggdata[4:8])[0]
+        substreamid = struct.unpack('<I', aggdata[8:12])[0]
+        subheader = rtmp.Header(channel, time=subtime, size=subsize, type=subtype, streamId=substreamid)
+        aggdata = aggdata[11:]
+        yield rtmp.Message(subheader, aggdata[:subsize])
+        aggdata = aggdata[subsize:]
+        backpointer = struct.unpack('!I', aggdata[0:4])[0]
+        aggdata = aggdata[4:]
+
+def bench_aggregate():
+    '''Milliseconds to split an aggregate message of 10, 100 and 1000 sub-messages of 1000 bytes: re-slicing the rest of
+    the data per field versus unpacking the fields at an offset.'''
+    print '%-10s %12s %12s' % ('messages', 'slice ms', 'offset ms')
+    for count in (10, 100, 1000):
+        payload, parts = 'a' * 1000, []
+        for i in xrange(count):
+            parts.append(struct.pack('>II', rtmp.Message.AUDIO << 24 | len(payload), i * 23 << 8) + '\x00\x00\x00')
+            parts.append(payload); parts.append(struct.pack('>I', 11 + len(payload)))
+        data, repeat, times = ''.join(parts), max(1, 10000 / count), []
+        header = rtmp.Header(4, 0, len(data), rtmp.Message.AGGREGATE, 1)
+        assert [(m.time, m.data) for m in rtmp.aggregateMessages(header, data)] == [(i * 23, payload) for i in xrange(count)]
+        for split in (_sliceAggregate, rtmp.aggregateMessages):
+            assert [m.data for m in split(header, data)] == [payload] * count
+            start = time.time()
+            for i in xrange(repeat):
+                for message in split(header, data): pass
+            times.append((time.time() - start) * 1000 / repeat)
+        print '%-10d %12.3f %12.3f' % (count, times[0], times[1])
+
+def _corpus(chunkSize, seconds=60):
+    '''The chunks of a publisher session at chunkSize, as a str: the set chunk size message, then 30 fps video with a
+    40 kB key frame every 2 seconds and 2-8 kB inter frames, and 180 byte audio frames every 23 ms. The sizes are
+    generated from a fixed seed, hence the corpus is the same for every run.'''
+    import random
+    generator, codec, parts, media = random.Random(1935), rtmp.Codec(), [], []
+    for i in xrange(seconds * 30): media.append((i * 1000 / 30, rtmp.Message.VIDEO, 40000 if i % 60 == 0 else generator.randint(2000, 8000)))
+    for i in xrange(seconds * 1000 / 23): media.append((i * 23, rtmp.Message.AUDIO, 180))
+    message = rtmp.Message()
+    message.type, message.data = rtmp.Message.CHUNK_SIZE, struct.pack('>L', chunkSize)
+    parts.append(codec.encode(message)); codec.writeChunkSize = chunkSize
+    for tm, type, size in sorted(media):
+        message = rtmp.Message(rtmp.Header(time=tm, size=size, type=type, streamId=1), chr(type) * size)
+        parts.append(codec.encode(message))
+    return ''.join(parts)
+
+def bench_codec():
+    '''MB/s and messages/s of Codec decoding a publisher session fed in 4 kB pieces, as received from a socket, at 128
+    and 4096 byte chunks, and of Codec encoding the decoded messages. The -c option decodes the chunks in a file instead.'''
+    corpora = [('file', open(_corpus_file, 'rb').read())] if _corpus_file else [(str(size), _corpus(size)) for size in (128, 4096)]
+    print '%-8s %8s %12s %12s %12s' % ('corpus', 'MB', 'decode MB/s', 'decode msg/s', 'encode msg/s')
+    for name, data in corpora:
+        codec, messages, start = rtmp.Codec(), [], time.time()
+        for offset in xrange(0, len(data), 4096):
+            codec.feed(data[offset:offset+4096])
+            messages.extend(codec.receive())
+        decode = time.time() - start
+        codec = rtmp.Codec(); codec.writeChunkSize = int(name) if name != 'file' else rtmp.Protocol.HIGH_WRITE_CHUNK_SIZE
+        start = time.time()
+        for message in messages: codec.encode(message)
+        encode = time.time() - start
+        print '%-8s %8.1f %12.1f %12.0f %12.0f' % (name, len(data) / 1e6, len(data) / 1e6 / decode, len(messages) / decode, len(messages) / encode)
+
+class _PackedHeader(rtmp.Header):
+    '''The previous Header, which packs its basic header when created and every field of a chunk header.'''
+    def __init__(self, channel=0, time=0, size=None, type=None, streamId=0):
+        rtmp.Header.__init__(self, channel, time, size, type, streamId)
+        if (channel < 64): self._hdrdata = struct.pack('>B', channel)
+        elif (channel < 320): self._hdrdata = '\x00' + struct.pack('>B', channel-64)
+        else: self._hdrdata = '\x01' + struct.pack('>H', channel-64)
+
+    def toBytes(self, control):
+        data = chr(ord(self._hdrdata[0]) | control)
+        if len(self._hdrdata) >= 2: data += self._hdrdata[1:]
+        if control != rtmp.Header.SEPARATOR:
+            data += struct.pack('>I', self.time if self.time < 0xFFFFFF else 0xFFFFFF)[1:]
+            if control != rtmp.Header.TIME:
+                data += struct.pack('>I', self.size)[1:]
+                data += struct.pack('>B', self.type)
+                if control != rtmp.Header.MESSAGE:
+                    data += struct.pack('<I', self.streamId)
+            if self.time >= 0xFFFFFF:
+                data += struct.pack('>I', self.time)
+        return data
+
+class _PackingCodec(rtmp.Codec):
+    '''The previous Codec.chunks(), which creates a Header per message and packs the header of every chunk.'''
+    def chunks(self, message, parts):
+        if message.streamId in self.lastWriteHeaders:
+            header = self.lastWriteHeaders[message.streamId]
+        else:
+            header, self.nextChannelId = _PackedHeader(self.nextChannelId), self.nextChannelId + 1
+            self.lastWriteHeaders[message.streamId] = header
+        if message.type < rtmp.Message.AUDIO:
+            header = _PackedHeader(rtmp.Protocol.PROTOCOL_CHANNEL_ID)
+        if header.streamId != message.streamId or header.time == 0 or message.time <= header.time:
+            header.streamId, header.type, header.size, header.time, header.delta = message.streamId, message.type, message.size, message.time, message.time
+            control = rtmp.Header.FULL
+        elif header.size != message.size or header.type != message.type:
+            header.type, header.size, header.time, header.delta = message.type, message.size, message.time, message.time-header.time
+            control = rtmp.Header.MESSAGE
+        else:
+            header.time, header.delta = message.time, message.time-header.time
+            control = rtmp.Header.TIME
+        hdr = _PackedHeader(channel=header.channel, time=header.delta if control in (rtmp.Header.MESSAGE, rtmp.Header.TIME) else header.time, size=header.size, type=header.type, streamId=header.streamId)
+        data, offset, size = message.data, 0, 0
+        while offset < len(data):
+            count = min(self.writeChunkSize, len(data) - offset)
+            chunk = hdr.toBytes(control)
+            parts.append(chunk)
+            parts.append(buffer(data, offset, count))
+            offset += count
+            size += len(chunk) + count
+            control = rtmp.Header.SEPARATOR
+        return size
+
+def bench_framing():
+    '''Microseconds of Codec.chunks() per outgoing media message of 180, 1000 and 5000 bytes at 128 and 4096 byte
+    chunks: a Header per message with every chunk header packed, versus precompiled Structs and cached basic headers.'''
+    print '%-6s %6s %12s %12s' % ('chunk', 'size', 'packed us', 'cached us')
+    for chunkSize in (128, 4096):
+        for size in (180, 1000, 5000):
+            messages = [rtmp.Message(rtmp.Header(time=i * 33, size=size, type=rtmp.Message.VIDEO, streamId=1), 'v' * size) for i in xrange(1, 20001)]
+            times = []
+            for cls in (_PackingCodec, rtmp.Codec):
+                codec, parts = cls(), []
+                codec.writeChunkSize = chunkSize
+                start = time.time()
+                for message in messages:
+                    codec.chunks(message, parts)
+                    del parts[:]
+                times.append((time.time() - start) * 1e6 / len(messages))
+            print '%-6d %6d %12.2f %12.2f' % (chunkSize, size, times[0], times[1])
+
+def bench_chunkstreams():
+    '''Header bytes sent for the messages of a publisher session at 128 and 4096 byte chunks, and how many messages start
+    with a type 0, 1, 2 and 3 header: a chunk stream per message stream, which starts over with a type 0 header unless the
+    time increases, versus a chunk stream per message stream and media type. The -c option uses the chunks in a file.'''
+    corpora = [('file', open(_corpus_file, 'rb').read())] if _corpus_file else [(str(size), _corpus(size)) for size in (128, 4096)]
+    print '%-8s %-10s %10s %10s %7s %7s %7s %7s' % ('corpus', 'chunks', 'bytes', 'headers', 'type 0', 'type 1', 'type 2', 'type 3')
+    for name, data in corpora:
+        decoder = rtmp.Codec(); decoder.feed(data); messages = decoder.receive()
+        payload = sum(len(message.data) for message in messages)
+        for policy, cls in (('stream', _PackingCodec), ('media', rtmp.Codec)):
+            codec, parts, size, types = cls(), [], 0, [0, 0, 0, 0]
+            codec.writeChunkSize = decoder.readChunkSize
+            for message in messages:
+                size += codec.chunks(message, parts)
+                if parts: types[ord(parts[0][0]) >> 6] += 1
+                del parts[:]
+            print '%-8s %-10s %10d %10d %7d %7d %7d %7d' % ((name, policy, size, size - payload) + tuple(types))
+
+def bench_chunksize():
+    '''Chunks, bytes and microseconds per message to encode and to decode the media of a publisher session, with the
+    default 128 byte chunks, 4096 byte chunks announced after connect, and chunks raised as needed up to 65536 bytes.
+    The -c option uses the messages in a file of chunks.'''
+    data = open(_corpus_file, 'rb').read() if _corpus_file else _corpus(4096)
+    decoder = rtmp.Codec(); decoder.feed(data)
+    messages = [message for message in decoder.receive() if message.type != rtmp.Message.CHUNK_SIZE]
+    print '%-10s %10s %10s %10s %10s' % ('policy', 'chunks', 'bytes', 'encode us', 'decode us')
+    for name, chunkSize, maxChunkSize in (('128', None, None), ('4096', 4096, None), ('adaptive', None, 65536)):
+        encoder, parts, size = rtmp.Codec(), [], 0
+        encoder.maxWriteChunkSize = maxChunkSize
+        start = time.time()
+        if chunkSize: size += encoder.chunks(rtmp.Message(rtmp.Header(0, 0, 4, rtmp.Message.CHUNK_SIZE, 0), struct.pack('>L', chunkSize)), parts)
+        for message in messages: size += encoder.chunks(message, parts)
+        encode = time.time() - start
+        output = bytearray()
+        for part in parts: output += part
+        decoder = rtmp.Codec()
+        start = time.time()
+        decoded = decoder.decode(output, 0, len(output), [])
+        decode = time.time() - start
+        assert decoded == size == len(output)
+        print '%-10s %10d %10d %10.2f %10.2f' % (name, encoder.chunksWritten, size, encode * 1e6 / len(messages), decode * 1e6 / len(messages))
+
+def bench_coalesce():
+    '''send() calls and time of Protocol.write() for 100 players getting 2k media messages queued in bursts of 1, 3 and 8:
+    a send() per message versus the chunks of a burst coalesced in one send().'''
+    players, messages = 100, 2000
+    def run(burst):
+        multitask.set_default_task_manager(multitask.TaskManager())
+        pairs = [socket.socketpair() for i in xrange(players)]
+        protocols = [rtmp.Protocol(a) for a, b in pairs]
+        def drain(fd):
+            while (yield fd.recv(65536)): pass
+        def publish():
+            for i in xrange(0, messages, burst):
+                for j in xrange(i, min(i + burst, messages)):
+                    message = rtmp.Message(rtmp.Header(0, j * 23, 0, rtmp.Message.VIDEO if j % 3 == 0 else rtmp.Message.AUDIO, 1), 'x' * 300)
+                    for protocol in protocols: protocol.writeQueue.put_nowait(message)
+                yield multitask.sleep(0.0001) # the next burst comes after the players wrote this one
+            for protocol in protocols: protocol.writeQueue.put_nowait(None)
+        drains = [multitask.PersistentFD(b) for a, b in pairs]
+        for protocol in protocols: multitask.add(protocol.write())
+        for fd in drains: multitask.add(drain(fd))
+        multitask.add(publish())
+        start = time.time(); multitask.run(); elapsed = time.time() - start
+        for fd in drains: fd.close()
+        for a, b in pairs: b.close()
+        return elapsed, sum(protocol.stream.sendCalls for protocol in protocols), sum(protocol.stream.bytesWritten for protocol in protocols)
+    default, budget = multitask.get_default_task_manager(), rtmp.Protocol.WRITE_BUFFER_SIZE
+    print '%-10s %6s %10s %12s %10s' % ('writes', 'burst', 'msg/s', 'sends/msg', 'bytes/send')
+    try:
+        for burst in (1, 3, 8):
+            for name, size in (('per-msg', 0), ('coalesced', budget)):
+                rtmp.Protocol.WRITE_BUFFER_SIZE = size
+                elapsed, sends, written = run(burst)
+                print '%-10s %6d %10.0f %12.2f %10.0f' % (name, burst, players * messages / elapsed, float(sends) / (players * messages), float(written) / sends)
+    finally:
+        rtmp.Protocol.WRITE_BUFFER_SIZE = budget
+        multitask.set_default_task_manager(default)
+
+# A fan-out load generator: one publisher and many players against a FlashServer running in a child process. The load
+# generator uses plain sockets and epoll so that it does not depend on the scheduler being measured.
+
+_MARKER = 'MRK!' # ends the payload of every published audio message, counted by the players
+
+def _chunk(msg, channel):
+    '''Encode a message that fits in one chunk of the default chunk size, using a type 0 header.'''
+    hdr = rtmp.Header(channel, msg.time, len(msg.data), msg.type, msg.streamId)
+    return hdr.toBytes(rtmp.Header.FULL) + msg.data
+
+def _command(name, id, args=[], cmdData=None, streamId=0):
+    msg = rtmp.Command(name=name, id=id, cmdData=cmdData, args=args).toMessage()
+    msg.streamId = streamId
+    return _chunk(msg, 3) if len(msg.data) <= rtmp.Protocol.DEFAULT_CHUNK_SIZE else None
+
+class _FanoutServer(rtmp.FlashServer):
+    '''The stock server ignores play, so this one adds the playing stream to the players of the application instance.'''
+    def streamhandler(self, stream, message):
+        if message.type == rtmp.Message.RPC:
+            cmd = rtmp.Command.fromMessage(message)
+            if cmd.name == 'play':
+                stream.name = cmd.args[0]
+                stream.client.setPriority(multitask.PRIORITY_NORMAL)
+                self.clients[stream.client.path][0].players.setdefault(stream.name, []).append(stream)
+                return
+        yield super(_FanoutServer, self).streamhandler(stream, message)
+
+class _ClusterFanoutServer(_FanoutServer, cluster.ClusterServer):
+    pass
+
+def _run_server(port):
+    server = _FanoutServer(); server.start('127.0.0.1', port)
+    multitask.run()
+
+def _serve(setup, main=_run_server):
+    '''Fork main(port), which runs a server on an ephemeral port. setup(), if given, is called in the child first.
+    Returns (pid, port).'''
+    listener = socket.socket(); listener.bind(('127.0.0.1', 0)); port = listener.getsockname()[1]; listener.close()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            devnull = os.open(os.devnull, os.O_WRONLY); os.dup2(devnull, 1) # silence the debug prints of the TS handler
+            if setup: setup()
+            main(port)
+        finally:
+            os._exit(0)
+    for i in xrange(100): # wait for the server to listen
+        try: socket.create_connection(('127.0.0.1', port)).close(); break
+        except socket.error: time.sleep(0.05)
+    return pid, port
+
+def _cputime(pid):
+    '''Return the user+system CPU seconds used so far by the process pid and its children (Linux only, else None).'''
+    total, found = 0, False
+    for name in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        try:
+            with open('/proc/%s/stat' % (name,)) as f: fields = f.read().rpartition(')')[2].split()
+        except (IOError, OSError): continue
+        if name == str(pid) or fields[1] == str(pid): # fields[1] is the parent pid
+            total += int(fields[11]) + int(fields[12]); found = True
+    return total / float(os.sysconf('SC_CLK_TCK')) if found else None
+
+class _Peer(object):
+    '''A client connection of the load generator, with non-blocking input and output buffers.'''
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.sendall('\x03' + '\x00' * rtmp.Protocol.PING_SIZE) # simple handshake: C0, C1
+        need = 1 + 2 * rtmp.Protocol.PING_SIZE
+        while need > 0: need -= len(self.sock.recv(need))       # S0, S1, S2
+        self.sock.sendall('\x00' * rtmp.Protocol.PING_SIZE)    # C2
+        self.sock.sendall(_command('connect', 1, cmdData=amf.Object(app='bench', objectEncoding=0.0)) + _command('createStream', 2))
+        self.sock.setblocking(0)
+        self.output, self.input, self.markers, self.bytes, self.arrivals = '', '', 0, 0, []
+    def fileno(self):
+        return self.sock.fileno()
+    def readable(self):
+        try: data = self.sock.recv(65536)
+        except socket.error: return
+        self.bytes += len(data)
+        data = self.input + data
+        count = data.count(_MARKER)
+        self.markers += count
+        self.arrivals.extend([time.time()] * count)
+        self.input = data[-(len(_MARKER) - 1):]
+    def writable(self):
+        try: self.output = self.output[self.sock.send(self.output):]
+        except socket.error: pass
+
+class _Prober(object):
+    '''Opens one connection after another, each time measuring the connection setup latency: the time from connect() until
+    the replies to both connect and createStream are received.'''
+    def __init__(self, port, poller, byfd):
+        self.port, self.poller, self.byfd, self.latencies, self.sock = port, poller, byfd, [], None
+        self.start()
+    def start(self):
+        self.started = time.time()
+        self.sock = socket.create_connection(('127.0.0.1', self.port))
+        self.sock.sendall('\x03' + '\x00' * rtmp.Protocol.PING_SIZE)
+        self.sock.setblocking(0)
+        self.input, self.handshaken = '', False
+        self.byfd[self.sock.fileno()] = self; self.poller.register(self.sock.fileno(), select.EPOLLIN)
+    def stop(self):
+        if self.sock:
+            self.poller.unregister(self.sock.fileno()); del self.byfd[self.sock.fileno()]
+            self.sock.close(); self.sock = None
+    def readable(self):
+        try: self.input += self.sock.recv(65536)
+        except socket.error: return
+        if not self.handshaken and len(self.input) >= 1 + 2 * rtmp.Protocol.PING_SIZE:
+            self.input, self.handshaken = self.input[1 + 2 * rtmp.Protocol.PING_SIZE:], True
+            self.sock.sendall('\x00' * rtmp.Protocol.PING_SIZE + _command('connect', 1, cmdData=amf.Object(app='bench', objectEncoding=0.0)) + _command('createStream', 2))
+        if self.handshaken and self.input.count('\x02\x00\x07_result') >= 2:
+            self.latencies.append(time.time() - self.started)
+            self.stop(); self.start()
+
+def _peakrss(pid):
+    '''Return the peak resident memory in kB of the process pid (Linux only, else None).'''
+    try:
+        with open('/proc/%d/status' % (pid,)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'): return int(line.split()[1])
+    except (IOError, OSError): pass
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[max(0, int(len(values) * percent / 100.0 + 0.5) - 1)] if values else None
+
+def _fanout(players=200, messages=500, size=100, setup=None, main=_run_server, probe=False, pace=None, timeout=60.0):
+    '''Publish messages audio messages of the given payload size to the given number of players, all at once or pace
+    messages per second. Returns a dict with the elapsed time, delivered messages per second, server CPU percentage and
+    counters, and with pace the delays from publishing to receiving each message. With probe, new connections are made
+    one after another during the fan-out, and their setup latencies are returned too.'''
+    _raise_fd_limit(2 * players + 16)
+    pid, port = _serve(setup, main)
+    try:
+        publisher = _Peer(port)
+        publisher.output = _command('publish', 3, args=['bench'], streamId=1)
+        peers = [_Peer(port) for i in xrange(players)]
+        for peer in peers: peer.output = _command('play', 3, args=['bench'], streamId=1)
+        poller = select.epoll()
+        byfd = dict((peer.fileno(), peer) for peer in peers + [publisher])
+        for fd in byfd: poller.register(fd, select.EPOLLIN | select.EPOLLOUT)
+        def pump(until, deadline, feed=lambda: 0.1):
+            while not until() and time.time() < deadline:
+                for fd, events in poller.poll(feed()):
+                    peer = byfd[fd]
+                    if events & select.EPOLLIN: peer.readable()
+                    if events & select.EPOLLOUT:
+                        peer.writable()
+                        if not peer.output: poller.modify(fd, select.EPOLLIN)
+        settle = time.time() + 1.0
+        pump(lambda: False, settle) # let every client finish connect, createStream and publish or play
+        payload = '\xaf\x01' + 'x' * (size - 2 - len(_MARKER)) + _MARKER
+        config = _chunk(rtmp.Message(rtmp.Header(0, 0, 0, rtmp.Message.AUDIO, 1), '\xaf\x00\x12\x10'), 4) # AAC sequence header
+        chunks = [_chunk(rtmp.Message(rtmp.Header(0, i * 23, 0, rtmp.Message.AUDIO, 1), payload), 4) for i in xrange(messages)]
+        publisher.output, sent = config + ('' if pace else ''.join(chunks)), []
+        poller.modify(publisher.fileno(), select.EPOLLIN | select.EPOLLOUT)
+        for peer in peers: peer.arrivals = []
+        cpu0, start = _cputime(pid), time.time()
+        def feed(): # queue the messages due by now, and return the time until the next one
+            due = min(messages, int((time.time() - start) * pace) + 1)
+            if due > len(sent):
+                publisher.output += ''.join(chunks[len(sent):due])
+                sent.extend([time.time()] * (due - len(sent)))
+                poller.modify(publisher.fileno(), select.EPOLLIN | select.EPOLLOUT)
+            return 0.1 if due >= messages else min(0.1, max(0.0, start + due / float(pace) - time.time()))
+        prober = _Prober(port, poller, byfd) if probe else None
+        pump(lambda: all(peer.markers >= messages for peer in peers), start + timeout, *((feed,) if pace else ()))
+        elapsed, cpu1, rss = time.time() - start, _cputime(pid), _peakrss(pid)
+        if prober: prober.stop()
+        delivered = sum(peer.markers for peer in peers)
+        return dict(elapsed=elapsed, rate=delivered / elapsed, delivered=delivered, expected=messages * players,
+                    cpu=(100.0 * (cpu1 - cpu0) / elapsed) if cpu0 is not None and cpu1 is not None else None,
+                    bytes=sum(peer.bytes for peer in peers), latencies=prober.latencies if prober else None, rss=rss,
+                    delays=[arrival - sent[i] for peer in peers for i, arrival in enumerate(peer.arrivals)] if pace else None)
+    finally:
+        os.kill(pid, signal.SIGTERM); os.waitpid(pid, 0)
+
+def _print_fanout(name, result):
+    cpu = '%5.1f%%' % (result['cpu'],) if result['cpu'] is not None else '   n/a'
+    print '%-10s %10.0f msg/s  cpu %s  %d/%d messages in %.2fs' % (name, result['rate'], cpu, result['delivered'], result['expected'], result['elapsed'])
+
+def _unslotted():
+    '''Replace Header, Message, Stream, Protocol and Client in the rtmp module by copies without __slots__, whose instances
+    keep their attributes in a __dict__ as before.'''
+    replaced = dict()
+    for name in ('Header', 'Message', 'Stream', 'Protocol', 'Client'):
+        cls = getattr(rtmp, name)
+        namespace = dict((key, value) for key, value in cls.__dict__.items() if key not in cls.__slots__ and key not in ('__slots__', '__dict__', '__weakref__'))
+        replaced[cls] = copy = type(name, tuple(replaced.get(base, base) for base in cls.__bases__), namespace)
+        setattr(rtmp, name, copy)
+
+def _sizeof(obj):
+    return sys.getsizeof(obj) + (sys.getsizeof(obj.__dict__) if hasattr(obj, '__dict__') else 0)
+
+def bench_slots():
+    '''Bytes per Header and Message of a played copy, per Stream and per Client, and messages/s, server CPU and peak
+    memory for 1 publisher and 500 players: __dict__ backed objects versus __slots__, and __slots__ with a free list
+    of headers.'''
+    def objects(): # the sizes of the objects of the rtmp module as it is now
+        default = multitask.get_default_task_manager()
+        multitask.set_default_task_manager(multitask.TaskManager())
+        a, b = socket.socketpair()
+        try:
+            message = rtmp.Message(rtmp.Header(5, 1000, 100, rtmp.Message.AUDIO, 1), 'a' * 100).dup()
+            client = rtmp.Client(a, None); stream = rtmp.Stream(client)
+            stream.name, stream.metaData, stream.avcSeq, stream.avcIntra = 'bench', None, None, False
+            client.path = 'bench'
+            return _sizeof(message) + _sizeof(message.header), _sizeof(stream), _sizeof(client) + _sizeof(client.stream) + _sizeof(client.codec)
+        finally:
+            a.close(); b.close(); multitask.set_default_task_manager(default)
+    def freelist(): rtmp.Header.FREE_LIST_SIZE = 4096
+    setups = [('dict', _unslotted), ('slots', None), ('freelist', freelist)]
+    print '%-10s %8s %8s %8s %10s %8s %10s' % ('objects', 'message', 'stream', 'client', 'msg/s', 'cpu', 'peak kB')
+    for name, setup in setups:
+        saved = [(cls, getattr(rtmp, cls)) for cls in ('Header', 'Message', 'Stream', 'Protocol', 'Client')] + [('FREE_LIST_SIZE', rtmp.Header.FREE_LIST_SIZE)]
+        if setup: setup()
+        sizes = objects()
+        for key, value in saved:
+            if key == 'FREE_LIST_SIZE': rtmp.Header.FREE_LIST_SIZE = value
+            else: setattr(rtmp, key, value)
+        result = _fanout(players=500, messages=300, setup=setup)
+        cpu = '%7.1f%%' % (result['cpu'],) if result['cpu'] is not None else '     n/a'
+        print '%-10s %8d %8d %8d %10.0f %s %10s' % ((name,) + sizes + (result['rate'], cpu, result['rss'] or 'n/a'))
+
+def bench_asyncio():
+    '''Fan-out of 1 publisher to 200 players: messages/sec and server CPU% on the legacy TaskManager and on asyncio.'''
+    _print_fanout('legacy', _fanout())
+    try: import aiomultitask
+    except ImportError: print 'asyncio: skipped, neither asyncio nor trollius is available'; return
+    _print_fanout('asyncio', _fanout(setup=aiomultitask.install))
+
+def bench_cluster():
+    '''Fan-out of 1 publisher to 400 players on a cluster of 1, 2, 4... workers, up to the number of CPU cores.'''
+    workers, cores = 1, multiprocessing.cpu_count()
+    while True:
+        main = lambda port: cluster.serve(workers, '127.0.0.1', port, server_class=_ClusterFanoutServer)
+        _print_fanout('%d worker%s' % (workers, 's' if workers > 1 else ''), _fanout(players=400, main=main))
+        if workers >= cores: break
+        workers = min(2 * workers, cores)
+
+class _FifoTaskManager(multitask.TaskManager):
+    '''A TaskManager that ignores task priorities, hence runs every task from a single FIFO run queue.'''
+    def set_priority(self, task, priority):
+        pass
+
+def bench_priority():
+    '''Connection setup latency (handshake, connect, createStream) during a fan-out to 200 players, with and without priorities.'''
+    print '%-10s %8s %8s %8s %8s %12s' % ('scheduler', 'connects', 'p50 ms', 'p99 ms', 'max ms', 'fan-out msg/s')
+    for name, setup in (('fifo', lambda: multitask.set_default_task_manager(_FifoTaskManager())), ('priority', None)):
+        result = _fanout(messages=1000, setup=setup, probe=True)
+        latencies = result['latencies']
+        if not latencies: print '%-10s no connection completed' % (name,); continue
+        print '%-10s %8d %8.1f %8.1f %8.1f %12.0f' % (name, len(latencies), _percentile(latencies, 50) * 1e3, _percentile(latencies, 99) * 1e3, max(latencies) * 1e3, result['rate'])
+
+def _queueSendMessage(self, message, release=False):
+    '''The previous Protocol.writeMessage(), which always queues the message for the write task.'''
+    return self.writeQueue.put_nowait(message)
+
+def bench_sendnow():
+    '''Fan-out to 200 players of 300 messages, paced at 50/sec and all at once: delivery delay and server CPU per message
+    with the synchronous send of Protocol.writeMessage() versus always queueing for the write task.'''
+    print '%-8s %8s %10s %10s %12s %12s' % ('send', 'pace', 'p50 ms', 'p99 ms', 'cpu us/msg', 'msg/s')
+    for pace in (50, None):
+        for name, setup in (('queued', lambda: setattr(rtmp.Protocol, 'sendMessage', _queueSendMessage)), ('now', None)):
+            result = _fanout(messages=300, setup=setup, pace=pace)
+            delays = result['delays']
+            cpu = result['cpu'] * result['elapsed'] * 1e4 / result['delivered'] if result['cpu'] is not None and result['delivered'] else float('nan')
+            print '%-8s %8s %10s %10s %12.1f %12.0f' % (name, pace or 'max', '%.1f' % (_percentile(delays, 50) * 1e3,) if delays else '-',
+                                                     '%.1f' % (_percentile(delays, 99) * 1e3,) if delays else '-', cpu, result['rate'])
+
+def bench_dispatch():
+    '''Fan-out of 500 messages to 10 and 200 players: delivered messages/s per core of server CPU and CPU per published
+    message, with a streamhandler task per media message versus the direct dispatch by the parser to the Fanout.'''
+    print '%-8s %8s %12s %14s %12s' % ('media', 'players', 'msg/s', 'msg/s per core', 'cpu us/pub')
+    for players in (10, 200):
+        for name, setup in (('tasks', lambda: setattr(rtmp.FlashServer, 'fanout', lambda self, inst, stream: None)), ('direct', None)):
+            result = _fanout(players=players, setup=setup)
+            seconds = result['cpu'] * result['elapsed'] / 100.0 if result['cpu'] is not None else None
+            print '%-8s %8d %12.0f %14s %12s' % (name, players, result['rate'], '%.0f' % (result['delivered'] / seconds,) if seconds else 'n/a',
+                                                '%.1f' % (seconds * 1e6 * players / result['delivered'],) if seconds and result['delivered'] else 'n/a')
+
+def bench_profiler():
+    '''Overhead of the Profiler and of the Watchdog: 100k resumptions of tasks passing items through a Queue, and a
+    fan-out of 500 messages to 200 players, with neither, either and both enabled.'''
+    def enable(profiler, watchdog, manager=None):
+        manager = manager or multitask.get_default_task_manager()
+        if profiler: manager.set_profiler(multitask.Profiler())
+        if watchdog: manager.set_watchdog(multitask.Watchdog())
+        return manager
+    count = 50000
+    def put(queue):
+        for i in xrange(count): yield queue.put(i)
+    def get(queue):
+        for i in xrange(count): yield queue.get()
+    print '%-18s %12s %12s %12s' % ('scheduler', 'usec/resume', 'fan-out msg/s', 'cpu us/msg')
+    for name, profiler, watchdog in (('plain', False, False), ('profiler', True, False), ('watchdog', False, True), ('both', True, True)):
+        tm = enable(profiler, watchdog, multitask.TaskManager()); queue = multitask.Queue()
+        tm.add(get(queue)); tm.add(put(queue))
+        start = time.time(); tm.run(); elapsed = time.time() - start
+        tm.set_watchdog(None)
+        result = _fanout(messages=500, setup=lambda: enable(profiler, watchdog))
+        cpu = result['cpu'] * result['elapsed'] * 1e4 / result['delivered'] if result['cpu'] is not None and result['delivered'] else float('nan')
+        print '%-18s %12.2f %12.0f %12.1f' % (name, elapsed / (2 * count) * 1e6, result['rate'], cpu)
+
+def bench_accept():
+    '''An accept storm: 1000 clients connecting at once, time until each one has its handshake reply. A listen backlog of
+    5 with one accept per wakeup versus the default backlog with batched accepts.'''
+    clients = 1000
+    _raise_fd_limit(2 * clients + 16)
+    def main(backlog, batch):
+        def run(port):
+            rtmp.Server.ACCEPT_BATCH = batch
+            server = _FanoutServer(); server.start('127.0.0.1', port, backlog=backlog)
+            multitask.run()
+        return run
+    print '%-12s %8s %8s %8s %8s %10s' % ('accept', 'done', 'p50 ms', 'p99 ms', 'max ms', 'total s')
+    for name, backlog, batch in (('backlog 5', 5, 1), ('batched', 1024, rtmp.Server.ACCEPT_BATCH)):
+        pid, port = _serve(None, main(backlog, batch))
+        try:
+            poller, pending, latencies = select.epoll(), {}, []
+            start = time.time()
+            for i in xrange(clients):
+                sock = socket.socket(); sock.setblocking(0)
+                if sock.connect_ex(('127.0.0.1', port)) not in (0, errno.EINPROGRESS): sock.close(); continue
+                pending[sock.fileno()] = [sock, time.time(), False, 0] # socket, start, C0+C1 sent, reply bytes received
+                poller.register(sock.fileno(), select.EPOLLOUT)
+            need = 1 + 2 * rtmp.Protocol.PING_SIZE
+            while pending and time.time() < start + 30:
+                for fd, events in poller.poll(0.1):
+                    entry = pending[fd]
+                    if not entry[2]:
+                        entry[0].send('\x03' + '\x00' * rtmp.Protocol.PING_SIZE); entry[2] = True
+                        poller.modify(fd, select.EPOLLIN); continue
+                    try: data = entry[0].recv(65536)
+                    except socket.error: data = ''
+                    entry[3] += len(data)
+                    if not data or entry[3] >= need:
+                        if data: latencies.append(time.time() - entry[1])
+                        poller.unregister(fd); entry[0].close(); del pending[fd]
+            total = time.time() - start
+            for entry in pending.values(): entry[0].close()
+        finally:
+            os.kill(pid, signal.SIGTERM); os.waitpid(pid, 0)
+        print '%-12s %8d %8.1f %8.1f %8.1f %10.2f' % (name, len(latencies), _percentile(latencies, 50) * 1e3, _percentile(latencies, 99) * 1e3, max(latencies) * 1e3, total)
+
+BENCHMARKS = [(name[6:], func) for name, func in sorted(globals().items()) if name.startswith('bench_')]
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('-l', '--list', dest='list', default=False, action='store_true', help='list the available benchmarks')
+    parser.add_option('-c', '--corpus', dest='corpus', default=None, help='file of RTMP chunks after the handshake for the codec benchmark')
+    (options, args) = parser.parse_args()
+    _corpus_file = options.corpus
+    if options.list:
+        for name, func in BENCHMARKS: print '%-12s %s' % (name, func.__doc__)
+        sys.exit(0)
+    for name, func in BENCHMARKS:
+        if not args or name in args:
+            print '==', name
+            func()
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Run the Flash RTMP server in several worker processes that share the listening port.
+
+A single FlashServer runs all its tasks on one multitask loop, hence uses at most one CPU core. The serve() function of
+this module is a supervisor that forks a number of workers, by default one per core. Every worker runs its own
+ClusterServer listening on the same port with SO_REUSEPORT, so that the kernel spreads the incoming connections.
+
+A publisher and its players may end up in different workers. The workers are connected to each other by a mesh of
+socket pairs created by the supervisor before forking. Every worker subscribes at its peers to the streams that its own
+players play, and the worker that has the publisher forwards the published media messages to the subscribed workers. A
+worker delivers a forwarded message to its own players of the same application path and stream name exactly as if the
+publisher were local. Publish and unpublish are announced to the peers too, so that a stream name in use in any worker is
+rejected with NetStream.Publish.BadName everywhere.
+
+The workers cannot be restarted individually, because the mesh is only built at startup: if a worker dies, the
+supervisor stops the others and exits, so that it can be restarted as a whole.
+
+To start a cluster with four workers on the default port:
+$ python cluster.py -w 4
+
+or from an application:
+>>> cluster.serve(workers=4, port=1935, apps={'*': MyApp})
+'''
+
+import os, sys, time, errno, signal, socket, struct, multiprocessing, traceback
+import multitask, rtmp, amf
+
+_debug = False
+
+class Relay(object):
+    '''The connections of a worker to its peers. Frames are length prefixed: 4 bytes length of the rest, 1 byte kind,
+    then the kind specific body. Media frames carry the message type, time, application path and stream name.
+    The media of a stream are only forwarded to the peers that subscribed to it, and the queue of a peer holds at most
+    QUEUE_SIZE frames. When it is full, the media of the stream are dropped for that peer until the next video key frame,
+    or the next audio message if the stream has no video, which goes after the cached metadata and sequence headers of
+    the stream. A new subscriber starts the same way, so that its players can decode from the first message.'''
+    MEDIA, PUBLISH, UNPUBLISH, SUBSCRIBE, UNSUBSCRIBE = 1, 2, 3, 4, 5
+    MEDIA_HEADER = struct.Struct('>BBIH') # kind, message type, time, length of the key
+    QUEUE_SIZE = 1024 # frames queued for a peer at most, several seconds of media
+    SUBSCRIBE_INTERVAL = 0.25 # seconds between the checks of the streams that local players play
+
+    def __init__(self, socks):
+        self.peers = [rtmp.SockStream(sock) for sock in socks]
+        self.queues = [multitask.Queue(maxsize=Relay.QUEUE_SIZE) for sock in socks]
+        self.remote = dict() # (path, name) => number of peers that announced a publisher for it
+        self.subscribers = dict() # key => set of the indexes of the peers subscribed to it
+        self.lagging = set() # (index, key) of the peers that wait for a key frame of the stream
+        self.headers = dict() # key => frames of the metadata, AAC and AVC sequence headers of a local publisher
+        self.video = set() # keys of the local publishers that published video
+        self.received = dict() # (path, name) => ([metadata, AAC and AVC sequence header messages], set of primed players)
+        self.dropped = 0 # media frames not forwarded because the queue of the peer was full
+        self.server = None
+
+    def start(self, server):
+        '''Start reading from and writing to every peer, delivering the received frames to the server.'''
+        self.server = server
+        for index, (peer, queue) in enumerate(zip(self.peers, self.queues)):
+            multitask.add(self.reader(index, peer)); multitask.add(self.writer(peer, queue))
+        if self.peers: multitask.add(self.subscriber())
+
+    @staticmethod
+    def _key(path, name):
+        '''The application path and stream name, which AMF decodes as unicode, as a UTF-8 encoded str.'''
+        return (path + u'\x00' + name).encode('utf-8')
+
+    @staticmethod
+    def _unkey(data):
+        return tuple(data.decode('utf-8').split(u'\x00', 1))
+
+    @staticmethod
+    def header(message):
+        '''The index of a metadata, AAC or AVC sequence header message in the cached headers of a stream, else None.'''
+        if message.type == rtmp.Message.DATA: return 0
+        if message.type == rtmp.Message.AUDIO and message.data[:2] == '\xaf\x00': return 1
+        if message.type == rtmp.Message.VIDEO and message.data[:2] == '\x17\x00': return 2
+
+    def _broadcast(self, kind, key):
+        for queue in self.queues:
+            yield queue.put(struct.pack('>IB', len(key) + 1, kind) + key)
+
+    @staticmethod
+    def _media(key, message):
+        body = Relay.MEDIA_HEADER.pack(Relay.MEDIA, message.type, message.time, len(key)) + key
+        return struct.pack('>I', len(body) + len(message.data)) + body + message.data
+
+    def post(self, path, name, message):
+        '''Forward a published media message to the peers subscribed to its stream without yielding, see Relay.'''
+        key = Relay._key(path, name)
+        index, subscribers = Relay.header(message), self.subscribers.get(key)
+        if message.type == rtmp.Message.VIDEO: self.video.add(key)
+        if index is None and not subscribers: return
+        frame = Relay._media(key, message)
+        if index is not None: self.headers.setdefault(key, [None, None, None])[index] = frame
+        for peer in subscribers or (): self._enqueue(peer, key, message, frame)
+
+    def _enqueue(self, peer, key, message, frame):
+        queue = self.queues[peer]
+        if (peer, key) in self.lagging:
+            if message.type == rtmp.Message.VIDEO: resume = message.data[:1] != '' and ord(message.data[0]) >> 4 == 1 # key frame
+            else: resume = message.type == rtmp.Message.AUDIO and key not in self.video
+            headers = [header for header in self.headers.get(key, ()) if header is not None and header is not frame]
+            if not resume or len(queue) + len(headers) >= Relay.QUEUE_SIZE:
+                self.dropped += 1; return
+            self.lagging.discard((peer, key))
+            for header in headers: queue.put_nowait(header)
+        if not queue.put_nowait(frame):
+            self.lagging.add((peer, key)); self.dropped += 1
+
+    def drop(self, path, name):
+        '''Forget the cached headers of a local publisher that is gone.'''
+        key = Relay._key(path, name)
+        self.headers.pop(key, None); self.video.discard(key)
+
+    def subscribe(self, peer, key, subscribed):
+        '''Start or stop forwarding the stream of key to the peer of the given index.'''
+        if subscribed:
+            self.subscribers.setdefault(key, set()).add(peer)
+            self.lagging.add((peer, key)) # starts with the headers and a key frame
+        elif key in self.subscribers:
+            self.subscribers[key].discard(peer); self.lagging.discard((peer, key))
+            if not self.subscribers[key]: del self.subscribers[key]
+
+    def announce(self, path, name, published):
+        '''Generator to tell the peers that the stream name of the application path is now published or unpublished.'''
+        yield self._broadcast(Relay.PUBLISH if published else Relay.UNPUBLISH, Relay._key(path, name))
+
+    def subscriber(self):
+        '''Subscribe at the peers to the streams that local players play, and unsubscribe from those nobody plays any
+        more, every SUBSCRIBE_INTERVAL seconds. The peers do not know which stream has a publisher where.'''
+        subscribed = set()
+        while True:
+            yield multitask.sleep(Relay.SUBSCRIBE_INTERVAL)
+            wanted = set(Relay._key(path, name) for path, entry in self.server.clients.items() for name, players in entry[0].players.items() if players)
+            for key in wanted - subscribed: yield self._broadcast(Relay.SUBSCRIBE, key)
+            for key in subscribed - wanted: yield self._broadcast(Relay.UNSUBSCRIBE, key)
+            subscribed = wanted
+
+    def published(self, path, name):
+        '''Whether a peer has a publisher for the stream name of the application path.'''
+        return self.remote.get((path, name), 0) > 0
+
+    def writer(self, peer, queue):
+        try:
+            while True:
+                frames = yield queue.get_many(Relay.QUEUE_SIZE)
+                yield peer.writev(frames)
+        except rtmp.ConnectionClosed:
+            if _debug: print 'cluster.Relay peer closed while writing'
+
+    def reader(self, index, peer):
+        try:
+            while True:
+                size = struct.unpack('>I', (yield peer.read(4)))[0]
+                frame = yield peer.read(size)
+                kind = ord(frame[0])
+                if kind == Relay.MEDIA:
+                    kind, type, tm, keysize = Relay.MEDIA_HEADER.unpack_from(frame)
+                    offset = Relay.MEDIA_HEADER.size
+                    key = Relay._unkey(frame[offset:offset+keysize])
+                    message = rtmp.Message(rtmp.Header(time=tm, size=size - offset - keysize, type=type), frame[offset+keysize:])
+                    header = Relay.header(message)
+                    if header is not None: self.received.setdefault(key, ([None, None, None], set()))[0][header] = message
+                    yield self.server.relayhandler(key[0], key[1], message)
+                elif kind == Relay.SUBSCRIBE or kind == Relay.UNSUBSCRIBE:
+                    self.subscribe(index, frame[1:], kind == Relay.SUBSCRIBE)
+                else:
+                    key = Relay._unkey(frame[1:])
+                    self.remote[key] = self.remote.get(key, 0) + (1 if kind == Relay.PUBLISH else -1)
+                    if self.remote[key] <= 0: del self.remote[key]; self.received.pop(key, None)
+        except rtmp.ConnectionClosed:
+            if _debug: print 'cluster.Relay peer closed while reading'
+
+class RelayFanout(rtmp.Fanout):
+    '''Like rtmp.Fanout, but also forwards the media accepted by the application to the peers.'''
+    __slots__ = ('relay',)
+    def __init__(self, inst, stream, relay):
+        rtmp.Fanout.__init__(self, inst, stream)
+        self.relay = relay
+
+    def dispatch(self, message):
+        stream = self.stream
+        if stream.client is not None and self.inst.onPublishData(stream.client, stream, message):
+            self.relay.post(stream.client.path, stream.name, message)
+            self.play(message)
+            self.record(message)
+
+class ClusterServer(rtmp.FlashServer):
+    '''A FlashServer for one worker of a cluster, which shares published streams with the other workers through relay.'''
+    def __init__(self, relay):
+        rtmp.FlashServer.__init__(self)
+        self.relay = relay
+        self.relayed = dict() # (path, name) => Fanout to the local players of a stream published by a peer
+
+    def start(self, host='0.0.0.0', port=1935, backlog=1024, acceptRate=None):
+        rtmp.FlashServer.start(self, host, port, reuseport=True, backlog=backlog, acceptRate=acceptRate)
+        self.relay.start(self)
+
+    def publishhandler(self, stream, cmd):
+        name = cmd.args and cmd.args[0] and cmd.args[0].partition('?')[0]
+        if name and self.relay.published(stream.client.path, name):
+            if _debug: print 'cluster stream name already published by another worker', name
+            response = rtmp.Command(name='onStatus', id=cmd.id, tm=stream.client.relativeTime, args=[amf.Object(level='error',code='NetStream.Publish.BadName',description='Stream name already in use',details=None)])
+            yield stream.send(response)
+        else:
+            yield rtmp.FlashServer.publishhandler(self, stream, cmd)
+            inst = self.clients[stream.client.path][0]
+            if inst.publishers.get(stream.name) is stream:
+                yield self.relay.announce(stream.client.path, stream.name, True)
+
+    def closehandler(self, stream):
+        if stream.client is not None and stream.client.path in self.clients:
+            inst = self.clients[stream.client.path][0]
+            if inst.publishers.get(stream.name) is stream:
+                self.relay.drop(stream.client.path, stream.name)
+                multitask.add(self.relay.announce(stream.client.path, stream.name, False))
+        rtmp.FlashServer.closehandler(self, stream)
+
+    def fanout(self, inst, stream):
+        cls = type(self)
+        if cls.mediahandler.im_func is not ClusterServer.mediahandler.im_func or cls.playershandler.im_func is not rtmp.FlashServer.playershandler.im_func: return None
+        return RelayFanout(inst, stream, self.relay)
+
+    def mediahandler(self, stream, message):
+        '''Like FlashServer.mediahandler, but also forwards the media accepted by the application to the peers.'''
+        if stream.client is not None:
+            inst = self.clients[stream.client.path][0]
+            result = inst.onPublishData(stream.client, stream, message)
+            if result:
+                self.relay.post(stream.client.path, stream.name, message)
+                yield self.playershandler(inst, stream.name, message)
+                stream.recorder.write(message)
+
+    def relayhandler(self, path, name, message):
+        '''Deliver a media message forwarded by a peer to the local players of the stream, through a Fanout like the media
+        of a local publisher, unless fanout() returns None. A player that joined since the previous message first gets
+        the metadata and sequence headers of the stream received so far.'''
+        if path in self.clients:
+            inst = self.clients[path][0]
+            players = inst.players.get(name, [])
+            headers, primed = self.relay.received.get((path, name), ((), set()))
+            if not players: primed.clear(); self.relayed.pop((path, name), None); return
+            for s in players:
+                if s not in primed:
+                    primed.add(s)
+                    for header in headers:
+                        if header is not None and header is not message:
+                            m = header.dup()
+                            if inst.onPlayData(s.client, s, m): yield s.send(m)
+            if len(primed) > len(players): primed.intersection_update(players)
+            fanout = self.relayed.get((path, name))
+            if fanout is None or fanout.inst is not inst:
+                fanout = self.fanout(inst, None)
+                if fanout is None: yield self.playershandler(inst, name, message); return
+                fanout.name, self.relayed[(path, name)] = name, fanout
+            fanout.play(message)
+
+def _worker(index, socks, host, port, root, apps, server_class):
+    if _debug: print 'cluster worker', index, 'pid', os.getpid()
+    agent = server_class(Relay(socks))
+    agent.root = root
+    if apps is not None: agent.apps = apps
+    agent.start(host, port)
+    multitask.run()
+
+def serve(workers=None, host='0.0.0.0', port=1935, root='', apps=None, server_class=ClusterServer):
+    '''Fork the given number of workers, by default one per CPU core, each running a server_class instance listening on
+    host and port, and wait until one of them exits. Then stop the other workers and return.'''
+    workers = workers or multiprocessing.cpu_count()
+    mesh = [[None] * workers for i in xrange(workers)] # mesh[i][j] is the socket of worker i connected to worker j
+    for i in xrange(workers):
+        for j in xrange(i + 1, workers):
+            mesh[i][j], mesh[j][i] = socket.socketpair()
+    pids = []
+    for i in xrange(workers):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                for j, row in enumerate(mesh): # keep only our own ends of the mesh
+                    for k, sock in enumerate(row):
+                        if sock is not None and j != i: sock.close()
+                _worker(i, [sock for sock in mesh[i] if sock is not None], host, port, root, apps, server_class)
+            except KeyboardInterrupt: pass
+            except:
+                traceback.print_exc(); status = 1
+            os._exit(status)
+        pids.append(pid)
+    for row in mesh:
+        for sock in row:
+            if sock is not None: sock.close()
+
+    def terminate(signum, frame): raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        while True:
+            try: pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR: continue
+                raise
+            if pid in pids:
+                if _debug: print 'cluster worker', pid, 'exited with status', status
+                pids.remove(pid)
+                break
+    except KeyboardInterrupt: pass
+    finally:
+        for pid in pids:
+            try: os.kill(pid, signal.SIGTERM)
+            except OSError: pass
+        for pid in pids:
+            try: os.waitpid(pid, 0)
+            except OSError: pass
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(version='0.1')
+    parser.add_option('-i', '--host',    dest='host',    default='0.0.0.0', help="listening IP address. Default '0.0.0.0'")
+    parser.add_option('-p', '--port',    dest='port',    default=1935, type="int", help='listening port number. Default 1935')
+    parser.add_option('-r', '--root',    dest='root',    default='./',       help="document path prefix. Directory must end with /. Default './'")
+    parser.add_option('-w', '--workers', dest='workers', default=0, type="int", help='number of worker processes. Default one per CPU core')
+    parser.add_option('-d', '--verbose', dest='verbose', default=False, action='store_true', help='enable debug trace')
+    (options, args) = parser.parse_args()
+
+    _debug = rtmp._debug = options.verbose
+    root_dir = os.path.abspath(options.root)
+    if not root_dir.endswith('/'):
+        root_dir = root_dir + '/'
+    if _debug: print time.asctime(), 'Flash Server Cluster Starts - %s:%d' % (options.host, options.port)
+    serve(options.workers or None, options.host, options.port, root_dir)
+    if _debug: print time.asctime(), 'Flash Server Cluster Stops'
@@ -137,11 +137,17 @@ import collections
 import errno
 from functools import partial
 import heapq
+import inspect
+import itertools
+import math
 import os
 import select
 import sys
+import threading
 import time
+import traceback
 import types
+import weakref
 
 
 __author__   = 'Christopher Stawarz <cstawarz@csail.mit.edu>'
@@ -164,6 +170,26 @@ class Timeout(Exception):
 
 
 
+################################################################################
+#
+# Task priorities
+#
+################################################################################
+
+
+
+# A TaskManager has one run queue per priority.  Whenever it runs the
+# runnable tasks, it always picks the next one from the highest
+# priority queue that is not empty.  All the runnable tasks are still
+# run before the TaskManager waits for I/O again, so a task never
+# starves; the priority only decides which tasks run first.
+PRIORITY_HIGH   = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW    = 2
+PRIORITIES      = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+
+
 ################################################################################
 #
 # _ChildTask class
@@ -177,6 +203,8 @@ class _ChildTask(object):
     def __init__(self, parent, task):
         self.parent = parent
         self.task = task
+        # The task added to the TaskManager, whose priority applies
+        self.root = (parent.root if isinstance(parent, _ChildTask) else parent)
 
     def send(self, value):
         return self.task.send(value)
@@ -523,6 +551,25 @@ def recv(sock, *args, **kwargs):
     return FDAction(sock, sock.recv, args, kwargs, read=True)
 
 
+def recv_into(sock, *args, **kwargs):
+    """
+
+    A task that yields the result of this function will be resumed
+    when sock is readable, and the value of the yield expression will
+    be the number of bytes received into the given buffer, a bytearray
+    or a writable memoryview.  If a timeout keyword is given and is
+    not None, a Timeout exception will be raised in the yielding task
+    if sock is not readable after timeout seconds have elapsed.  Other
+    arguments will be passed to sock.recv_into().  For example:
+
+      buffer = bytearray(4096)
+      nbytes = (yield recv_into(sock, buffer, timeout=5))
+
+    """
+
+    return FDAction(sock, sock.recv_into, args, kwargs, read=True)
+
+
 def recvfrom(sock, *args, **kwargs):
     """
 
@@ -587,6 +634,140 @@ def sendto(sock, *args, **kwargs):
 
 
 
+################################################################################
+#
+# PersistentFD and _PersistentAction classes
+#
+################################################################################
+
+
+
+class PersistentFD(object):
+
+    """
+
+    A socket that stays registered with the task manager's reactor for
+    its whole life.  recv() and send() build a new FDAction for every
+    call, and the reactor adds and removes the socket each time.  The
+    methods of this class instead return the same two actions over and
+    over, and the reactor keeps the socket registered between waits, so
+    a busy socket costs no allocations and no reactor updates per I/O
+    operation.  For example:
+
+      fd = PersistentFD(sock)
+      while True:
+          data = (yield fd.recv(4096))
+          if not data:
+              break
+          yield fd.send(data)
+      fd.close()
+      sock.close()
+
+    One task may wait for reading and another for writing at the same
+    time.  Additional concurrent operations fall back to recv(),
+    recv_into() and send().  close() must be called before the socket
+    is closed.
+
+    """
+
+    def __init__(self, sock, task_manager=None):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self._task_manager = (task_manager or get_default_task_manager())
+        self._reader = _PersistentAction(self.fd, sock.recv, read=True)
+        self._filler = _PersistentAction(self.fd, sock.recv_into, read=True)
+        self._writer = _PersistentAction(self.fd, sock.send, write=True)
+        self._task_manager.attach(self.fd)
+
+    def fileno(self):
+        'Return the file descriptor of the socket'
+        return self.fd
+
+    def recv(self, bufsize):
+        """
+
+        A task that yields the result of this method will be resumed
+        when the socket is readable, and the value of the yield
+        expression will be the result of sock.recv(bufsize).
+
+        """
+
+        action = self._reader
+        if action.pending:
+            return recv(self.sock, bufsize)
+        action.pending, action.arg = True, bufsize
+        return action
+
+    def recv_into(self, buffer):
+        """
+
+        A task that yields the result of this method will be resumed
+        when the socket is readable, and the value of the yield
+        expression will be the result of sock.recv_into(buffer).
+
+        """
+
+        action = self._filler
+        if action.pending:
+            return recv_into(self.sock, buffer)
+        action.pending, action.arg = True, buffer
+        return action
+
+    def send(self, data):
+        """
+
+        A task that yields the result of this method will be resumed
+        when the socket is writable, and the value of the yield
+        expression will be the result of sock.send(data).
+
+        """
+
+        action = self._writer
+        if action.pending:
+            return send(self.sock, data)
+        action.pending, action.arg = True, data
+        return action
+
+    def close(self):
+        """
+
+        Unregister the socket from the reactor.  A task still waiting
+        on it is resumed with an EBADF error, see TaskManager.detach().
+        The socket is not closed.  Closing again does nothing.
+
+        """
+
+        if self._task_manager is None:
+            return
+        self._task_manager.detach(self.fd)
+        self._task_manager = None
+        for action in (self._reader, self._filler, self._writer):
+            action.task = None
+            action._reset()
+
+
+class _PersistentAction(FDAction):
+
+    # A reusable FDAction taking a single argument.  pending is set
+    # while a task is suspended on it and cleared when the action is
+    # performed, or by _reset() when the wait ends without it.
+
+    def __init__(self, fd, func, read=False, write=False):
+        super(_PersistentAction, self).__init__(fd, func, read=read,
+                                                write=write)
+        self.arg = None
+        self.pending = False
+
+    def _eval(self):
+        arg = self.arg
+        self._reset()
+        return self.func(arg)
+
+    def _reset(self):
+        self.pending, self.arg = False, None
+
+
+
 ################################################################################
 #
 # Queue and _QueueAction classes
@@ -604,6 +785,8 @@ class Queue(object):
 
     """
 
+    _manager = None     # the TaskManager of the tasks waiting in get() or put()
+
     def __init__(self, contents=(), maxsize=0):
         """
 
@@ -655,6 +838,20 @@ class Queue(object):
 
         return _QueueAction(self, timeout=timeout)
 
+    def get_many(self, max_items, timeout=None):
+        """
+
+        Like get(), but the value of the yield expression is a list of
+        all the items available in the queue, up to max_items, so that
+        a task can process a burst of items in a single resumption.
+        The list contains at least one item.
+
+        """
+
+        if max_items < 1:
+            raise ValueError("'max_items' must be greater than 0")
+        return _QueueAction(self, timeout=timeout, max_items=max_items)
+
     def put(self, item, timeout=None):
         """
 
@@ -673,17 +870,88 @@ class Queue(object):
 
         return _QueueAction(self, item, timeout=timeout)
 
+    def put_many(self, items, timeout=None):
+        """
+
+        Like put(), but adds all the given items, in order.  If the
+        queue does not have space for all of them, the task is resumed
+        when the last one has been added.  On Timeout, the items added
+        so far stay in the queue.
+
+        """
+
+        return _QueueAction(self, timeout=timeout,
+                            items=collections.deque(items))
+
+    def put_nowait(self, item, force=False):
+        """
+
+        Add item to the queue without yielding, and return True, or
+        return False if the queue is full or tasks are waiting in put(),
+        which must go first.  If a task is waiting in get(), the item is
+        handed over to it directly, without a _QueueAction and a round
+        trip through the run queue for the caller.  For example:
+
+          if not queue.put_nowait(item):
+              yield queue.put(item)
+
+        With force, the item is added in any case, ahead of the items of
+        the tasks waiting in put(), e.g., for the rest of something that
+        was begun before them.
+
+        """
+
+        if self.full() and not force:
+            return False
+        if self._manager is not None:
+            get_waits, put_waits = self._manager._queue_waits[self]
+            if put_waits and not force:
+                return False
+            self._put(item)
+            if get_waits:
+                self._manager._wake_getters(self, get_waits)
+        else:
+            self._put(item)
+        return True
+
 
 class _QueueAction(YieldCondition):
 
     NO_ITEM = object()
 
-    def __init__(self, queue, item=NO_ITEM, timeout=None):
+    def __init__(self, queue, item=NO_ITEM, timeout=None, max_items=None,
+                 items=None):
         super(_QueueAction, self).__init__(timeout)
         if not isinstance(queue, Queue):
             raise TypeError("'queue' must be a Queue instance")
         self.queue = queue
         self.item = item
+        self.max_items = max_items  # get_many(): maximum size of the list
+        self.items = items          # put_many(): deque of items not put yet
+
+    def _is_get(self):
+        return (self.item is self.NO_ITEM) and (self.items is None)
+
+    def _take(self):
+        # Remove what a get action returns from the (non-empty) queue
+        queue = self.queue
+        if self.max_items is None:
+            return queue._get()
+        return [queue._get() for i in xrange(min(self.max_items, len(queue)))]
+
+    def _give(self):
+        # Add to the queue as many items of a put action as fit, and
+        # return True if no item is left
+        queue = self.queue
+        if self.items is None:
+            if queue.full():
+                return False
+            queue._put(self.item)
+            return True
+        items = self.items
+        while items and not queue.full():
+            queue._put(items.popleft())
+        return not items
 
 
 ################################################################################
@@ -704,28 +972,51 @@ class SmartQueue(object):
     on get and allows multiple get to be signalled for the same put. 
     On the downside, this uses list instead of deque and has lower
     performance.
+
+    In keyed mode, i.e. if a key function is given, items are kept in
+    one deque per key, and a get() for a key finds its item, or a put()
+    finds the task waiting for the key of the item, in constant time
+    instead of trying every criteria against every item.  For example,
+    with messages of many streams:
+
+      queue = SmartQueue(key=lambda msg: msg.streamId)
+      msg = (yield queue.get(key=stream.id))
     
     """
 
-    def __init__(self, contents=(), maxsize=0):
+    NO_KEY = object()
+
+    def __init__(self, contents=(), maxsize=0, key=None):
         """
 
         Create a new Queue instance.  contents is a sequence (empty by
         default) containing the initial contents of the queue.  If
         maxsize is greater than 0, the queue will hold a maximum of
         maxsize items, and put() will block until space is available
-        in the queue.
+        in the queue.  If key is given, it is a function returning the
+        key of an item, and the queue is in keyed mode.
 
         """
 
         self.maxsize = int(maxsize)
-        self._pending =  list(contents)
+        self.key = key
+        if key is None:
+            self._pending =  list(contents)
+        else:
+            self._keyed = {}        # key => deque of (sequence, item)
+            self._order = collections.deque()   # (sequence, key) of every put, see _oldest()
+            self._count = 0
+            self._sequence = itertools.count()
+            for item in contents:
+                self._put(item)
 
     def __len__(self):
         'Return the number of items in the queue'
-        return len(self._pending)
+        return (len(self._pending) if self.key is None else self._count)
 
-    def _get(self, criteria=None):
+    def _get(self, criteria=None, key=NO_KEY):
+        if self.key is not None:
+            return self._get_keyed(key)
         #self._pending = filter(lambda x: x[1]<=now, self._pending) # remove expired ones
         if criteria:
             found = filter(lambda x: criteria(x), self._pending)   # check any matching criteria
@@ -737,8 +1028,50 @@ class SmartQueue(object):
         else:
             return self._pending.pop(0) if self._pending else None
 
+    def _live(self, entry):
+        # The items of a key are only taken from the front, so an entry
+        # of _order is stale once its sequence is before the first one
+        items = self._keyed.get(entry[1])
+        return (items is not None) and (items[0][0] <= entry[0])
+
+    def _oldest(self):
+        # The key of the oldest item.  The entries of the items taken
+        # by key are skipped here, and dropped when they outnumber the
+        # items, so that both kinds of get() are amortized O(1).
+        order = self._order
+        while order[0][0] != self._keyed.get(order[0][1], ((None,),))[0][0]:
+            order.popleft()
+        return order.popleft()[1]
+
+    def _get_keyed(self, key):
+        if key is self.NO_KEY:
+            # The oldest item of any key
+            if not self._count:
+                return None
+            key = self._oldest()
+        elif len(self._order) > 2 * self._count + 16:
+            self._order = collections.deque(entry for entry in self._order if self._live(entry))
+        items = self._keyed.get(key)
+        if not items:
+            return None
+        item = items.popleft()[1]
+        if not items:
+            del self._keyed[key]
+        self._count -= 1
+        return item
+
     def _put(self, item):
-        self._pending.append(item)
+        if self.key is None:
+            self._pending.append(item)
+        else:
+            key = self.key(item)
+            items = self._keyed.get(key)
+            if items is None:
+                items = self._keyed[key] = collections.deque()
+            sequence = next(self._sequence)
+            items.append((sequence, item))
+            self._order.append((sequence, key))
+            self._count += 1
 
     def empty(self):
         'Return True is the queue is empty, False otherwise'
@@ -748,7 +1081,7 @@ class SmartQueue(object):
         'Return True is the queue is full, False otherwise'
         return ((len(self) >= self.maxsize) if (self.maxsize > 0) else False)
 
-    def get(self, timeout=None, criteria=None):
+    def get(self, timeout=None, criteria=None, key=NO_KEY):
         """
 
         A task that yields the result of this method will be resumed
@@ -764,9 +1097,16 @@ class SmartQueue(object):
           except Timeout:
               # No item available after 5 seconds
 
+        In keyed mode, key selects the items instead of criteria, and
+        without a key the oldest item is returned.
+
         """
 
-        return _SmartQueueAction(self, timeout=timeout, criteria=criteria)
+        if self.key is None and key is not self.NO_KEY:
+            raise ValueError("'key' requires a SmartQueue in keyed mode")
+        if self.key is not None and criteria is not None:
+            raise ValueError("a SmartQueue in keyed mode uses 'key', not 'criteria'")
+        return _SmartQueueAction(self, timeout=timeout, criteria=criteria, key=key)
 
     def put(self, item, timeout=None):
         """
@@ -794,16 +1134,742 @@ class _SmartQueueAction(YieldCondition):
 
     NO_ITEM = object()
 
-    def __init__(self, queue, item=NO_ITEM, timeout=None, criteria=None):
+    def __init__(self, queue, item=NO_ITEM, timeout=None, criteria=None,
+                 key=SmartQueue.NO_KEY):
         super(_SmartQueueAction, self).__init__(timeout)
         if not isinstance(queue, SmartQueue):
             raise TypeError("'queue' must be a SmartQueue instance")
         self.queue = queue
         self.item = item
         self.criteria = criteria
+        self.key = key
         self.expires = (timeout is not None) and (time.time() + timeout) or 0
 
 
+################################################################################
+#
+# Reactor classes
+#
+################################################################################
+
+
+
+class SelectReactor(object):
+
+    """
+
+    Reactor that waits for I/O readiness using select().  This is the
+    reference implementation: it is available on every platform, but
+    each call to poll() costs O(n) in the number of waiting file
+    descriptors and it cannot handle descriptors above FD_SETSIZE
+    (usually 1024).
+
+    A reactor keeps track of the FDReady instances that tasks are
+    waiting on.  register() and unregister() add and remove a waiter,
+    and poll() returns the waiters that are ready for I/O.  attach()
+    marks a file descriptor as long-lived (see PersistentFD), which
+    allows a reactor to keep it registered between waits.
+
+    """
+
+    def __init__(self):
+        self._read_waits  = set()
+        self._write_waits = set()
+        self._exc_waits   = set()
+        self._attached    = set()
+
+    def __len__(self):
+        'Return the number of registered waiters'
+        return len(self._read_waits | self._write_waits | self._exc_waits)
+
+    def has_waits(self):
+        'Return True if there are registered waiters, False otherwise'
+        return bool(self._read_waits or self._write_waits or self._exc_waits)
+
+    def waiters(self):
+        'Return a list of all registered waiters'
+        return list(self._read_waits | self._write_waits | self._exc_waits)
+
+    def register(self, fdready):
+        'Start waiting for the I/O condition described by fdready'
+        fdready._add_to_fdsets(self._read_waits,
+                               self._write_waits,
+                               self._exc_waits)
+
+    def unregister(self, fdready):
+        'Stop waiting for fdready.  Unknown waiters are ignored.'
+        fdready._remove_from_fdsets(self._read_waits,
+                                    self._write_waits,
+                                    self._exc_waits)
+
+    def attach(self, fd):
+        'Keep fd registered until detach() is called'
+        self._attached.add(fd)
+
+    def detach(self, fd):
+        """
+
+        Undo attach().  Must be called before fd is closed.  The
+        waiters of fd would never be resumed, and a new descriptor may
+        reuse the number, so they are unregistered and returned, for
+        the caller to resume them.
+
+        """
+
+        self._attached.discard(fd)
+        waits = [fdready for fdready in (self._read_waits | self._write_waits | self._exc_waits)
+                 if fdready.fd == fd]
+        for fdready in waits:
+            self.unregister(fdready)
+        return waits
+
+    def attached(self):
+        'Return a list of the attached file descriptors'
+        return list(self._attached)
+
+    def poll(self, timeout):
+        """
+
+        Wait at most timeout seconds (forever if timeout is None) and
+        return a list of the waiters that are ready.  Errors raised by
+        the underlying system call are propagated to the caller.
+
+        """
+
+        read_ready, write_ready, exc_ready = \
+            select.select(self._read_waits,
+                          self._write_waits,
+                          self._exc_waits,
+                          timeout)
+        return set(read_ready + write_ready + exc_ready)
+
+    def remove_bad_file_descriptors(self):
+        'Unregister and return the waiters whose descriptors are invalid'
+        bad = []
+        for fd in (self._read_waits | self._write_waits | self._exc_waits):
+            try:
+                select.select([fd], [fd], [fd], 0.0)
+            except:
+                self.unregister(fd)
+                bad.append(fd)
+        return bad
+
+    def close(self):
+        'Release any resources held by the reactor'
+        pass
+
+
+class _PollingReactor(SelectReactor):
+
+    """
+
+    Base class for reactors built on a poll()-style object, which keep
+    one registration per file descriptor and only pay for the
+    descriptors that are actually ready.  Subclasses supply the poller
+    object and its event masks.
+
+    An attached descriptor is not removed from the poller when its
+    last waiter goes away, and its event mask is only widened by
+    register().  Events that nobody waits for any more narrow the
+    mask lazily in poll(), so a socket that is read from in a loop
+    causes no poller updates at all.
+
+    """
+
+    _READ = _WRITE = _EXC = _ERROR = _INVALID = 0
+
+    def __init__(self):
+        self._poller   = self._create_poller()
+        self._waits    = {}     # fd => set of FDReady waiting on it
+        self._masks    = {}     # fd => event mask registered with the poller
+        self._bad      = []     # waiters found to have invalid descriptors
+        self._attached = set()
+
+    def __len__(self):
+        return sum(len(waits) for waits in self._waits.itervalues()) + len(self._bad)
+
+    def has_waits(self):
+        return bool(self._waits or self._bad)
+
+    def waiters(self):
+        result = list(self._bad)
+        for waits in self._waits.itervalues():
+            result.extend(waits)
+        return result
+
+    def _mask(self, fdready):
+        return ((fdready.read and self._READ) |
+                (fdready.write and self._WRITE) |
+                (fdready.exc and self._EXC))
+
+    def register(self, fdready):
+        waits = self._waits.get(fdready.fd)
+        if waits is None:
+            waits = self._waits[fdready.fd] = set()
+        waits.add(fdready)
+        self._update(fdready.fd)
+
+    def unregister(self, fdready):
+        waits = self._waits.get(fdready.fd)
+        if waits is not None and fdready in waits:
+            waits.discard(fdready)
+            self._update(fdready.fd)
+        elif fdready in self._bad:
+            self._bad.remove(fdready)
+
+    def detach(self, fd):
+        # fd is about to be closed.  Its waiters would never be resumed,
+        # and the poller may forget it behind our back (epoll does), so
+        # drop every trace of it: a new descriptor that reuses the
+        # number must be registered from scratch.
+        self._attached.discard(fd)
+        if self._masks.pop(fd, 0):
+            try:
+                self._poller.unregister(fd)
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+        return list(self._waits.pop(fd, ()))
+
+    def _wanted(self, fd):
+        mask = 0
+        for fdready in self._waits.get(fd, ()):
+            mask |= self._mask(fdready)
+        return mask
+
+    def _update(self, fd):
+        mask = self._wanted(fd)
+        old = self._masks.get(fd, 0)
+        if not mask:
+            self._waits.pop(fd, None)
+        if fd in self._attached:
+            mask |= old
+        if mask == old:
+            return
+        try:
+            if not mask:
+                del self._masks[fd]
+                self._poller.unregister(fd)
+            elif not old:
+                self._poller.register(fd, mask)
+                self._masks[fd] = mask
+            else:
+                self._modify(fd, mask)
+                self._masks[fd] = mask
+        except (IOError, OSError, ValueError, KeyError):
+            # The descriptor was closed behind our back.  Like select(),
+            # defer the failure to remove_bad_file_descriptors().
+            self._masks.pop(fd, None)
+            self._bad.extend(self._waits.pop(fd, ()))
+
+    def _modify(self, fd, mask):
+        try:
+            self._poller.modify(fd, mask)
+        except (IOError, OSError), err:
+            # epoll forgets descriptors when they are closed, so a new
+            # descriptor that reuses the number must be registered again
+            if err.errno != errno.ENOENT:
+                raise
+            self._poller.register(fd, mask)
+
+    def _poller_wait(self, timeout):
+        raise NotImplementedError
+
+    def poll(self, timeout):
+        if self._bad:
+            raise IOError(errno.EBADF, os.strerror(errno.EBADF))
+
+        ready = []
+        for fd, events in self._poller_wait(timeout):
+            waits = self._waits.get(fd)
+            if fd in self._attached:
+                wanted = self._wanted(fd)
+                if not (events & wanted) and self._masks.get(fd, 0) != wanted:
+                    self._narrow(fd, wanted)
+            if not waits:
+                continue
+            if events & self._INVALID:
+                self._masks.pop(fd, None)
+                self._bad.extend(self._waits.pop(fd))
+                continue
+            if events & self._ERROR:
+                # Like select(), report errors to every waiter so that
+                # the pending operation raises in the task
+                ready.extend(waits)
+            else:
+                ready.extend(fdready for fdready in waits
+                             if events & self._mask(fdready))
+        return ready
+
+    def _narrow(self, fd, mask):
+        # An attached descriptor reported an event that no task waits
+        # for, so stop asking for it.  With no waiters at all it is
+        # dropped from the poller until the next register(), since
+        # errors and hang-ups are reported whatever the mask is.
+        try:
+            if not mask:
+                del self._masks[fd]
+                self._poller.unregister(fd)
+            else:
+                self._modify(fd, mask)
+                self._masks[fd] = mask
+        except (IOError, OSError, ValueError, KeyError):
+            self._masks.pop(fd, None)
+
+    def remove_bad_file_descriptors(self):
+        bad, self._bad = self._bad, []
+        for fd in self._waits.keys():
+            try:
+                os.fstat(fd)
+            except OSError:
+                self._masks.pop(fd, None)
+                bad.extend(self._waits.pop(fd))
+                try:
+                    self._poller.unregister(fd)
+                except (IOError, OSError, ValueError, KeyError):
+                    pass
+        return bad
+
+
+class PollReactor(_PollingReactor):
+
+    'Reactor that waits for I/O readiness using poll()'
+
+    if hasattr(select, 'poll'):
+        _READ    = select.POLLIN
+        _WRITE   = select.POLLOUT
+        _EXC     = select.POLLPRI
+        _ERROR   = select.POLLERR | select.POLLHUP
+        _INVALID = select.POLLNVAL
+
+    def _create_poller(self):
+        return select.poll()
+
+    def _poller_wait(self, timeout):
+        # poll() takes milliseconds and blocks forever on a negative value
+        if timeout is None:
+            return self._poller.poll(-1)
+        return self._poller.poll(int(math.ceil(timeout * 1000.0)))
+
+
+class EpollReactor(_PollingReactor):
+
+    'Reactor that waits for I/O readiness using epoll() (Linux only)'
+
+    if hasattr(select, 'epoll'):
+        _READ    = select.EPOLLIN
+        _WRITE   = select.EPOLLOUT
+        _EXC     = select.EPOLLPRI
+        _ERROR   = select.EPOLLERR | select.EPOLLHUP
+
+    def _create_poller(self):
+        return select.epoll()
+
+    def _poller_wait(self, timeout):
+        return self._poller.poll(-1 if timeout is None else timeout)
+
+    def close(self):
+        self._poller.close()
+
+
+def default_reactor():
+    'Return a new instance of the best reactor available on this platform'
+    if hasattr(select, 'epoll'):
+        return EpollReactor()
+    elif hasattr(select, 'poll') and sys.platform != 'darwin':
+        return PollReactor()
+    else:
+        return SelectReactor()
+
+
+
+################################################################################
+#
+# _TimeoutHeap class
+#
+################################################################################
+
+
+
+class _TimeoutHeap(object):
+
+    """
+
+    Priority queue of YieldConditions ordered by expiration time.
+    Cancelled timeouts are not searched for in the heap: their entry
+    is only marked dead and skipped when it reaches the top, which
+    makes cancel() O(1) and push()/pop() O(log n).  When more than half
+    of the entries are dead the heap is compacted.
+
+    """
+
+    _COMPACT_MIN = 64
+
+    def __init__(self):
+        self._heap = []             # [expiration, sequence, item or None]
+        self._entries = {}          # item => its live entry
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def push(self, item):
+        self.cancel(item)
+        entry = [item.expiration, next(self._sequence), item]
+        self._entries[item] = entry
+        heapq.heappush(self._heap, entry)
+
+    def cancel(self, item):
+        entry = self._entries.pop(item, None)
+        if entry is not None:
+            entry[2] = None
+            dead = len(self._heap) - len(self._entries)
+            if dead > self._COMPACT_MIN and dead > len(self._entries):
+                self._heap = [e for e in self._heap if e[2] is not None]
+                heapq.heapify(self._heap)
+
+    def _discard_dead(self):
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+
+    def first_expiration(self):
+        'Return the earliest expiration time (the heap must not be empty)'
+        self._discard_dead()
+        return self._heap[0][0]
+
+    def pop_expired(self, current_time):
+        'Remove and return the next item expiring by current_time, or None'
+        self._discard_dead()
+        heap = self._heap
+        if heap and heap[0][0] <= current_time:
+            item = heapq.heappop(heap)[2]
+            del self._entries[item]
+            return item
+        return None
+
+    def merge(self, other):
+        for entry in other._heap:
+            if entry[2] is not None:
+                self.push(entry[2])
+
+
+
+################################################################################
+#
+# Task naming
+#
+################################################################################
+
+
+
+def _task_name(gen):
+    # A generator method is named after the class defining it, which
+    # is found through the 'self' argument of its frame.
+    code = gen.gi_code
+    frame = gen.gi_frame
+    if frame is not None and code.co_varnames[:1] == ('self',):
+        cls = getattr(frame.f_locals.get('self'), '__class__', None)
+        for base in (inspect.getmro(cls) if cls is not None else ()):
+            func = base.__dict__.get(code.co_name)
+            if getattr(func, 'func_code', None) is code:
+                return '%s.%s' % (base.__name__, code.co_name)
+    return code.co_name
+
+
+
+################################################################################
+#
+# Profiler class
+#
+################################################################################
+
+
+
+class Profiler(object):
+
+    """
+
+    Measures, for every resumption of a task by a TaskManager, the wall
+    clock and CPU time spent in send() or throw(), and the scheduling
+    latency, i.e. the delay between the task becoming runnable and it
+    actually running.  The figures are rolled up by generator function
+    name, e.g. 'Protocol.parseMessages' for a generator method or
+    'printer' for a generator function.
+
+    The overhead is a few clock reads and dictionary updates per
+    resumption, which bench_profiler in benchmark.py measures.  It does
+    not show in the throughput of the RTMP fan-out, where the media are
+    mostly sent without resuming a task, so a profiler can be left
+    enabled in production:
+
+      >>> profiler = multitask.Profiler()
+      >>> multitask.get_default_task_manager().set_profiler(profiler)
+      >>> profiler.dump_on_signal(signal.SIGUSR1)
+
+    """
+
+    def __init__(self):
+        self._names = {}            # code object => rolled up name
+        self._enqueued = {}         # task => time it became runnable
+        self.reset()
+
+    def reset(self):
+        'Discard all the figures collected so far'
+        self._stats = {}            # name => [resumptions, wall, cpu, latency, max latency, max wall]
+        self.started = time.time()
+
+    def enqueued(self, task):
+        self._enqueued[task] = time.time()
+
+    def resume(self, task, input, exc_info):
+        'Resume task as TaskManager does, measuring it'
+        gen = (task.task if isinstance(task, _ChildTask) else task)
+        name = self._names.get(gen.gi_code)
+        if name is None:
+            name = self._names[gen.gi_code] = _task_name(gen)
+        start_cpu, start = time.clock(), time.time()
+        try:
+            if exc_info:
+                return task.throw(*exc_info)
+            else:
+                return task.send(input)
+        finally:
+            wall, cpu = time.time() - start, time.clock() - start_cpu
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = [0, 0.0, 0.0, 0.0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += wall
+            stats[2] += cpu
+            if wall > stats[5]:
+                stats[5] = wall
+            enqueued = self._enqueued.pop(task, None)
+            if enqueued is not None:
+                latency = start - enqueued
+                stats[3] += latency
+                if latency > stats[4]:
+                    stats[4] = latency
+
+    def stats(self):
+        """
+
+        Return a list of (name, resumptions, wall time, CPU time, mean
+        latency, max latency, max wall time) tuples, with times in
+        seconds, sorted by decreasing CPU time
+
+        """
+        result = [(name, s[0], s[1], s[2], s[3] / s[0], s[4], s[5])
+                  for name, s in self._stats.iteritems()]
+        result.sort(key=(lambda r: r[3]), reverse=True)
+        return result
+
+    def dump(self, file=None):
+        'Print the stats() as a table to file, which defaults to sys.stderr'
+        file = (file or sys.stderr)
+        print >>file, 'multitask profile of %.1f s' % (time.time() - self.started)
+        print >>file, '%-40s %10s %10s %10s %10s %10s %10s' % ('task', 'resumed', 'wall ms', 'cpu ms', 'max ms', 'lat ms', 'max lat ms')
+        for name, count, wall, cpu, latency, max_latency, max_wall in self.stats():
+            print >>file, '%-40s %10d %10.1f %10.1f %10.2f %10.2f %10.2f' % (name, count, wall * 1e3, cpu * 1e3, max_wall * 1e3, latency * 1e3, max_latency * 1e3)
+        file.flush()
+
+    def dump_on_signal(self, signum, file=None):
+        'Call dump() whenever the process receives signal signum'
+        import signal
+        signal.signal(signum, (lambda signum, frame: self.dump(file)))
+
+
+
+################################################################################
+#
+# Watchdog class
+#
+################################################################################
+
+
+
+class Watchdog(object):
+
+    """
+
+    Detects task steps, i.e. single resumptions of a task, that block
+    the TaskManager for longer than threshold seconds, and keeps
+    histograms of the step durations and of the loop lag, i.e. the time
+    the TaskManager runs tasks without checking for I/O.  Both are the
+    delays that every other connection suffers.
+
+    A background thread looks at the task that is running every
+    threshold / 2 seconds, and if it is still running after threshold
+    seconds, records where it is, so that a stall is attributed to the
+    line that is slow rather than to the point where the task yields
+    afterwards.  When the step finishes, report() is called with the
+    name of the generator, its duration and that stack:
+
+      >>> watchdog = multitask.Watchdog(threshold=0.1)
+      >>> multitask.get_default_task_manager().set_watchdog(watchdog)
+      >>> watchdog.dump_on_signal(signal.SIGUSR2)
+
+    The thread takes no lock.  It only reads the current step, a
+    (task, start time) tuple that the TaskManager replaces as a whole,
+    and writes the stack it captures as a (step, stack) tuple, which
+    is used only for the step it names.  The histograms steps and lags
+    and the stalls are changed by the thread running the TaskManager
+    only, hence read them from that thread, as dump() does from a
+    signal handler.
+
+    """
+
+    # Upper bounds of the histogram buckets, in seconds
+    BUCKETS = tuple(2 ** i / 1000.0 for i in xrange(11)) # 1 ms to 1024 ms
+
+    def __init__(self, threshold=0.1, file=None, history=100):
+        """
+
+        Report steps longer than threshold seconds to file, which
+        defaults to sys.stderr, and keep the last history of them in
+        the stalls attribute.
+
+        """
+
+        self.threshold = float(threshold)
+        self.file = file
+        self.stalls = collections.deque(maxlen=history)
+        self._step = None           # (task, start time) of the current step, replaced as a whole
+        self._captured = None       # (step, stack) captured by the thread during that step
+        self._thread_id = None      # the thread running the TaskManager
+        self._thread = None
+        self.reset()
+
+    def reset(self):
+        'Clear the histograms'
+        self.steps = [0] * (len(self.BUCKETS) + 1)
+        self.lags = [0] * (len(self.BUCKETS) + 1)
+        self.started = time.time()
+
+    def _bucket(self, duration):
+        i = 0
+        for bound in self.BUCKETS:
+            if duration < bound:
+                break
+            i += 1
+        return i
+
+    def start(self):
+        """
+
+        Start the watching thread for the calling thread, which must be
+        the one running the TaskManager.  This is done by the first
+        step.
+
+        """
+        self._thread_id = threading.current_thread().ident
+        self._thread = threading.Thread(target=self._watch,
+                                        name='multitask.Watchdog')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        'Stop the watching thread, which the next step starts again'
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def step(self, task):
+        # Called by the TaskManager when it resumes task, or with None
+        # when it stops running tasks.  The step that was running, if
+        # any, ends now.
+        now = time.time()
+        current = self._step
+        if current is not None:
+            duration = now - current[1]
+            if duration < self.BUCKETS[0]:
+                self.steps[0] += 1
+            else:
+                self._end_step(current, duration)
+        self._step = ((task, now) if task is not None else None)
+
+    def end_loop(self, duration):
+        # Called by the TaskManager when it has run all the runnable
+        # tasks, for duration seconds
+        self.step(None)
+        self.lags[self._bucket(duration)] += 1
+
+    def _end_step(self, current, duration):
+        self.steps[self._bucket(duration)] += 1
+        if duration >= self.threshold:
+            task = current[0]
+            gen = (task.task if isinstance(task, _ChildTask) else task)
+            captured = self._captured
+            stack = (captured[1] if captured is not None and captured[0] is current else None)
+            if stack is None and gen.gi_frame is not None:
+                # Not seen by the thread: the best guess is where the
+                # task stopped
+                stack = traceback.extract_stack(gen.gi_frame, limit=1)
+            stall = (time.time(), _task_name(gen), duration, stack)
+            self.stalls.append(stall)
+            self.report(*stall[1:])
+
+    def _watch(self):
+        thread = threading.current_thread()
+        while self._thread is thread:
+            time.sleep(self.threshold / 2)
+            current, captured = self._step, self._captured
+            if current is None or (captured is not None and captured[0] is current) or \
+                   time.time() - current[1] < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None and self._step is current:
+                # The frames are those of the step, which was running
+                # before and after they were taken.  Keep them from the
+                # task's generator inwards.
+                task = current[0]
+                gen = (task.task if isinstance(task, _ChildTask) else task)
+                depth, f = 0, frame
+                while f is not None and f is not gen.gi_frame:
+                    depth, f = depth + 1, f.f_back
+                self._captured = (current, traceback.extract_stack(frame, limit=(depth + 1 if f is not None else None)))
+
+    def report(self, name, duration, stack):
+        """
+
+        Called when the step of the generator named name took duration
+        seconds.  stack is a list of (filename, line number, function
+        name, text) tuples, innermost last.  Override this to report
+        stalls differently.
+
+        """
+
+        file = (self.file or sys.stderr)
+        print >>file, 'multitask stall: %s blocked for %.1f ms' % (name, duration * 1e3)
+        for filename, lineno, function, text in (stack or ())[-5:]:
+            print >>file, '  %s:%d in %s: %s' % (filename, lineno, function, text)
+        file.flush()
+
+    def histograms(self):
+        """
+
+        Return a list of (upper bound in seconds or None, number of
+        steps, number of loop iterations) tuples, one per bucket
+
+        """
+        bounds = list(self.BUCKETS) + [None]
+        return zip(bounds, self.steps, self.lags)
+
+    def dump(self, file=None):
+        'Print the histograms as a table to file, which defaults to sys.stderr'
+        file = (file or self.file or sys.stderr)
+        print >>file, 'multitask watchdog for %.1f s, %d stalls' % (time.time() - self.started, len(self.stalls))
+        print >>file, '%10s %12s %12s' % ('below ms', 'steps', 'loop lag')
+        for bound, steps, lags in self.histograms():
+            print >>file, '%10s %12d %12d' % (('%g' % (bound * 1e3)) if bound is not None else 'inf', steps, lags)
+        file.flush()
+
+    def dump_on_signal(self, signum, file=None):
+        'Call dump() whenever the process receives signal signum'
+        import signal
+        signal.signal(signum, (lambda signum, frame: self.dump(file)))
+
+
+
 ################################################################################
 #
 # TaskManager class
@@ -819,9 +1885,15 @@ class TaskManager(object):
     Engine for running a set of cooperatively-multitasking tasks
     within a single Python thread
 
+    While it runs tasks of normal or low priority, and some task has a
+    high priority, the TaskManager checks for I/O readiness without
+    blocking every io_check_interval seconds (0 disables this).
+
     """
 
-    def __init__(self):
+    io_check_interval = 0.01
+
+    def __init__(self, reactor=None):
         """
 
         Create a new TaskManager instance.  Generally, there will only
@@ -829,14 +1901,21 @@ class TaskManager(object):
         existing instances simultaneously, merge them first, then run
         one or the other.
 
+        reactor is the object used to wait for I/O readiness (see
+        SelectReactor).  If it is None, the best reactor available on
+        this platform is used: epoll on Linux, then poll, then select.
+
         """
 
-        self._queue       = collections.deque()
-        self._read_waits  = set()
-        self._write_waits = set()
-        self._exc_waits   = set()
+        self._queues      = tuple(collections.deque() for p in PRIORITIES)
+        # task => priority, unless PRIORITY_NORMAL.  Weak, so that a
+        # task dropped before it finishes is not kept alive
+        self._priorities  = weakref.WeakKeyDictionary()
+        self._reactor     = (reactor if reactor is not None else default_reactor())
         self._queue_waits = collections.defaultdict(self._double_deque)
-        self._timeouts    = []
+        self._timeouts    = _TimeoutHeap()
+        self._profiler    = None
+        self._watchdog    = None
 
     @staticmethod
     def _double_deque():
@@ -855,33 +1934,129 @@ class TaskManager(object):
             raise TypeError("'other' must be a TaskManager instance")
 
         # Merge the data structures
-        self._queue.extend(other._queue)
-        self._read_waits  |= other._read_waits
-        self._write_waits |= other._write_waits
-        self._exc_waits   |= other._exc_waits
+        for queue, other_queue in zip(self._queues, other._queues):
+            queue.extend(other_queue)
+        self._priorities.update(other._priorities)
+        if other._reactor is not self._reactor:
+            for fd in other._reactor.attached():
+                self._reactor.attach(fd)
+            for fdready in other._reactor.waiters():
+                self._reactor.register(fdready)
+            other._reactor.close()
         self._queue_waits.update(other._queue_waits)
-        self._timeouts.extend(other._timeouts)
-        heapq.heapify(self._timeouts)
+        self._timeouts.merge(other._timeouts)
 
         # Make other reference the merged data structures.  This is
         # necessary because other's tasks may reference and use other
         # (e.g. to add a new task in response to an event).
-        other._queue       = self._queue
-        other._read_waits  = self._read_waits
-        other._write_waits = self._write_waits
-        other._exc_waits   = self._exc_waits
+        other._queues      = self._queues
+        other._priorities  = self._priorities
+        other._reactor     = self._reactor
         other._queue_waits = self._queue_waits
         other._timeouts    = self._timeouts
+        other._profiler    = self._profiler
+        other._watchdog    = self._watchdog
+
+    def add(self, task, priority=PRIORITY_NORMAL):
+        """
 
-    def add(self, task):
-        'Add a new task (i.e. a generator instance) to the run queue'
+        Add a new task (i.e. a generator instance) to the run queue.
+        The task and its child tasks run with the given priority (see
+        set_priority()).
+
+        """
 
         if not isinstance(task, types.GeneratorType):
             raise TypeError("'task' must be a generator")
+        self.set_priority(task, priority)
         self._enqueue(task)
 
+    def set_priority(self, task, priority):
+        """
+
+        Change the priority of a task previously passed to add(),
+        which must be one of PRIORITY_HIGH, PRIORITY_NORMAL or
+        PRIORITY_LOW.  It takes effect the next time the task becomes
+        runnable.
+
+        """
+
+        if priority not in PRIORITIES:
+            raise ValueError('invalid priority: %r' % (priority,))
+        if priority == PRIORITY_NORMAL:
+            self._priorities.pop(task, None)
+        else:
+            self._priorities[task] = priority
+
+    def get_priority(self, task):
+        'Return the priority of a task previously passed to add()'
+        return self._priorities.get(task, PRIORITY_NORMAL)
+
+    def attach(self, fd):
+        """
+
+        Keep the file descriptor fd registered with the reactor
+        between I/O waits, until detach() is called.  This is used by
+        PersistentFD.
+
+        """
+        self._reactor.attach(fd)
+
+    def detach(self, fd):
+        """
+
+        Undo attach().  Must be called before fd is closed.  The tasks
+        still waiting on fd are resumed with the EBADF error that their
+        operation would raise on the closed descriptor.
+
+        """
+
+        for fdready in self._reactor.detach(fd):
+            try:
+                raise IOError(errno.EBADF, os.strerror(errno.EBADF))
+            except IOError:
+                self._enqueue(fdready.task, exc_info=sys.exc_info())
+            if fdready._expires():
+                self._remove_timeout(fdready)
+
+    def set_profiler(self, profiler):
+        """
+
+        Measure every task resumption with profiler (see Profiler).  If
+        profiler is None, profiling stops.
+
+        """
+        self._profiler = profiler
+
+    def get_profiler(self):
+        'Return the current Profiler, or None'
+        return self._profiler
+
+    def set_watchdog(self, watchdog):
+        """
+
+        Watch every task resumption and the loop lag with watchdog (see
+        Watchdog).  If watchdog is None, watching stops.  The thread of
+        the previous Watchdog, if any, is stopped.
+
+        """
+        if self._watchdog is not None and self._watchdog is not watchdog:
+            self._watchdog.stop()
+        self._watchdog = watchdog
+
+    def get_watchdog(self):
+        'Return the current Watchdog, or None'
+        return self._watchdog
+
+    def _task_priority(self, task):
+        if not self._priorities:
+            return PRIORITY_NORMAL
+        return self._priorities.get((task.root if isinstance(task, _ChildTask) else task), PRIORITY_NORMAL)
+
     def _enqueue(self, task, input=None, exc_info=()):
-        self._queue.append((task, input, exc_info))
+        self._queues[self._task_priority(task)].append((task, input, exc_info))
+        if self._profiler is not None:
+            self._profiler.enqueued(task)
 
     def run(self):
         """
@@ -903,7 +2078,8 @@ class TaskManager(object):
         otherwise
 
         """
-        return bool(self._queue)
+        high, normal, low = self._queues
+        return bool(high or normal or low)
 
     def has_io_waits(self):
         """
@@ -912,7 +2088,7 @@ class TaskManager(object):
         otherwise
 
         """
-        return bool(self._read_waits or self._write_waits or self._exc_waits)
+        return self._reactor.has_waits()
 
     def has_timeouts(self):
         """
@@ -940,7 +2116,7 @@ class TaskManager(object):
 
         If there are runnable tasks in the queue when run_next() is
         called, then it will check for I/O readiness using a
-        non-blocking call to select() (i.e. a poll), and only
+        non-blocking call to the reactor (i.e. a poll), and only
         already-expired timeouts will be handled.  This ensures both
         that the task manager is never idle when tasks can be run and
         that tasks waiting for I/O never starve.
@@ -953,12 +2129,37 @@ class TaskManager(object):
         if self.has_timeouts():
             self._handle_timeouts(self._fix_run_timeout(timeout))
 
-        # Run all tasks currently in the queue
-        #for dummy in xrange(len(self._queue)):
-        while len(self._queue) > 0:
-            task, input, exc_info = self._queue.popleft()
+        self._run_queue()
+
+    def _run_queue(self):
+        # Run all tasks currently in the queues, highest priority first
+        high, normal, low = self._queues
+        interval = (self.io_check_interval if self._priorities else 0)
+        started = next_check = time.time()
+        next_check += interval
+        watchdog = self._watchdog
+        if watchdog is not None and watchdog._thread is None:
+            watchdog.start()
+        while high or normal or low:
+            if high:
+                queue = high
+            else:
+                if interval and (time.time() >= next_check):
+                    # Let tasks of high priority that are ready for
+                    # I/O overtake a long backlog of other tasks
+                    next_check = time.time() + interval
+                    if self.has_io_waits():
+                        self._handle_io_waits(0.0, PRIORITY_HIGH)
+                        if high:
+                            continue
+                queue = (normal or low)
+            task, input, exc_info = queue.popleft()
+            if watchdog is not None:
+                watchdog.step(task)
             try:
-                if exc_info:
+                if self._profiler is not None:
+                    output = self._profiler.resume(task, input, exc_info)
+                elif exc_info:
                     output = task.throw(*exc_info)
                 else:
                     output = task.send(input)
@@ -971,39 +2172,44 @@ class TaskManager(object):
                     else:
                         output = e.args
                     self._enqueue(task.parent, input=output)
+                elif self._priorities:
+                    self._priorities.pop(task, None)
             except:
                 if isinstance(task, _ChildTask):
                     # Propagate exception to parent
                     self._enqueue(task.parent, exc_info=sys.exc_info())
                 else:
                     # No parent task, so just die
+                    self._priorities.pop(task, None)
                     raise
             else:
                 self._handle_task_output(task, output)
 
+        if watchdog is not None:
+            watchdog.end_loop(time.time() - started)
+
     def _fix_run_timeout(self, timeout):
         if self.has_runnable():
             # Don't block if there are tasks in the queue
             timeout = 0.0
         elif self.has_timeouts():
             # If there are timeouts, block only until the first expiration
-            expiration_timeout = max(0.0, self._timeouts[0][0] - time.time())
+            expiration_timeout = max(0.0, self._timeouts.first_expiration() - time.time())
             if (timeout is None) or (timeout > expiration_timeout):
                 timeout = expiration_timeout
         return timeout
 
-    def _handle_io_waits(self, timeout):
+    def _handle_io_waits(self, timeout, priority=None):
+        # If priority is given, only the tasks of that priority are
+        # resumed.  The other ready waits stay registered, so the
+        # reactor reports them again on the next poll.
         # The error handling here is (mostly) borrowed from Twisted
         try:
-            read_ready, write_ready, exc_ready = \
-                select.select(self._read_waits,
-                              self._write_waits,
-                              self._exc_waits,
-                              timeout)
+            ready = self._reactor.poll(timeout)
         except (TypeError, ValueError):
             self._remove_bad_file_descriptors()
             return False
-        except (select.error, IOError), err:
+        except (select.error, EnvironmentError), err:
             if err[0] == errno.EINTR:
                 return False
             elif ((err[0] == errno.EBADF) or
@@ -1015,40 +2221,38 @@ class TaskManager(object):
                 # Not an error we can handle, so die
                 raise
         else:
-            for fd in set(read_ready + write_ready + exc_ready):
-                try:
-                    input = (fd._eval() if isinstance(fd, FDAction) else None)
-                    self._enqueue(fd.task, input=input)
-                except:
-                    self._enqueue(fd.task, exc_info=sys.exc_info())
-                fd._remove_from_fdsets(self._read_waits,
-                                       self._write_waits,
-                                       self._exc_waits)
-                if fd._expires():
-                    self._remove_timeout(fd)
+            if priority is not None:
+                ready = [fd for fd in ready if self._task_priority(fd.task) == priority]
+            self._handle_ready(ready)
             return True
 
-    def _remove_bad_file_descriptors(self):
-        for fd in (self._read_waits | self._write_waits | self._exc_waits):
+    def _handle_ready(self, ready):
+        for fd in ready:
             try:
-                select.select([fd], [fd], [fd], 0.0)
+                input = (fd._eval() if isinstance(fd, FDAction) else None)
+                self._enqueue(fd.task, input=input)
             except:
-                # TODO: do not enqueue the exception (socket.error) so that it does not crash
-                # when closing an already closed socket. See rtmplite issue #28
-                # self._enqueue(fd.task, exc_info=sys.exc_info())
-                fd._remove_from_fdsets(self._read_waits,
-                                       self._write_waits,
-                                       self._exc_waits)
-                if fd._expires():
-                    self._remove_timeout(fd)
+                self._enqueue(fd.task, exc_info=sys.exc_info())
+            self._reactor.unregister(fd)
+            if fd._expires():
+                self._remove_timeout(fd)
+
+    def _remove_bad_file_descriptors(self):
+        for fd in self._reactor.remove_bad_file_descriptors():
+            if isinstance(fd, _PersistentAction):
+                fd._reset()    # the PersistentFD can wait again
+            # TODO: do not enqueue the exception (socket.error) so that it does not crash
+            # when closing an already closed socket. See rtmplite issue #28
+            # self._enqueue(fd.task, exc_info=sys.exc_info())
+            if fd._expires():
+                self._remove_timeout(fd)
 
     def _add_timeout(self, item, handler):
         item.handle_expiration = handler
-        heapq.heappush(self._timeouts, (item.expiration, item))
+        self._timeouts.push(item)
 
     def _remove_timeout(self, item):
-        self._timeouts.remove((item.expiration, item))
-        heapq.heapify(self._timeouts)
+        self._timeouts.cancel(item)
 
     def _handle_timeouts(self, timeout):
         if (not self.has_runnable()) and (timeout > 0.0):
@@ -1056,8 +2260,10 @@ class TaskManager(object):
 
         current_time = time.time()
 
-        while self._timeouts and (self._timeouts[0][0] <= current_time):
-            item = heapq.heappop(self._timeouts)[1]
+        while True:
+            item = self._timeouts.pop_expired(current_time)
+            if item is None:
+                break
             if isinstance(item, _SleepDelay):
                 self._enqueue(item.task)
             else:
@@ -1083,51 +2289,56 @@ class TaskManager(object):
             self._enqueue(task, input=output)
 
     def _handle_fdready(self, task, output):
-        output._add_to_fdsets(self._read_waits,
-                              self._write_waits,
-                              self._exc_waits)
+        self._reactor.register(output)
         if output._expires():
             self._add_timeout(output,
-                              (lambda:
-                               output._remove_from_fdsets(self._read_waits,
-                                                          self._write_waits,
-                                                          self._exc_waits)))
+                              (lambda: self._reactor.unregister(output)))
 
     def _handle_queue_action(self, task, output):
-        get_waits, put_waits = self._queue_waits[output.queue]
+        queue = output.queue
+        get_waits, put_waits = self._queue_waits[queue]
 
-        if output.item is output.NO_ITEM:
+        if output._is_get():
             # Action is a get
-            if output.queue.empty():
+            if queue.empty():
                 get_waits.append(output)
+                queue._manager = self
                 if output._expires():
                     self._add_timeout(output,
                                       (lambda: get_waits.remove(output)))
             else:
-                item = output.queue._get()
-                self._enqueue(task, input=item)
+                self._enqueue(task, input=output._take())
                 if put_waits:
-                    action = put_waits.popleft()
-                    output.queue._put(action.item)
-                    self._enqueue(action.task)
-                    if action._expires():
-                        self._remove_timeout(action)
+                    self._wake_putters(queue, put_waits)
         else:
-            # Action is a put
-            if output.queue.full():
+            # Action is a put, which goes after those already waiting
+            if (not put_waits) and output._give():
+                self._enqueue(task)
+            else:
                 put_waits.append(output)
+                queue._manager = self
                 if output._expires():
                     self._add_timeout(output,
                                       (lambda: put_waits.remove(output)))
-            else:
-                output.queue._put(output.item)
-                self._enqueue(task)
-                if get_waits:
-                    action = get_waits.popleft()
-                    item = output.queue._get()
-                    self._enqueue(action.task, input=item)
-                    if action._expires():
-                        self._remove_timeout(action)
+            if get_waits:
+                self._wake_getters(queue, get_waits)
+
+    def _wake_getters(self, queue, get_waits):
+        while get_waits and not queue.empty():
+            action = get_waits.popleft()
+            self._enqueue(action.task, input=action._take())
+            if action._expires():
+                self._remove_timeout(action)
+
+    def _wake_putters(self, queue, put_waits):
+        while put_waits and not queue.full():
+            action = put_waits[0]
+            if not action._give():
+                break
+            put_waits.popleft()
+            self._enqueue(action.task)
+            if action._expires():
+                self._remove_timeout(action)
 
 
     def _handle_smart_queue_action(self, task, output):
@@ -1135,12 +2346,16 @@ class TaskManager(object):
 
         if output.item is output.NO_ITEM:
             # Action is a get
-            item = output.queue._get(criteria=output.criteria)
+            item = output.queue._get(criteria=output.criteria, key=output.key)
             if item is None:
-                get_waits.append(output)
-                if output._expires():
-                    self._add_timeout(output,
-                                      (lambda: get_waits.remove(output)))
+                if output.key is not SmartQueue.NO_KEY:
+                    # Getters of a key of a keyed queue wait apart
+                    self._wait_keyed(output)
+                else:
+                    get_waits.append(output)
+                    if output._expires():
+                        self._add_timeout(output,
+                                          (lambda: get_waits.remove(output)))
             else:
                 self._enqueue(task, input=item)
                 if put_waits:
@@ -1149,6 +2364,8 @@ class TaskManager(object):
                     self._enqueue(action.task)
                     if action._expires():
                         self._remove_timeout(action)
+                    if output.queue.key is not None:
+                        self._wake_keyed(output.queue, action.item, get_waits)
         else:
             # Action is a put
             if output.queue.full():
@@ -1159,7 +2376,9 @@ class TaskManager(object):
             else:
                 output.queue._put(output.item)
                 self._enqueue(task)
-                if get_waits:
+                if output.queue.key is not None:
+                    self._wake_keyed(output.queue, output.item, get_waits)
+                elif get_waits:
                     actions = []
                     for action in get_waits:
                         item = output.queue._get(criteria=action.criteria)
@@ -1171,6 +2390,34 @@ class TaskManager(object):
                         if action._expires():
                             self._remove_timeout(action)
 
+    def _wait_keyed(self, action):
+        key = (action.queue, action.key)
+        waits = self._queue_waits[key][0]
+        waits.append(action)
+        if action._expires():
+            def expire():
+                waits.remove(action)
+                if not waits:
+                    del self._queue_waits[key]
+            self._add_timeout(action, expire)
+
+    def _wake_keyed(self, queue, item, get_waits):
+        # Wake the first task waiting for the key of the new item, or
+        # else the first one waiting for any key
+        key = (queue, queue.key(item))
+        waits = self._queue_waits.get(key)
+        if waits is not None:
+            action = waits[0].popleft()
+            if not waits[0]:
+                del self._queue_waits[key]
+        elif get_waits:
+            action = get_waits.popleft()
+        else:
+            return
+        self._enqueue(action.task, input=queue._get(key=action.key))
+        if action._expires():
+            self._remove_timeout(action)
+
 
 
 ################################################################################
@@ -1192,9 +2439,28 @@ def get_default_task_manager():
     return _default_task_manager
 
 
-def add(task):
+def set_default_task_manager(task_manager):
+    """
+
+    Replace the default TaskManager instance, e.g. with one that runs
+    tasks on another event loop.  This must be done before any task is
+    added to the default instance.
+
+    """
+    global _default_task_manager
+    if not isinstance(task_manager, TaskManager):
+        raise TypeError("'task_manager' must be a TaskManager instance")
+    _default_task_manager = task_manager
+
+
+def add(task, priority=PRIORITY_NORMAL):
     'Add a task to the default TaskManager instance'
-    get_default_task_manager().add(task)
+    get_default_task_manager().add(task, priority)
+
+
+def set_priority(task, priority):
+    'Change the priority of a task of the default TaskManager instance'
+    get_default_task_manager().set_priority(task, priority)
 
 
 def run():
@@ -9,8 +9,9 @@ This is a simple implementation of a Flash RTMP server to accept connections and
 1. The FlashServer class is the main class to provide the server abstraction. It uses the multitask module for co-operative multitasking.
    It also uses the App abstract class to implement the applications.
 2. The Server class implements a simple server to receive new Client connections and inform the FlashServer application. The Client class
-   derived from Protocol implements the RTMP client functions. The Protocol class implements the base RTMP protocol parsing. A Client contains
-   various streams from the client, represented using the Stream class.
+   derived from Protocol implements the RTMP client functions. The Protocol class implements the base RTMP protocol parsing, using the
+   Codec class which encodes and decodes the chunks without doing any I/O. A Client contains various streams from the client, represented
+   using the Stream class. The media of a published stream go from the parser to its players through a Fanout.
 3. The Message, Header and Command represent RTMP message, header and command respectively. The FLV class implements functions to perform read
    and write of FLV file format.
 
@@ -64,7 +65,7 @@ throw an exception and display the error message.
 
 '''
 
-import os, sys, cgi, time, struct, socket, traceback, multitask, amf, hashlib, hmac, random
+import os, sys, cgi, time, errno, struct, socket, weakref, traceback, multitask, amf, hashlib, hmac, random
 
 from handler import TsHandler
 
@@ -73,43 +74,126 @@ _debug = False
 class ConnectionClosed:
     'raised when the client closed the connection'
 
+class ProtocolError(ConnectionClosed):
+    'raised when the peer sent data that is not valid RTMP, after which the connection is closed'
+
 def truncate(data, max=100):
     return data and len(data)>max and data[:max] + '...(%d)'%(len(data),) or data
     
 class SockStream(object):
-    '''A class that represents a socket as a stream'''
+    '''A class that represents a socket as a stream. Received data is written in place by recv_into() to the bytearray
+    buffer, of which buffer[offset:length] is not read yet, so that a read copies only the bytes it consumes instead of
+    the rest of the buffer.
+    Every recv_into() asks for recvSize bytes, whatever the count being read, so that the data the kernel has buffered is
+    pulled in one call. recvSize doubles when a recv_into() fills it and halves when it gets a quarter of it or less,
+    between MIN_RECV_SIZE and MAX_RECV_SIZE, and the buffer shrinks back when an idle connection has read everything.
+    recvCalls and sendCalls count the recv_into() and send() calls.
+    The socket is made non-blocking, so that a send() larger than the free space of the socket buffer returns a partial
+    count instead of blocking every task until the peer has read enough.'''
+    RECV_SIZE, MIN_RECV_SIZE, MAX_RECV_SIZE = 4096, 1024, 262144 # bytes per recv_into(): initial, lower and upper bound
     def __init__(self, sock):
-        self.sock, self.buffer = sock, ''
-        self.bytesWritten = self.bytesRead = 0
+        self.sock, self.offset, self.length, self.recvSize = sock, 0, 0, SockStream.RECV_SIZE
+        sock.setblocking(0)
+        self._setbuffer(bytearray(self.recvSize))
+        self.fd = multitask.PersistentFD(sock) # stays registered with the reactor until closed
+        self.bytesWritten = self.bytesRead = self.recvCalls = self.sendCalls = 0
     
     def close(self):
+        self.fd.close()
         self.sock.close()
         
     def read(self, count):
+        '''Generator that returns the next count bytes as a str.'''
+        if self.length - self.offset < count: # don't have enough data in buffer
+            yield self.fill(count)
+        raise StopIteration(self.take(count))
+        
+    def take(self, count):
+        '''Return the next count bytes, which must be in the buffer already, as a str.'''
+        offset = self.offset
+        self.offset = end = offset + count
+        return self.view[offset:end].tobytes()
+        
+    def fill(self, count):
+        '''Generator that receives from the socket until there are at least count bytes not read yet in the buffer, so
+        that they can be parsed synchronously from buffer[offset:length].'''
         try:
-            while True:
-                if len(self.buffer) >= count: # do have enough data in buffer
-                    data, self.buffer = self.buffer[:count], self.buffer[count:]
-                    raise StopIteration(data)
-                if _debug: print 'socket.read[%d] calling recv()'%(count,)
-                data = (yield multitask.recv(self.sock, 4096)) # read more from socket
-                if not data: raise ConnectionClosed
-                if _debug: print 'socket.read[%d] %r'%(len(data), truncate(data))
-                self.bytesRead += len(data)
-                self.buffer += data
-        except StopIteration: raise
-        except: raise ConnectionClosed # anything else is treated as connection closed.
+            while self.length - self.offset < count:
+                self._reserve(count)
+                if _debug: print 'socket.read[%d] calling recv_into()'%(count,)
+                wanted = self.recvSize
+                try: size = (yield self.fd.recv_into(self.view[self.length:self.length+wanted])) # read more from socket
+                except socket.error, e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): continue # readable, but nothing to read after all
+                    raise
+                self.recvCalls += 1
+                if not size: raise ConnectionClosed
+                if _debug: print 'socket.read[%d] %r'%(size, truncate(self.view[self.length:self.length+size].tobytes()))
+                self.bytesRead += size
+                self.length += size
+                if size == wanted: self.recvSize = min(wanted * 2, SockStream.MAX_RECV_SIZE) # the kernel may have more
+                elif size <= wanted / 4: self.recvSize = max(wanted / 2, SockStream.MIN_RECV_SIZE)
+        except EnvironmentError: raise ConnectionClosed # a socket error, or EBADF once the socket is closed
+        
+    def _setbuffer(self, buffer):
+        self.buffer, self.view = buffer, memoryview(buffer)
+        
+    def _reserve(self, count):
+        '''Make room for count unread bytes plus recvSize more, moving the unread bytes to the front of the buffer, or to
+        a new buffer if it is too small or, once recvSize went down, much too large. The buffer is replaced rather than
+        resized, which its memoryviews do not allow.'''
+        size = count + self.recvSize
+        if self.offset == self.length: # everything was read, start over at the front
+            self.offset = self.length = 0
+            if size <= len(self.buffer) < 4 * size: return
+            self._setbuffer(bytearray(size))
+        elif self.length + self.recvSize > len(self.buffer):
+            pending = self.length - self.offset
+            data = self.buffer[self.offset:self.length]
+            if len(self.buffer) < size: self._setbuffer(bytearray(size))
+            self.buffer[:pending] = data
+            self.offset, self.length = 0, pending
         
     def unread(self, data):
-        self.buffer = data + self.buffer
+        if len(data) <= self.offset: # put it back in front of the unread bytes
+            self.offset -= len(data)
+            self.buffer[self.offset:self.offset+len(data)] = data
+        else:
+            self._setbuffer(bytearray(data) + self.buffer[self.offset:self.length] + bytearray(self.recvSize))
+            self.offset, self.length = 0, len(data) + self.length - self.offset
             
     def write(self, data):
-        while len(data) > 0: # write in 4K chunks each time
-            chunk, data = data[:4096], data[4096:]
-            self.bytesWritten += len(chunk)
-            if _debug: print 'socket.write[%d] %r'%(len(chunk), truncate(chunk))
-            try: yield multitask.send(self.sock, chunk)
-            except: raise ConnectionClosed
+        '''Generator that sends data, a str, continuing from a view of the unsent part after a partial send.'''
+        return self._send(memoryview(data))
+        
+    def writev(self, parts):
+        '''Generator that sends a list of parts, each a str, buffer or bytearray, gathered once in a bytearray, which is
+        cheaper than a send() per part. Python 2 has no sendmsg() to send the parts as they are.'''
+        data = bytearray()
+        for part in parts: data += part
+        return self._send(memoryview(data))
+        
+    def trysend(self, data):
+        '''Send as much of data as the socket takes without blocking and return the number of bytes sent, which is 0 if
+        the send buffer is full, on error, or where the platform has no MSG_DONTWAIT.'''
+        try: size = self.sock.send(data, socket.MSG_DONTWAIT)
+        except (socket.error, AttributeError): return 0 # EAGAIN, or an error that the write task will get too
+        self.sendCalls += 1
+        self.bytesWritten += size
+        return size
+        
+    def _send(self, view):
+        try:
+            while len(view) > 0:
+                if _debug: print 'socket.write[%d] %r'%(len(view), truncate(view.tobytes()))
+                try: size = (yield self.fd.send(view))
+                except socket.error, e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): continue
+                    raise
+                self.sendCalls += 1
+                self.bytesWritten += size
+                view = view[size:]
+        except EnvironmentError: raise ConnectionClosed
                                 
 
 '''
@@ -190,6 +274,12 @@ class Header(object):
     # Chunk type 2 = TIME
     # Chunk type 3 = SEPARATOR
     FULL, MESSAGE, TIME, SEPARATOR, MASK = 0x00, 0x40, 0x80, 0xC0, 0xC0
+    __slots__ = ('channel', 'time', 'size', 'type', 'streamId', 'delta')
+    FREE_LIST_SIZE = 0 # most released headers kept for reuse by alloc(), see release(); 0 disables the free list
+    _freeList = []
+    
+    _basicHeaders = dict() # channel => basic header bytes of the chunk types FULL, MESSAGE, TIME and SEPARATOR
+    _TIME, _MESSAGE, _STREAM_ID, _EXTENDED_TIME = struct.Struct('>BH'), struct.Struct('>BHBHB'), struct.Struct('<I'), struct.Struct('>I')
     
     def __init__(self, channel=0, time=0, size=None, type=None, streamId=0):
         
@@ -198,37 +288,80 @@ class Header(object):
         self.size = size         # message length
         self.type = type         # message type id
         self.streamId = streamId # message stream id
-        
-        if (channel < 64): self.hdrdata = struct.pack('>B', channel)
-        elif (channel < 320): self.hdrdata = '\x00' + struct.pack('>B', channel-64)
-        else: self.hdrdata = '\x01' + struct.pack('>H', channel-64)
     
-    def toBytes(self, control):
-        data = chr(ord(self.hdrdata[0]) | control)
-        if len(self.hdrdata) >= 2: data += self.hdrdata[1:] 
+    @property
+    def hdrdata(self):
+        return Header.basicHeaders(self.channel)[0]
+    
+    @staticmethod
+    def basicHeaders(channel):
+        '''Return the basic header bytes of channel for each chunk type, indexed by the type >> 6. The SEPARATOR one is
+        the whole header of the continuation chunks.'''
+        try: return Header._basicHeaders[channel]
+        except KeyError:
+            if (channel < 64): hdrdata = struct.pack('>B', channel)
+            elif (channel < 320): hdrdata = '\x00' + struct.pack('>B', channel-64)
+            else: hdrdata = '\x01' + struct.pack('>H', channel-64)
+            result = Header._basicHeaders[channel] = tuple(chr(ord(hdrdata[0]) | control) + hdrdata[1:] for control in (Header.FULL, Header.MESSAGE, Header.TIME, Header.SEPARATOR))
+            return result
+    
+    @staticmethod
+    def encode(channel, control, time, size, type, streamId):
+        '''Return the bytes of a chunk header of type control with the given fields, of which the type does not have
+        some, without creating a Header.'''
+        data = Header.basicHeaders(channel)[control >> 6]
         
         # if the chunk type is not 3
         if control != Header.SEPARATOR:
-            data += struct.pack('>I', self.time if self.time < 0xFFFFFF else 0xFFFFFF)[1:] # add time in 3 bytes
-            # if the chunk type is not 2
-            if control != Header.TIME:
-                data += struct.pack('>I', self.size)[1:] # add size in 3 bytes
-                data += struct.pack('>B', self.type) # add type in 1 byte
-                # if the chunk type is not 1
-                if control != Header.MESSAGE:
-                    data += struct.pack('<I', self.streamId) # add streamId in little-endian 4 bytes
+            tm = time if time < 0xFFFFFF else 0xFFFFFF # time in 3 bytes
+            # if the chunk type is 2
+            if control == Header.TIME:
+                data += Header._TIME.pack(tm >> 16, tm & 0xFFFF)
+            else: # add size in 3 bytes and type in 1 byte too
+                data += Header._MESSAGE.pack(tm >> 16, tm & 0xFFFF, size >> 16, size & 0xFFFF, type)
+                # if the chunk type is 0
+                if control == Header.FULL:
+                    data += Header._STREAM_ID.pack(streamId) # add streamId in little-endian 4 bytes
             # add the extended time part to the header if timestamp[delta] >= 16777215
-            if self.time >= 0xFFFFFF:
-                data += struct.pack('>I', self.time)
+            if time >= 0xFFFFFF:
+                data += Header._EXTENDED_TIME.pack(time)
         return data
+    
+    def toBytes(self, control):
+        return Header.encode(self.channel, control, self.time, self.size, self.type, self.streamId)
 
     def __repr__(self):
         return ("<Header channel=%r time=%r size=%r type=%s (%r) streamId=%r>"
             % (self.channel, self.time, self.size, Message.type_name.get(self.type, 'unknown'), self.type, self.streamId))
     
     def dup(self):
-        return Header(channel=self.channel, time=self.time, size=self.size, type=self.type, streamId=self.streamId)
-
+        return Header.alloc(self.channel, self.time, self.size, self.type, self.streamId)
+    
+    @staticmethod
+    def alloc(channel=0, time=0, size=None, type=None, streamId=0):
+        '''Return a Header with the given fields, which is a released one if the free list has any.'''
+        if Header._freeList:
+            header = Header._freeList.pop()
+            header.channel, header.time, header.size, header.type, header.streamId = channel, time, size, type, streamId
+            return header
+        return Header(channel, time, size, type, streamId)
+    
+    @staticmethod
+    def release(header):
+        '''Keep the header for reuse by alloc() if the free list is not full. Only the headers that the server owns are
+        released: those of the copies that Fanout sends to the players, once chunked. Hence with the free list enabled,
+        an App.onPlayData that returns True must not keep the message it got, but a dup() of it.'''
+        if len(Header._freeList) < Header.FREE_LIST_SIZE: Header._freeList.append(header)
+
+
+class ChunkStream(object):
+    '''The state of an incoming chunk stream: the fields of its last chunk header, and the message being reassembled as
+    packet, the list of its chunk payloads so far, which have received bytes in total.'''
+    __slots__ = ('channel', 'time', 'size', 'type', 'streamId', 'extendedTime', 'currentTime', 'hdrtype', 'packet', 'received')
+    def __init__(self, channel):
+        self.channel, self.time, self.size, self.type, self.streamId = channel, 0, None, None, 0
+        self.extendedTime, self.currentTime, self.hdrtype = None, 0, None
+        self.packet, self.received = None, 0
 
 class Message(object):
     # message types: RPC3, DATA3,and SHAREDOBJECT3 are used with AMF3
@@ -236,14 +369,16 @@ class Message(object):
     0x01,         0x02,    0x03,  0x04,         0x05,         0x06,        0x08,  0x09,  0x0F,  0x10,       0x11, 0x12, 0x13,      0x14, 0x16
     type_name = dict(enumerate('unknown chunk-size abort ack user-control win-ack-size set-peer-bw unknown audio video unknown unknown unknown unknown unknown data3 sharedobj3 rpc3 data sharedobj rpc unknown aggregate'.split()))
     
+    __slots__ = ('header', 'data')
+    
     def __init__(self, hdr=None, data=''):
         self.header, self.data = hdr or Header(), data
     
-    # define properties type, streamId and time to access self.header.(property)
-    for p in ['type', 'streamId', 'time']:
-        exec 'def _g%s(self): return self.header.%s'%(p, p)
-        exec 'def _s%s(self, %s): self.header.%s = %s'%(p, p, p, p)
-        exec '%s = property(fget=_g%s, fset=_s%s)'%(p, p, p)
+    # properties type, streamId and time to access self.header.(property)
+    type = property(lambda self: self.header.type, lambda self, value: setattr(self.header, 'type', value))
+    streamId = property(lambda self: self.header.streamId, lambda self, value: setattr(self.header, 'streamId', value))
+    time = property(lambda self: self.header.time, lambda self, value: setattr(self.header, 'time', value))
+    
     @property
     def size(self): return len(self.data)
             
@@ -253,19 +388,276 @@ class Message(object):
     def dup(self):
         return Message(self.header.dup(), self.data[:])
                 
+def aggregateMessages(header, data):
+    '''Iterate over the sub-messages in the data of an aggregate message of the given header, see
+    http://code.google.com/p/red5/source/browse/java/server/trunk/src/org/red5/server/net/rtmp/event/Aggregate.java / getParts()
+    Each is an FLV tag: type=1 byte, size=3 bytes, time=3 bytes and its upper 8 bits=1 byte, streamId=3 bytes,
+    data=size bytes, backPointer=4 bytes, value == size + 11. The sub-messages take the channel and streamId of the
+    aggregate message, and the times of the tags shifted by the offset from the first one to the aggregate message.
+    The fields are unpacked at their offset in data, hence only the data of a sub-message is copied, once.'''
+    offset, end, delta = 0, len(data), None
+    while offset < end:
+        subsize = struct.unpack_from('!I', data, offset)[0] & 0xFFFFFF
+        if offset + 11 + subsize + 4 > end:
+            if _debug: print 'Warning aggregate submsg size=%r truncated at %r of %r bytes' % (subsize, offset, end)
+            break
+        subtime = struct.unpack_from('!I', data, offset + 4)[0]
+        subtime = (subtime >> 8) | (subtime & 0xFF) << 24
+        if delta is None: delta = header.time - subtime
+        subheader = Header.alloc(header.channel, (subtime + delta) & 0xFFFFFFFF, subsize, ord(data[offset]), header.streamId)
+        offset += 11 # skip header
+        yield Message(subheader, data[offset:offset+subsize])
+        offset += subsize # skip message data
+        backpointer = struct.unpack_from('!I', data, offset)[0]
+        if backpointer != subsize + 11:
+            if _debug: print 'Warning aggregate submsg backpointer=%r != %r' % (backpointer, subsize + 11)
+        offset += 4 # skip back pointer, go to next message
+
+class Codec(object):
+    '''The RTMP chunk layer without I/O: bytes in, messages out, and messages in, bytes out. It keeps the state of the
+    chunk streams in both directions and applies the protocol control messages that change it, i.e., set chunk size,
+    window acknowledgement size and acknowledgement. The handshake and everything above the messages is left to the
+    caller, e.g., Protocol which decodes from the SockStream buffer and sends what encode() or chunks() produce.
+    
+    Bytes are either fed and decoded from the codec's own buffer,
+    >>> codec = Codec(); codec.feed(data); messages = codec.receive()
+    or decoded in place from a bytearray by decode(), which returns the offset up to which the bytes were consumed.
+    
+    A set chunk size message is applied when it is chunked too, so that the messages chunked before it keep the previous
+    size. With maxWriteChunkSize larger than writeChunkSize, the codec raises the chunk size by itself, inserting a set
+    chunk size message before a media message that does not fit in one chunk.'''
+    HEADER_SIZES = {Header.FULL: 11, Header.MESSAGE: 7, Header.TIME: 3, Header.SEPARATOR: 0} # chunk message header bytes by type
+    
+    def __init__(self):
+        self.lastReadHeaders, self.lastWriteHeaders = dict(), dict() # channel => ChunkStream, (streamId, kind) => Header
+        self.readChunkSize = self.writeChunkSize = Protocol.DEFAULT_CHUNK_SIZE
+        self.readWinSize0, self.readWinSize, self.writeWinSize0, self.writeWinSize = 0L, Protocol.READ_WIN_SIZE, 0L, Protocol.WRITE_WIN_SIZE
+        self.nextChannelId = Protocol.PROTOCOL_CHANNEL_ID + 1
+        self.buffer, self.offset = bytearray(), 0 # bytes fed and not decoded yet are buffer[offset:]
+        self.bytesRead, self.need = 0, 1 # bytes received in total, and from the offset to decode the next chunk
+        self.maxWriteChunkSize = None # the largest chunk size to raise writeChunkSize to, None keeps it
+        self.chunksRead = self.chunksWritten = 0
+        
+    def feed(self, data):
+        '''Append data, a str or bytearray received from the peer, to the bytes to decode.'''
+        if self.offset: del self.buffer[:self.offset]; self.offset = 0
+        self.buffer += data
+        self.bytesRead += len(data)
+        
+    def receive(self):
+        '''Decode the complete chunks fed so far and return the list of messages completed by them.'''
+        messages = []
+        self.offset = self.decode(self.buffer, self.offset, len(self.buffer), messages)
+        return messages
+    
+    def decode(self, buf, offset, length, messages):
+        '''Decode the complete chunks in buf[offset:length] of the bytearray buf, append the messages they complete to the
+        list messages, and return the offset after the last chunk decoded. Then need is the number of bytes from that
+        offset to decode the next chunk. The sub-messages of an aggregate message are appended instead of it. Raises
+        ProtocolError on a chunk that cannot be decoded, i.e., of type 2 or 3 on a chunk stream without a header yet.'''
+        CHANNEL_MASK, FULL, MESSAGE, TIME, SEPARATOR = 0x3F, Header.FULL, Header.MESSAGE, Header.TIME, Header.SEPARATOR
+        view, need = memoryview(buf), 1
+        while length - offset >= 1:
+            available = length - offset
+            hdrsize = buf[offset]  # header size byte
+            channel, hdrtype = hdrsize & CHANNEL_MASK, hdrsize & Header.MASK
+            start = 1 if channel > 1 else 2 if channel == 0 else 3 # the chunk message header starts after the basic header
+            size = start + Codec.HEADER_SIZES[hdrtype]
+            if available < size: need = size; break # not even the fixed part of the header is buffered
+            if channel == 0: # we need one more byte
+                channel = 64 + buf[offset+1]
+            elif channel == 1: # we need two more bytes
+                channel = 64 + buf[offset+1] + 256 * buf[offset+2]
+            
+            header = self.lastReadHeaders.get(channel)
+            if header is None and hdrtype >= TIME: # only the time or nothing changed on a chunk stream that has no header yet
+                if _debug: print 'Codec.decode chunk type %r on the new chunk stream %r' % (hdrtype >> 6, channel)
+                raise ProtocolError
+            pos = offset + start
+            tm = (buf[pos] << 16 | buf[pos+1] << 8 | buf[pos+2]) if hdrtype < SEPARATOR else header.time
+            if tm == 0xFFFFFF: # if we have extended timestamp, it follows
+                size += 4
+                if available < size: need = size; break
+            
+            # the chunk is decoded only when its payload is buffered too
+            msgsize = (buf[pos+3] << 16 | buf[pos+4] << 8 | buf[pos+5]) if hdrtype < TIME else header.size
+            received = header.received if header is not None and (hdrtype >= TIME or header.received < msgsize) else 0
+            count = min(msgsize - received, self.readChunkSize) # how much more
+            if available < size + count: need = size + count; break
+            
+            if header is None:
+                header = self.lastReadHeaders[channel] = ChunkStream(channel)
+            
+            if hdrtype < SEPARATOR: # time or delta has changed
+                header.time = tm
+                
+            if hdrtype < TIME: # size and type also changed
+                header.size, header.type = msgsize, buf[pos+6]
+                if received != header.received: # a new message abandons the incomplete one
+                    if _debug: print 'dropped incomplete message of %r bytes'%(header.received,)
+                    header.packet, header.received = None, 0
+
+            if hdrtype < MESSAGE: # streamId also changed
+                header.streamId = struct.unpack_from('<I', buf, pos + 7)[0]
+
+            if tm == 0xFFFFFF: # if we have extended timestamp, read it
+                header.extendedTime = struct.unpack_from('!I', buf, offset + size - 4)[0]
+                if _debug: print 'extended time stamp', '%x'%(header.extendedTime,)
+            else:
+                header.extendedTime = None
+                
+            if hdrtype == FULL:
+                header.currentTime = header.extendedTime or header.time
+                header.hdrtype = hdrtype
+            elif hdrtype in (MESSAGE, TIME):
+                header.hdrtype = hdrtype
+
+            # if _debug: print 'R', header, header.currentTime, header.extendedTime, '0x%x'%(hdrsize,)
+            
+            offset += size # consume the header and the payload
+            if count == header.size: # the whole message is in this chunk
+                data = view[offset:offset+count].tobytes()
+            else: # keep the chunk payloads, which are joined once when the message is complete
+                if header.packet is None: header.packet = []
+                header.packet.append(view[offset:offset+count].tobytes())
+                header.received += count
+                data = None
+            offset += count
+            self.chunksRead += 1
+                    
+            if data is None and header.received < header.size: # we don't have all data
+                continue
+            
+            if hdrtype in (MESSAGE, TIME):
+                header.currentTime = header.currentTime + (header.extendedTime or header.time)
+            elif hdrtype == SEPARATOR:
+                if header.hdrtype in (MESSAGE, TIME):
+                    header.currentTime = header.currentTime + (header.extendedTime or header.time)
+            if data is None:
+                data, header.packet, header.received = ''.join(header.packet), None, 0
+                if _debug:
+                    print 'aggregated %r bytes message: readChunkSize(%r) x %r'%(len(data), self.readChunkSize, len(data) / self.readChunkSize)
+            
+            hdr = Header.alloc(header.channel, header.currentTime, header.size, header.type, header.streamId)
+            msg = Message(hdr, data)
+
+            if hdr.type == Message.AGGREGATE:
+                if _debug: print 'Codec.decode aggregated msg=', msg 
+                for submsg in aggregateMessages(hdr, data):
+                    self.control(submsg); messages.append(submsg)
+            else:
+                self.control(msg); messages.append(msg)
+        self.need = need
+        return offset
+    
+    def control(self, msg):
+        '''Apply a protocol control message received on the protocol channel to the state of the chunk streams, before
+        the next chunk is decoded.'''
+        if msg.header.channel != Protocol.PROTOCOL_CHANNEL_ID: return
+        try:
+            if msg.type == Message.ACK: # respond to ACK requests
+                self.writeWinSize0 = struct.unpack('>L', msg.data)[0]
+            elif msg.type == Message.CHUNK_SIZE:
+                self.readChunkSize = struct.unpack('>L', msg.data)[0]
+                if _debug: print "set read chunk size to %d" % self.readChunkSize
+            elif msg.type == Message.WIN_ACK_SIZE:
+                self.readWinSize, self.readWinSize0 = struct.unpack('>L', msg.data)[0], self.bytesRead
+        except:
+            if _debug: print 'Codec.control exception', (traceback and traceback.print_exc() or None)
+    
+    def acknowledgement(self):
+        '''Return the ACK message to send if more than the window acknowledgement size was received since the last one,
+        otherwise None. The caller sets its time.'''
+        if self.readWinSize is not None and self.bytesRead > (self.readWinSize0 + self.readWinSize):
+            self.readWinSize0 = self.bytesRead
+            ack = Message()
+            ack.type, ack.data = Message.ACK, struct.pack('>L', self.readWinSize0)
+            return ack
+
+    def encode(self, message):
+        '''Return the chunks of message as a str.'''
+        parts, data = [], bytearray()
+        self.chunks(message, parts)
+        for part in parts: data += part
+        return str(data)
+        
+
+    def chunks(self, message, parts):
+        '''Append the chunk headers and views of the payload of message to parts, and return the number of bytes added.'''
+        hdr, data = message.header, message.data
+        streamId, type, tm, length = hdr.streamId, hdr.type, hdr.time, len(data)
+        added = 0
+        if type < Message.AUDIO: # protocol control and user control messages have a full header on their channel
+            channel, control = Protocol.PROTOCOL_CHANNEL_ID, Header.FULL
+        else:
+            if self.maxWriteChunkSize and self.writeChunkSize < self.maxWriteChunkSize and length > self.writeChunkSize: # raise the chunk size first
+                chunkSize = self.writeChunkSize
+                while chunkSize < length: chunkSize *= 2
+                added = self.chunks(Message(Header(0, tm, 4, Message.CHUNK_SIZE, 0), struct.pack('>L', min(chunkSize, self.maxWriteChunkSize))), parts)
+            
+            # get the header stored for the audio, the video or the other messages of the stream, which have their own chunk
+            # streams so that the size and type of consecutive messages on a chunk stream change as rarely as possible
+            key = (streamId, type if type == Message.AUDIO or type == Message.VIDEO else 0)
+            header = self.lastWriteHeaders.get(key)
+            if header is None:
+                if self.nextChannelId <= Protocol.PROTOCOL_CHANNEL_ID: self.nextChannelId = Protocol.PROTOCOL_CHANNEL_ID+1
+                header, self.nextChannelId = Header(self.nextChannelId), self.nextChannelId + 1
+                self.lastWriteHeaders[key] = header
+            
+            # now figure out the header data bytes: the delta from the previous message unless the time goes back, and the
+            # previous header without a field if it has the same value; delta is None after an absolute time
+            channel, delta = header.channel, tm - header.time
+            if header.type is None or header.streamId != streamId or delta < 0:
+                header.streamId, header.type, header.size, header.time, header.delta = streamId, type, length, tm, None
+                control = Header.FULL
+            elif header.size != length or header.type != type:
+                header.type, header.size, header.time, header.delta, tm = type, length, tm, delta, delta
+                control = Header.MESSAGE
+            elif header.delta != delta or delta >= 0xFFFFFF:
+                header.time, header.delta, tm = tm, delta, delta
+                control = Header.TIME
+            else: # the same size, type and delta as the previous message, hence a type 3 header of a single byte
+                header.time, tm = tm, delta
+                control = Header.SEPARATOR
+
+        chunkSize = self.writeChunkSize
+        chunk = Header.encode(channel, control, tm, length, type, streamId)
+        parts.append(chunk); parts.append(buffer(data, 0, chunkSize))
+        size, offset = len(chunk) + min(chunkSize, length), chunkSize
+        if offset < length: # the continuation chunks have the constant type 3 header, and views of the payload, which is not copied
+            chunk = Header.basicHeaders(channel)[3]
+            if tm >= 0xFFFFFF: chunk += Header._EXTENDED_TIME.pack(tm) # repeated in every chunk
+            while offset < length:
+                parts.append(chunk); parts.append(buffer(data, offset, chunkSize))
+                offset += chunkSize
+            size += len(chunk) * ((length - 1) / chunkSize) + length - chunkSize
+        self.chunksWritten += (length - 1) / chunkSize + 1 if length else 1
+        if type == Message.CHUNK_SIZE: # the following messages are chunked at the size it announces
+            self.writeChunkSize = struct.unpack_from('>L', data)[0]
+        return added + size
+
+def _codecAttribute(name):
+    '''A property of Protocol for the attribute of its codec.'''
+    return property(lambda self: getattr(self.codec, name), lambda self, value: setattr(self.codec, name, value))
+
 class Protocol(object):
     PING_SIZE, DEFAULT_CHUNK_SIZE, HIGH_WRITE_CHUNK_SIZE, PROTOCOL_CHANNEL_ID = 1536, 128, 4096, 2 # constants
     READ_WIN_SIZE, WRITE_WIN_SIZE = 1000000L, 1073741824L
+    WRITE_BATCH_SIZE = 64 # maximum number of queued messages the write task takes per resumption
+    WRITE_BUFFER_SIZE = 65536 # bytes of chunks of several messages sent at once
+    WRITE_DELAY = 0.0 # seconds the chunks may wait for more messages before they are sent; 0 sends what is queued
+    __slots__ = ('stream', 'codec', '_time0', 'writeQueue', 'writing', '__dict__') # a subclass or application may set other attributes
     
     def __init__(self, sock):
-        self.stream = SockStream(sock)
-        self.lastReadHeaders, self.incompletePackets, self.lastWriteHeaders = dict(), dict(), dict()
-        self.readChunkSize = self.writeChunkSize = Protocol.DEFAULT_CHUNK_SIZE
-        self.readWinSize0, self.readWinSize, self.writeWinSize0, self.writeWinSize = 0L, self.READ_WIN_SIZE, 0L, self.WRITE_WIN_SIZE
-        self.nextChannelId = Protocol.PROTOCOL_CHANNEL_ID + 1
+        self.stream, self.codec = SockStream(sock), Codec()
         self._time0 = time.time()
         self.writeQueue = multitask.Queue()
+        self.writing = False # whether data is queued for, handed to or held by the write task, i.e., not sent yet
             
+    # the chunk stream state is kept by the codec
+    readChunkSize, writeChunkSize, maxWriteChunkSize, readWinSize0, readWinSize, writeWinSize0, writeWinSize, lastReadHeaders, lastWriteHeaders, nextChannelId, chunksRead, chunksWritten = \
+        map(_codecAttribute, ('readChunkSize', 'writeChunkSize', 'maxWriteChunkSize', 'readWinSize0', 'readWinSize', 'writeWinSize0', 'writeWinSize', 'lastReadHeaders', 'lastWriteHeaders', 'nextChannelId', 'chunksRead', 'chunksWritten'))
+    
     @property
     def relativeTime(self):
         return int(1000*(time.time() - self._time0))
@@ -273,18 +665,8 @@ class Protocol(object):
     def messageReceived(self, msg): # override in subclass
         yield
             
-    def protocolMessage(self, msg):
-        if msg.type == Message.ACK: # respond to ACK requests
-            self.writeWinSize0 = struct.unpack('>L', msg.data)[0]
-#            response = Message()
-#            response.type, response.data = msg.type, msg.data
-#            yield self.writeMessage(response)
-        elif msg.type == Message.CHUNK_SIZE:
-            self.readChunkSize = struct.unpack('>L', msg.data)[0]
-            if _debug: print "set read chunk size to %d" % self.readChunkSize
-        elif msg.type == Message.WIN_ACK_SIZE:
-            self.readWinSize, self.readWinSize0 = struct.unpack('>L', msg.data)[0], self.stream.bytesRead
-        elif msg.type == Message.USER_CONTROL:
+    def protocolMessage(self, msg): # ACK, CHUNK_SIZE and WIN_ACK_SIZE were applied by the codec
+        if msg.type == Message.USER_CONTROL:
             type, data = struct.unpack('>H', msg.data[:2])[0], msg.data[2:]
             if type == 3: # client expects a response when it sends set buffer length
                 streamId, bufferTime = struct.unpack('>II', data)
@@ -309,8 +691,40 @@ class Protocol(object):
             if _debug: traceback.print_exc()
             yield self.connectionClosed()
                     
+    def setChunkSize(self, size):
+        '''Generator to send a set chunk size message, after which the messages written are chunked at size.'''
+        message = Message()
+        message.time, message.type, message.data = self.relativeTime, Message.CHUNK_SIZE, struct.pack('>L', size)
+        yield self.writeMessage(message)
+    
+    def sendMessage(self, message, release=False):
+        '''Send a message without yielding, and return True, or return False if the write queue is full or tasks wait in
+        writeMessage() for room, then nothing is sent. When nothing is waiting to be sent, the message is sent right away
+        without blocking, and only what the socket did not take, if anything, is queued. Otherwise it is queued behind the
+        rest. The connection stays busy from the moment something is queued until the write task has sent everything, so
+        that no message overtakes one the write task already took from the queue, or the rest of a message sent in part.
+        With release, the header of the message is the caller's own, and is released once chunked, see Header.release;
+        a message that is queued keeps its header.'''
+        if self.writeQueue.full(): return False
+        if message is not None and not self.writing:
+            parts = []; self.codec.chunks(message, parts)
+            if release: Header.release(message.header)
+            data = bytearray()
+            for part in parts: data += part
+            size = self.stream.trysend(data)
+            if size == len(data): return True
+            message = memoryview(data)[size:] # the write task sends the rest before anything queued after it
+            self.writeQueue.put_nowait(message, force=True) # the chunk stream cannot wait for the tasks in writeMessage()
+        elif not self.writeQueue.put_nowait(message): # handed over directly if the write task is waiting
+            return False # behind the tasks waiting in writeMessage()
+        self.writing = True
+        return True
+    
     def writeMessage(self, message):
-        yield self.writeQueue.put(message)
+        '''Generator to send a message, see sendMessage(), which waits while the write queue is full.'''
+        if not self.sendMessage(message):
+            self.writing = True
+            yield self.writeQueue.put(message)
             
     def parseCrossDomainPolicyRequest(self):
         # read the request
@@ -385,121 +799,24 @@ class Protocol(object):
         return (''.join([chr(random.randint(0, 255)) for i in xrange(128)]), '')
         
     def parseMessages(self):
-        '''Parses complete messages until connection closed. Raises ConnectionLost exception.'''
-        CHANNEL_MASK = 0x3F
+        '''Parses complete messages until connection closed. Raises ConnectionLost exception.
+        The codec decodes the chunks in place from the stream buffer, and the parser yields to receive more only when the
+        buffer does not hold the next complete chunk.'''
+        stream, codec, messages = self.stream, self.codec, []
         while True:
-            hdrsize = ord((yield self.stream.read(1))[0])  # read header size byte
-            channel = hdrsize & CHANNEL_MASK
-            if channel == 0: # we need one more byte
-                channel = 64 + ord((yield self.stream.read(1))[0])
-            elif channel == 1: # we need two more bytes
-                data = (yield self.stream.read(2))
-                channel = 64 + ord(data[0]) + 256 * ord(data[1])
-
-            hdrtype = hdrsize & Header.MASK   # read header type byte
-            if hdrtype == Header.FULL or not self.lastReadHeaders.has_key(channel):
-                header = Header(channel)
-                self.lastReadHeaders[channel] = header
-            else:
-                header = self.lastReadHeaders[channel]
+            if stream.length - stream.offset < codec.need: yield stream.fill(codec.need)
+            codec.bytesRead = stream.bytesRead
+            stream.offset = codec.decode(stream.buffer, stream.offset, stream.length, messages)
             
-            if hdrtype < Header.SEPARATOR: # time or delta has changed
-                data = (yield self.stream.read(3))
-                header.time = struct.unpack('!I', '\x00' + data)[0]
-                
-            if hdrtype < Header.TIME: # size and type also changed
-                data = (yield self.stream.read(3))
-                header.size = struct.unpack('!I', '\x00' + data)[0]
-                header.type = ord((yield self.stream.read(1))[0])
-
-            if hdrtype < Header.MESSAGE: # streamId also changed
-                data = (yield self.stream.read(4))
-                header.streamId = struct.unpack('<I', data)[0]
-
-            if header.time == 0xFFFFFF: # if we have extended timestamp, read it
-                data = (yield self.stream.read(4))
-                header.extendedTime = struct.unpack('!I', data)[0]
-                if _debug: print 'extended time stamp', '%x'%(header.extendedTime,)
-            else:
-                header.extendedTime = None
-                
-            if hdrtype == Header.FULL:
-                header.currentTime = header.extendedTime or header.time
-                header.hdrtype = hdrtype
-            elif hdrtype in (Header.MESSAGE, Header.TIME):
-                header.hdrtype = hdrtype
-
-            #print header.type, '0x%02x'%(hdrtype,), header.time, header.currentTime
-            
-            # if _debug: print 'R', header, header.currentTime, header.extendedTime, '0x%x'%(hdrsize,)
-             
-            data = self.incompletePackets.get(channel, "") # are we continuing an incomplete packet?
-            
-            count = min(header.size - (len(data)), self.readChunkSize) # how much more
-            
-            data += (yield self.stream.read(count))
-
             # check if we need to send Ack
-            if self.readWinSize is not None:
-                if self.stream.bytesRead > (self.readWinSize0 + self.readWinSize):
-                    self.readWinSize0 = self.stream.bytesRead
-                    ack = Message()
-                    ack.time, ack.type, ack.data = self.relativeTime, Message.ACK, struct.pack('>L', self.readWinSize0)
-                    yield self.writeMessage(ack)
-                    
-            if len(data) < header.size: # we don't have all data
-                self.incompletePackets[channel] = data
-            else: # we have all data
-                if hdrtype in (Header.MESSAGE, Header.TIME):
-                    header.currentTime = header.currentTime + (header.extendedTime or header.time)
-                elif hdrtype == Header.SEPARATOR:
-                    if header.hdrtype in (Header.MESSAGE, Header.TIME):
-                        header.currentTime = header.currentTime + (header.extendedTime or header.time)
-                if len(data) == header.size:
-                    if channel in self.incompletePackets:
-                        del self.incompletePackets[channel]
-                        if _debug:
-                            print 'aggregated %r bytes message: readChunkSize(%r) x %r'%(len(data), self.readChunkSize, len(data) / self.readChunkSize)
-                else:
-                    data, self.incompletePackets[channel] = data[:header.size], data[header.size:]
-                
-                hdr = Header(channel=header.channel, time=header.currentTime, size=header.size, type=header.type, streamId=header.streamId)
-                msg = Message(hdr, data)
-
-                if hdr.type == Message.AGGREGATE:
-                    ''' see http://code.google.com/p/red5/source/browse/java/server/trunk/src/org/red5/server/net/rtmp/event/Aggregate.java / getParts()
-                    '''
-                    if _debug: print 'Protocol.parseMessages aggregated msg=', msg 
-                    aggdata = data;
-                    while len(aggdata) > 0:
-                        '''
-                        type=1 byte
-                        size=3 bytes
-                        time=4 bytes
-                        streamId= 4 bytes
-                        data= size bytes
-                        backPointer=4 bytes, value == size
-                        '''
-                        subtype = ord(aggdata[0])
-                        subsize = struct.unpack('!I', '\x00' + aggdata[1:4])[0]
-                        subtime = struct.unpack('!I', aggdata[4:8])[0]
-                        substreamid = struct.unpack('<I', aggdata[8:12])[0]     
-                        subheader = Header(channel, time=subtime, size=subsize, type=subtype, streamId=substreamid) # TODO: set correct channel
-                        aggdata = aggdata[11:] # skip header       
-                        submsgdata = aggdata[:subsize] # get message data 
-                        submsg = Message(subheader, submsgdata) 
-                        
-                        yield self.parseMessage(submsg)
-                                        
-                        aggdata = aggdata[subsize:] # skip message data
-                    
-                        backpointer = struct.unpack('!I', aggdata[0:4])[0]
-                        if backpointer != subsize:
-                            print 'Warning aggregate submsg backpointer=%r != %r' % (backpointer, subsize)                          
-                        aggdata = aggdata[4:] # skip back pointer, go to next message
-                else:
-                    yield self.parseMessage(msg)
-                
+            ack = codec.acknowledgement()
+            if ack is not None:
+                ack.time = self.relativeTime
+                yield self.writeMessage(ack)
+            
+            for msg in messages:
+                yield self.parseMessage(msg)
+            del messages[:]
 
     def parseMessage(self, msg):
         try:            
@@ -512,55 +829,44 @@ class Protocol(object):
             if _debug: print 'Protocol.parseMessage exception', (traceback and traceback.print_exc() or None)
 
     def write(self):
-        '''Writes messages to stream'''
+        '''Writes messages to stream. The chunks of the messages queued at the same time are sent together, in a send()
+        per WRITE_BUFFER_SIZE bytes instead of one per message. With a WRITE_DELAY, the chunks gathered are held until
+        that many seconds after the first of them, unless the budget is reached before, to wait for more messages.'''
+        parts, size, deadline = [], 0, None
         while True:
-#            while self.writeQueue.empty(): (yield multitask.sleep(0.01))
-#            message = self.writeQueue.get() # TODO this should be used using multitask.Queue and remove previous wait.
-            message = yield self.writeQueue.get() # TODO this should be used using multitask.Queue and remove previous wait.
-            if _debug: print 'Protocol.write msg=', message
-            if message is None: 
-                try: self.stream.close()  # just in case TCP socket is not closed, close it.
-                except: pass
-                break
-            
-            # get the header stored for the stream
-            if self.lastWriteHeaders.has_key(message.streamId):
-                header = self.lastWriteHeaders[message.streamId]
-            else:
-                if self.nextChannelId <= Protocol.PROTOCOL_CHANNEL_ID: self.nextChannelId = Protocol.PROTOCOL_CHANNEL_ID+1
-                header, self.nextChannelId = Header(self.nextChannelId), self.nextChannelId + 1
-                self.lastWriteHeaders[message.streamId] = header
-            if message.type < Message.AUDIO:
-                header = Header(Protocol.PROTOCOL_CHANNEL_ID)
-               
-            # now figure out the header data bytes
-            if header.streamId != message.streamId or header.time == 0 or message.time <= header.time:
-                header.streamId, header.type, header.size, header.time, header.delta = message.streamId, message.type, message.size, message.time, message.time
-                control = Header.FULL
-            elif header.size != message.size or header.type != message.type:
-                header.type, header.size, header.time, header.delta = message.type, message.size, message.time, message.time-header.time
-                control = Header.MESSAGE
-            else:
-                header.time, header.delta = message.time, message.time-header.time
-                control = Header.TIME
-            
-            hdr = Header(channel=header.channel, time=header.delta if control in (Header.MESSAGE, Header.TIME) else header.time, size=header.size, type=header.type, streamId=header.streamId)
-            assert message.size == len(message.data)
-
-            data = ''
-            while len(message.data) > 0:
-                data += hdr.toBytes(control) # gather header bytes
-                count = min(self.writeChunkSize, len(message.data))
-                data += message.data[:count]
-                message.data = message.data[count:]
-                control = Header.SEPARATOR # incomplete message continuation
             try:
-                yield self.stream.write(data)
-            except ConnectionClosed:
-                yield self.connectionClosed()
-            except:
-                print traceback.print_exc()
-
+                if deadline is None: messages = yield self.writeQueue.get_many(Protocol.WRITE_BATCH_SIZE) # a burst of messages in one resumption
+                else: messages = yield self.writeQueue.get_many(Protocol.WRITE_BATCH_SIZE, timeout=max(deadline - time.time(), 0))
+            except multitask.Timeout: messages = []
+            for message in messages:
+                if _debug: print 'Protocol.write msg=', message
+                if message is None: 
+                    if parts: yield self._flush(parts)
+                    try: self.stream.close()  # just in case TCP socket is not closed, close it.
+                    except: pass
+                    return
+                if isinstance(message, memoryview): # the rest of a message that writeMessage() sent in part
+                    parts.append(message); size += len(message)
+                else:
+                    size += self.codec.chunks(message, parts)
+                if size >= Protocol.WRITE_BUFFER_SIZE:
+                    yield self._flush(parts)
+                    parts, size, deadline = [], 0, None
+            if parts:
+                if deadline is None and messages: deadline = time.time() + Protocol.WRITE_DELAY
+                if not messages or time.time() >= deadline:
+                    yield self._flush(parts)
+                    parts, size, deadline = [], 0, None
+            if not parts and not self.writeQueue: self.writing = False # parks on an empty queue with nothing held
+                    
+    def _flush(self, parts):
+        try:
+            yield self.stream.writev(parts)
+        except ConnectionClosed:
+            yield self.connectionClosed()
+        except:
+            if _debug: traceback.print_exc()
+            
 class Command(object):
     ''' Class for command / data messages'''
     def __init__(self, type=Message.RPC, name=None, id=None, tm=0, cmdData=None, args=[]):
@@ -705,12 +1011,16 @@ class FLV(object):
                 self.fp = None
         
 class Stream(object):
-    '''The stream object that is used for RTMP stream.'''
+    '''The stream object that is used for RTMP stream. The attributes used by the server are slots, and an application
+    may set others.'''
+    __slots__ = ('client', 'id', 'name', 'recordfile', 'playfile', 'queue', '_name', 'mode', 'recorder', 'metaData', 'avcSeq', 'avcIntra', 'fanout', 'lagging', '__dict__')
     count = 0;
     def __init__(self, client):
         self.client, self.id, self.name = client, 0, ''
         self.recordfile = self.playfile = None # so that it doesn't complain about missing attribute
         self.queue = multitask.Queue()
+        self.fanout = None # set by the server when the stream is published, see Fanout
+        self.lagging = False # a player whose media are dropped until the next key frame, see Fanout
         self._name = 'Stream[' + str(Stream.count) + ']'; Stream.count += 1
         if _debug: print self, 'created'
         
@@ -740,19 +1050,83 @@ class Stream(object):
         # if _debug: print self,'send'
         if self.client is not None: yield self.client.writeMessage(msg)
         
+class Fanout(object):
+    '''The fan-out of a published stream to its players. The parser of the publisher's connection dispatches the media
+    received on the stream directly to it, instead of queueing every message for a new FlashServer.streamhandler task.
+    It caches the application instance, and looks up the players on every message since they come and go.
+    
+    The media that arrive before the stream is published, i.e., in the same read as the publish command, are queued for
+    the stream listener, which dispatches them here in order. It sets direct once it has nothing queued left, and only
+    then the parser dispatches the following media itself, so that none overtakes those queued before.
+    
+    A player that does not keep up, i.e., with QUEUE_SIZE messages in its write queue already, lags: its media are dropped,
+    except the metadata and sequence headers, until the next video key frame, or the next audio message when the stream
+    has no video. So a slow player costs a bounded queue and skips to a decodable frame, instead of delaying the others.'''
+    __slots__ = ('inst', 'stream', 'name', 'video', 'dropped', 'direct')
+    QUEUE_SIZE = 1024 # most messages in the write queue of a player before its media are dropped
+    def __init__(self, inst, stream):
+        self.inst, self.stream = inst, stream
+        self.name = stream.name if stream is not None else None # set by the caller for a stream published elsewhere
+        self.video, self.dropped = False, 0 # whether the stream has video, and the count of messages dropped for players
+        self.direct = False # whether the parser dispatches the media, see FlashServer.streamlistener
+        
+    def dispatch(self, message):
+        '''Handle a media message received on the stream like FlashServer.mediahandler, without yielding.'''
+        stream = self.stream
+        if stream.client is not None and self.inst.onPublishData(stream.client, stream, message):
+            self.play(message)
+            self.record(message)
+            
+    def record(self, message):
+        '''Write the media message to the recorder of the stream. An error is dropped like in FlashServer.streamhandler,
+        rather than closing the publisher's connection from its parser.'''
+        try: self.stream.recorder.write(message)
+        except:
+            if _debug: print 'Fanout.record exception', (sys and sys.exc_info() or None)
+            
+    def play(self, message):
+        '''Send a copy of the media message to every player of the stream like FlashServer.playershandler, without yielding.'''
+        inst, type, data = self.inst, message.type, message.data
+        if type == Message.VIDEO: self.video = True
+        header = type == Message.DATA or data[1:2] == '\x00' and (type == Message.AUDIO and data[:1] == '\xaf' or type == Message.VIDEO and data[:1] == '\x17')
+        if type == Message.VIDEO: resume = data[:1] != '' and ord(data[0]) >> 4 == 1 # key frame
+        else: resume = type == Message.AUDIO and not self.video
+        for s in (inst.players.get(self.name, [])):
+            client = s.client
+            if client is None: continue
+            if not header and (s.lagging and not resume or len(client.writeQueue) >= Fanout.QUEUE_SIZE):
+                s.lagging = True; self.dropped += 1
+                continue
+            m = message.dup()
+            if inst.onPlayData(client, s, m) and s.client is not None:
+                m.streamId = s.id
+                if not client.sendMessage(m, release=True): s.lagging = True; self.dropped += 1 # write queue is full
+                elif not header: s.lagging = False
+        
 class Client(Protocol):
-    '''The client object represents a single connected client to the server.'''
+    '''The client object represents a single connected client to the server. The attributes used by the server are
+    slots, and an application may set others.'''
+    __slots__ = ('server', 'agent', 'streams', '_nextCallId', '_nextStreamId', 'objectEncoding', 'queue', 'tasks', 'path')
     def __init__(self, sock, server):
         Protocol.__init__(self, sock)
         self.server, self.agent, self.streams, self._nextCallId, self._nextStreamId, self.objectEncoding = \
           server,      None,         {},           2,                1,                  0.0
         self.queue = multitask.Queue() # receive queue used by application
-        multitask.add(self.parse()); multitask.add(self.write())
+        tasks = (self.parse(), self.write()) # run with high priority until the connection carries media, see setPriority.
+        self.tasks = tuple(weakref.ref(task) for task in tasks) # the tasks refer to self, and a cycle with a suspended generator is never collected
+        for task in tasks: multitask.add(task, multitask.PRIORITY_HIGH)
 
     def recv(self):
         '''Generator to receive new Message (msg, arg) on this stream, or (None,None) if stream is closed.'''
         return self.queue.get()
     
+    def setPriority(self, priority):
+        '''Change the multitask priority of the tasks reading and writing this connection. A new connection has high priority
+        so that handshakes and connect replies are not delayed by media of other connections.'''
+        for ref in self.tasks:
+            task = ref()
+            if task is not None: multitask.set_priority(task, priority)
+
     def connectionClosed(self):
         '''Called when the client drops the connection'''
         if _debug: 'Client.connectionClosed'
@@ -791,7 +1165,11 @@ class Client(Protocol):
             # if _debug: print self.streams[msg.streamId], 'recv'
             stream = self.streams[msg.streamId]
             if not stream.client: stream.client = self 
-            yield stream.queue.put(msg) # give it to stream
+            fanout = stream.fanout
+            if fanout is not None and fanout.direct and msg.type != Message.RPC and msg.type != Message.RPC3:
+                fanout.dispatch(msg) # media of a published stream, see Fanout
+            elif not stream.queue.put_nowait(msg): # give it to stream
+                yield stream.queue.put(msg)
 
     @property
     def rpc(self):
@@ -846,28 +1224,61 @@ class Client(Protocol):
 
 class Server(object):
     '''A RTMP server listens for incoming connections and informs the app.'''
-    def __init__(self, sock):
+    ACCEPT_BATCH = 64 # most connections accepted per wakeup
+    TCPI_UNACKED = 24 # offset of tcpi_unacked, then tcpi_sacked, in the Linux struct tcp_info, after 8 bytes and 4 ints
+    def __init__(self, sock, rate=None):
         '''Create an RTMP server on the given bound TCP socket. The server will terminate
-        when the socket is disconnected, or some other error occurs in listening.'''
-        self.sock = sock
+        when the socket is disconnected, or some other error occurs in listening.
+        Every wakeup accepts all the pending connections up to ACCEPT_BATCH. With rate, at most that many connections
+        are accepted per second and the others wait in the listen backlog.'''
+        self.sock, self.rate = sock, rate
+        self.accepted = self.wakeups = self.maxBatch = 0 # accept loop metrics: connections, wakeups, largest batch
         self.queue = multitask.Queue()  # queue to receive incoming client connections
-        multitask.add(self.run())
+        multitask.add(self.run(), multitask.PRIORITY_HIGH)
 
     def recv(self):
         '''Generator to wait for incoming client connections on this server and return
         (client, args) or (None, None) if the socket is closed or some error.'''
         return self.queue.get()
         
+    def acceptQueue(self):
+        '''Return (pending, backlog): the connections waiting in the listen backlog and its size, as reported by the
+        kernel, or None where TCP_INFO is not available, or not the Linux one, or shorter than expected.'''
+        if not sys.platform.startswith('linux'): return None # other systems have a TCP_INFO of another layout
+        end = Server.TCPI_UNACKED + 8
+        try: info = self.sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, end)
+        except (AttributeError, socket.error): return None
+        if len(info) < end: return None
+        return struct.unpack_from('=II', info, Server.TCPI_UNACKED) # tcpi_unacked and tcpi_sacked of a listening socket
+        
     def run(self):
         try:
+            self.sock.setblocking(0)
+            allowance, last = float(self.rate or 0), time.time() # token bucket of the accept rate
             while True:
-                sock, remote = (yield multitask.accept(self.sock))  # receive client TCP
-                if sock == None:
-                    if _debug: print 'rtmp.Server accept(sock) returned None.' 
-                    break
-                if _debug: print 'connection received from', remote
-                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # make it non-block
-                client = Client(sock, self)
+                yield multitask.readable(self.sock)
+                batch = Server.ACCEPT_BATCH
+                if self.rate:
+                    now = time.time()
+                    allowance, last = min(float(self.rate), allowance + (now - last) * self.rate), now
+                    if allowance < 1:
+                        yield multitask.sleep((1 - allowance) / self.rate)
+                        continue
+                    batch = min(batch, int(allowance))
+                count = 0
+                while count < batch:
+                    try: sock, remote = self.sock.accept() # receive client TCP
+                    except socket.error, e:
+                        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): break # no more pending connections
+                        if e.args[0] in (errno.ECONNABORTED, errno.EINTR): continue
+                        raise
+                    count += 1
+                    if _debug: print 'connection received from', remote
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # make it non-block
+                    client = Client(sock, self)
+                if self.rate: allowance -= count
+                self.wakeups, self.accepted, self.maxBatch = self.wakeups + 1, self.accepted + count, max(self.maxBatch, count)
+                if _debug and count > 1: print 'rtmp.Server accepted', count, 'connections, accept queue', self.acceptQueue()
         except GeneratorExit: pass # terminate
         except: 
             if _debug: print 'rtmp.Server exception ', (sys and sys.exc_info() or None)
@@ -1001,18 +1412,24 @@ class FlashServer(object):
         self.apps = dict({'*': App}) # supported applications: * means any as in {'*': App}
         self.clients = dict()  # list of clients indexed by scope. First item in list is app instance.
         self.root = ''
-
-    def start(self, host='0.0.0.0', port=1935):
-        '''This should be used to start listening for RTMP connections on the given port, which defaults to 1935.'''
+        self.chunkSize = Protocol.HIGH_WRITE_CHUNK_SIZE # chunk size announced to a client after connect, None keeps the default 128
+        self.maxChunkSize = None # if larger, the chunk size is raised up to it when a message does not fit in one chunk
+
+    def start(self, host='0.0.0.0', port=1935, reuseport=False, backlog=1024, acceptRate=None):
+        '''This should be used to start listening for RTMP connections on the given port, which defaults to 1935.
+        With reuseport, several processes can listen on the same port and the kernel spreads the connections.
+        backlog is the size of the listen queue, which the kernel caps to net.core.somaxconn, and acceptRate, if given,
+        the most connections accepted per second.'''
         if not self.server:
             sock = self.sock = socket.socket(type=socket.SOCK_STREAM)
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuseport: sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             sock.bind((host, port))
             if _debug:
                 print 'listening on ', sock.getsockname()
-            sock.listen(5)
-            server = self.server = Server(sock) # start rtmp server on that socket
-            multitask.add(self.serverlistener())
+            sock.listen(backlog)
+            server = self.server = Server(sock, acceptRate) # start rtmp server on that socket
+            multitask.add(self.serverlistener(), multitask.PRIORITY_HIGH)
 
     def stop(self):
         if _debug:
@@ -1055,6 +1472,8 @@ class FlashServer(object):
                         win_ack = Message()
                         win_ack.time, win_ack.type, win_ack.data = client.relativeTime, Message.WIN_ACK_SIZE, struct.pack('>L', client.writeWinSize)
                         yield client.writeMessage(win_ack)
+                        if self.chunkSize and self.chunkSize != client.writeChunkSize: yield client.setChunkSize(self.chunkSize)
+                        client.maxWriteChunkSize = self.maxChunkSize
                         
 #                        set_peer_bw = Message()
 #                        set_peer_bw.time, set_peer_bw.type, set_peer_bw.data = client.relativeTime, Message.SET_PEER_BW, struct.pack('>LB', client.writeWinSize, 1)
@@ -1072,7 +1491,7 @@ class FlashServer(object):
                             self.clients[client.path].append(client)
                             if result is True:
                                 yield client.accept() # TODO: else how to kill this task when rejectConnection() later
-                            multitask.add(self.clientlistener(client)) # receive messages from client.
+                            multitask.add(self.clientlistener(client), multitask.PRIORITY_HIGH) # receive messages from client.
                         else: 
                             yield client.rejectConnection(reason='Rejected in onConnect')
         except GeneratorExit:
@@ -1093,10 +1512,10 @@ class FlashServer(object):
                         print 'connection closed from client'
                     break                     #    come out of listening loop.
                 if msg == 'command':          # handle a new command
-                    multitask.add(self.clienthandler(client, arg))
+                    multitask.add(self.clienthandler(client, arg), multitask.PRIORITY_HIGH)
                 elif msg == 'stream':         # a new stream is created, handle the stream.
                     arg.client = client
-                    multitask.add(self.streamlistener(arg))
+                    multitask.add(self.streamlistener(arg), multitask.PRIORITY_HIGH)
         except StopIteration:
             raise
         except:
@@ -1132,6 +1551,7 @@ class FlashServer(object):
             if stream.name in inst.publishers and inst.publishers[stream.name] == stream: # clear the published stream
                 inst.onClose(stream.client, stream)
                 del inst.publishers[stream.name]
+                stream.fanout = None
             if stream.name in inst.players and stream in inst.players[stream.name]:
                 inst.onStop(stream.client, stream)
                 inst.players[stream.name].remove(stream)
@@ -1174,7 +1594,13 @@ class FlashServer(object):
                     self.closehandler(stream)
                     break
                 # if _debug: msg
-                multitask.add(self.streamhandler(stream, msg))
+                if msg.type == Message.RPC or msg.type == Message.RPC3: # commands on the stream, such as publish, before the media that follow
+                    yield self.streamhandler(stream, msg)
+                elif stream.fanout is not None: # the media of a published stream in order, see Fanout
+                    stream.fanout.dispatch(msg)
+                else:
+                    multitask.add(self.streamhandler(stream, msg))
+                if stream.fanout is not None and not stream.queue: stream.fanout.direct = True # the parser dispatches the next media
         except: 
             if _debug: print 'streamlistener exception', (sys and sys.exc_info() or None)
 
@@ -1187,7 +1613,7 @@ class FlashServer(object):
                 if cmd.name == 'publish':
                     yield self.publishhandler(stream, cmd)
                 elif cmd.name == 'play':
-                    pass
+                    stream.client.setPriority(multitask.PRIORITY_NORMAL)
                 elif cmd.name == 'closeStream':
                     self.closehandler(stream)
                 elif cmd.name == 'seek':
@@ -1217,6 +1643,8 @@ class FlashServer(object):
             
             #stream.recordfile = inst.getfile(stream.client.path, stream.name, self.root, stream.mode)
             stream.recorder = FLV(TsHandler())
+            stream.client.setPriority(multitask.PRIORITY_NORMAL) # the connection now carries media
+            stream.fanout = self.fanout(inst, stream)
             response = Command(name='onStatus', id=cmd.id, tm=stream.client.relativeTime, args=[amf.Object(level='status', code='NetStream.Publish.Start', description='', details=None)])
             yield stream.send(response)
         except ValueError, E: # some error occurred. inform the app.
@@ -1224,20 +1652,32 @@ class FlashServer(object):
             response = Command(name='onStatus', id=cmd.id, tm=stream.client.relativeTime, args=[amf.Object(level='error',code='NetStream.Publish.BadName',description=str(E),details=None)])
             yield stream.send(response)
 
+    def fanout(self, inst, stream):
+        '''Return the Fanout to which the parser dispatches the media of the stream published in the application instance,
+        or None to handle every media message in a streamhandler task. A subclass that overrides mediahandler or
+        playershandler gets None, unless it overrides this too.'''
+        cls = type(self)
+        if cls.mediahandler.im_func is not FlashServer.mediahandler.im_func or cls.playershandler.im_func is not FlashServer.playershandler.im_func: return None
+        return Fanout(inst, stream)
+        
     def mediahandler(self, stream, message):
         '''Handle incoming media on the stream, by sending to other stream in this application instance.'''
         if stream.client is not None:
             inst = self.clients[stream.client.path][0]
             result = inst.onPublishData(stream.client, stream, message)
             if result:
-                for s in (inst.players.get(stream.name, [])):
-                    #if _debug: print 'D', stream.name, s.name
-                    m = message.dup()
-                    result = inst.onPlayData(s.client, s, m)
-                    if result:
-                        yield s.send(m)
+                yield self.playershandler(inst, stream.name, message)
                 stream.recorder.write(message)
 
+    def playershandler(self, inst, name, message):
+        '''Send a copy of the media message to every player of the stream name in the application instance.'''
+        for s in (inst.players.get(name, [])):
+            #if _debug: print 'D', name, s.name
+            m = message.dup()
+            result = inst.onPlayData(s.client, s, m)
+            if result:
+                yield s.send(m)
+
 # The main routine to start, run and stop the service
 if __name__ == '__main__':
     from optparse import OptionParser
@@ -1245,19 +1685,42 @@ if __name__ == '__main__':
     parser.add_option('-i', '--host',    dest='host',    default='0.0.0.0', help="listening IP address. Default '0.0.0.0'")
     parser.add_option('-p', '--port',    dest='port',    default=1935, type="int", help='listening port number. Default 1935')
     parser.add_option('-r', '--root',    dest='root',    default='./',       help="document path prefix. Directory must end with /. Default './'")
+    parser.add_option('-b', '--backlog', dest='backlog', default=1024, type="int", help='size of the listen queue, capped by net.core.somaxconn. Default 1024')
+    parser.add_option('-R', '--accept-rate', dest='acceptRate', default=0, type="int", help='most connections accepted per second. Default 0 (unlimited)')
+    parser.add_option('-c', '--chunk-size', dest='chunkSize', default=Protocol.HIGH_WRITE_CHUNK_SIZE, type="int", help='chunk size announced to clients after connect, 0 keeps 128. Default %d' % (Protocol.HIGH_WRITE_CHUNK_SIZE,))
+    parser.add_option('-m', '--max-chunk-size', dest='maxChunkSize', default=0, type="int", help='raise the chunk size up to this when a message does not fit in one chunk. Default 0 (fixed)')
     parser.add_option('-d', '--verbose', dest='verbose', default=False, action='store_true', help='enable debug trace')
+    parser.add_option('-a', '--asyncio', dest='asyncio', default=False, action='store_true', help='run the tasks on an asyncio event loop')
+    parser.add_option('-P', '--profile', dest='profile', default=False, action='store_true', help='profile the tasks, print the profile on SIGUSR1 and on exit')
+    parser.add_option('-s', '--stall',   dest='stall',   default=0, type="int", help='report task steps blocking the server longer than this many milliseconds, print the loop lag histogram on SIGUSR2 and on exit. Default 0 (disabled)')
     (options, args) = parser.parse_args()
 
     _debug = options.verbose
+    if options.asyncio:
+        import aiomultitask
+        aiomultitask.install()
+    if options.profile:
+        import signal
+        profiler = multitask.Profiler()
+        multitask.get_default_task_manager().set_profiler(profiler)
+        profiler.dump_on_signal(signal.SIGUSR1)
+    if options.stall:
+        import signal
+        watchdog = multitask.Watchdog(threshold=options.stall / 1000.0)
+        multitask.get_default_task_manager().set_watchdog(watchdog)
+        watchdog.dump_on_signal(signal.SIGUSR2)
     try:
         root_dir = os.path.abspath(options.root)
         if not root_dir.endswith('/'):
             root_dir = root_dir + '/'
         agent = FlashServer()
         agent.root = root_dir
-        agent.start(options.host, options.port)
+        agent.chunkSize, agent.maxChunkSize = options.chunkSize or None, options.maxChunkSize or None
+        agent.start(options.host, options.port, backlog=options.backlog, acceptRate=options.acceptRate or None)
         if _debug: print time.asctime(), 'Flash Server Starts - %s:%d' % (options.host, options.port)
         multitask.run()
     except KeyboardInterrupt:
         pass
+    if options.profile: profiler.dump()
+    if options.stall: watchdog.dump()
     if _debug: print time.asctime(), 'Flash Server Stops'
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the cluster module. Run with:
+$ python -m unittest discover
+'''
+
+import socket, unittest
+import cluster, multitask, rtmp
+
+def media(type, data):
+    return rtmp.Message(rtmp.Header(time=0, size=len(data), type=type), data)
+
+META, AAC, AVC = media(rtmp.Message.DATA, 'meta'), media(rtmp.Message.AUDIO, '\xaf\x00aac'), media(rtmp.Message.VIDEO, '\x17\x00avc')
+KEY, INTER, AUDIO = media(rtmp.Message.VIDEO, '\x17\x01key'), media(rtmp.Message.VIDEO, '\x27\x01inter'), media(rtmp.Message.AUDIO, '\xaf\x01audio')
+
+class RelayTest(unittest.TestCase):
+    def setUp(self):
+        self.socks = [socket.socketpair() for i in xrange(2)]
+        self.relay = cluster.Relay([a for a, b in self.socks])
+        self.key = cluster.Relay._key(u'live', u'stream')
+
+    def tearDown(self):
+        for peer in self.relay.peers: peer.close()
+        for a, b in self.socks: a.close(); b.close()
+
+    def post(self, *messages):
+        for message in messages: self.relay.post(u'live', u'stream', message)
+
+    def queued(self, index):
+        '''The payloads of the frames queued for the peer of index, which are taken out of its queue.'''
+        queue, frames = self.relay.queues[index], []
+        while len(queue): frames.append(queue._get())
+        return [frame[4 + cluster.Relay.MEDIA_HEADER.size + len(self.key):] for frame in frames]
+
+    def testSubscribers(self):
+        '''Nothing is forwarded without subscribers, and a new subscriber starts with the headers and a key frame.'''
+        self.post(META, AVC, AAC, KEY, INTER)
+        self.assertEqual(self.queued(0) + self.queued(1), [])
+        self.relay.subscribe(1, self.key, True)
+        self.post(INTER, AUDIO, KEY, INTER, AUDIO)
+        self.assertEqual(self.queued(1), ['meta', '\xaf\x00aac', '\x17\x00avc', '\x17\x01key', '\x27\x01inter', '\xaf\x01audio'])
+        self.assertEqual(self.queued(0), [])
+        self.relay.subscribe(1, self.key, False)
+        self.post(KEY, AUDIO)
+        self.assertEqual(self.queued(1), [])
+
+    def testAudioOnly(self):
+        '''Without video, a new subscriber starts with the next audio message.'''
+        self.post(AAC)
+        self.relay.subscribe(0, self.key, True)
+        self.post(AUDIO)
+        self.assertEqual(self.queued(0), ['\xaf\x00aac', '\xaf\x01audio'])
+
+    def testFullQueue(self):
+        '''When the queue of a peer is full, the stream is dropped for it until the next key frame, headers first.'''
+        self.post(AVC)
+        self.relay.subscribe(0, self.key, True)
+        self.post(KEY)
+        while not self.relay.queues[0].full(): self.post(INTER)
+        self.post(AUDIO, INTER)
+        self.assertEqual(self.relay.dropped, 2)
+        self.assertEqual(len(self.queued(0)), cluster.Relay.QUEUE_SIZE)
+        self.post(INTER, AUDIO)
+        self.assertEqual(self.queued(0), [])
+        self.post(KEY, AUDIO)
+        self.assertEqual(self.queued(0), ['\x17\x00avc', '\x17\x01key', '\xaf\x01audio'])
+
+class RelayhandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.default, self.manager = multitask.get_default_task_manager(), multitask.TaskManager()
+        multitask.set_default_task_manager(self.manager)
+        self.socks = [socket.socketpair() for i in xrange(2)]
+        self.inst = rtmp.App()
+        self.protocol = rtmp.Protocol(self.socks[1][0])
+        self.protocol.writing = True # no write task, so everything sent stays in the write queue
+        self.player = rtmp.Stream(self.protocol); self.player.id, self.player.name = 1, 'stream'
+        self.inst.players['stream'] = [self.player]
+
+    def tearDown(self):
+        self.protocol.stream.close()
+        for a, b in self.socks: a.close(); b.close()
+        multitask.set_default_task_manager(self.default)
+
+    def relay(self, server, *messages):
+        server.clients['live'] = [self.inst]
+        for message in messages: self.manager.add(server.relayhandler('live', 'stream', message))
+        self.manager.run()
+
+    def testSlowPlayer(self):
+        '''Relayed media go through a Fanout, which drops them for a player that does not keep up.'''
+        server = cluster.ClusterServer(cluster.Relay([self.socks[0][0]]))
+        self.relay(server, KEY)
+        while len(self.protocol.writeQueue) < rtmp.Fanout.QUEUE_SIZE: self.relay(server, INTER)
+        self.relay(server, INTER, AUDIO)
+        fanout = server.relayed[('live', 'stream')]
+        self.assertEqual((fanout.dropped, self.player.lagging, len(self.protocol.writeQueue)), (2, True, rtmp.Fanout.QUEUE_SIZE))
+
+    def testPlayershandler(self):
+        '''A server that overrides playershandler gets no Fanout, and handles the relayed media itself.'''
+        played = []
+        class Server(cluster.ClusterServer):
+            def playershandler(self, inst, name, message):
+                played.append(message); yield
+        server = Server(cluster.Relay([self.socks[0][0]]))
+        self.assertEqual(server.fanout(self.inst, None), None)
+        self.relay(server, KEY, INTER)
+        self.assertEqual(played, [KEY, INTER])
+        self.assertEqual(server.relayed, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the multitask module. Run with:
+$ python -m unittest discover
+'''
+
+import gc, time, errno, socket, select, weakref, unittest
+from StringIO import StringIO
+import multitask
+
+REACTORS = [multitask.SelectReactor] + [cls for cls, name in ((multitask.PollReactor, 'poll'), (multitask.EpollReactor, 'epoll')) if hasattr(select, name)]
+MANAGERS = [(cls.__name__, lambda cls=cls: multitask.TaskManager(cls())) for cls in REACTORS]
+try:
+    import aiomultitask
+    MANAGERS.append(('asyncio', lambda: aiomultitask.AsyncioTaskManager(aiomultitask.asyncio.new_event_loop())))
+except ImportError: pass # neither asyncio nor trollius
+
+def run(manager, until, steps=100):
+    '''Run the tasks of manager until until() is true, at most steps iterations of 0.1 second.'''
+    for i in xrange(steps):
+        if until(): return True
+        manager.run_next(timeout=0.1)
+    return until()
+
+class ReactorTest(unittest.TestCase):
+    def testReuseClosedDescriptor(self):
+        '''A socket closed while a task waits on its PersistentFD must not keep its descriptor number registered, or a new
+        socket that reuses the number is never reported ready. The task waiting is resumed with EBADF right away, and the
+        reactor keeps nothing of the socket.'''
+        for name, factory in MANAGERS:
+            manager = factory()
+            received = []
+            def reader(fd):
+                try: received.append((yield fd.recv(16)))
+                except EnvironmentError, e: received.append(e.errno)
+            a, b = socket.socketpair()
+            old = multitask.PersistentFD(a, manager)
+            manager.add(reader(old))
+            manager.run_next(timeout=0.0) # the reader now waits on a
+            number = a.fileno()
+            old.close(); old.close(); a.close(); b.close()
+            self.assertFalse(manager.has_io_waits() or old._reader.pending, name)
+            manager.run_next(timeout=0.0)
+            self.assertEqual(received, [errno.EBADF], name)
+            del received[:]
+            c, d = socket.socketpair()
+            try:
+                if c.fileno() != number: c, d = d, c
+                self.assertEqual(c.fileno(), number)
+                new = multitask.PersistentFD(c, manager)
+                manager.add(reader(new))
+                d.send('data')
+                self.assertTrue(run(manager, lambda: received), name)
+                self.assertEqual(received, ['data'])
+                new.close()
+            finally:
+                c.close(); d.close()
+
+class RunNextTest(unittest.TestCase):
+    def testTimeout(self):
+        '''run_next() waits at most timeout seconds for a task to become runnable, and returns once it has run those that
+        became runnable.'''
+        for name, factory in MANAGERS:
+            manager, woken = factory(), []
+            def sleeper(delay):
+                yield multitask.sleep(delay)
+                woken.append(delay)
+            manager.add(sleeper(10)); manager.add(sleeper(0.1))
+            manager.run_next(timeout=0.0)
+            start = time.time(); manager.run_next(timeout=0.05); elapsed = time.time() - start
+            self.assertTrue(0.04 <= elapsed < 0.1 and woken == [], (name, elapsed, woken))
+            start = time.time(); manager.run_next(); elapsed = time.time() - start
+            self.assertTrue(0.02 <= elapsed < 0.1 and woken == [0.1], (name, elapsed, woken))
+
+    def testBadDescriptor(self):
+        '''With asyncio, a wait on a descriptor that the loop refuses resumes the task with the error.'''
+        for name, factory in MANAGERS:
+            if name != 'asyncio': continue
+            manager, errors = factory(), []
+            sock = socket.socket(); fd = sock.fileno(); sock.close()
+            def reader():
+                try: yield multitask.readable(fd)
+                except EnvironmentError, e: errors.append(e.errno)
+            manager.add(reader())
+            manager.run_next(timeout=1.0)
+            self.assertEqual(errors, [errno.EBADF])
+            self.assertFalse(manager.has_io_waits())
+
+class PriorityTest(unittest.TestCase):
+    def testDroppedTaskIsCollected(self):
+        '''A task of high priority that ends before the others, here because its socket is closed while it waits, is not
+        kept alive by the TaskManager.'''
+        for name, factory in MANAGERS:
+            manager = factory()
+            a, b = socket.socketpair()
+            fd = multitask.PersistentFD(a, manager)
+            def reader():
+                try: yield fd.recv(16)
+                except EnvironmentError: pass
+            task = reader(); ref = weakref.ref(task)
+            manager.add(task, multitask.PRIORITY_HIGH); del task
+            manager.run_next(timeout=0.0) # the reader now waits on a
+            fd.close(); a.close(); b.close()
+            manager.run_next(timeout=0.0)
+            gc.collect()
+            self.assertEqual(ref(), None, name)
+
+class Expiring(object):
+    def __init__(self, expiration):
+        self.expiration = expiration
+    def __repr__(self):
+        return '<Expiring %r>' % (self.expiration,)
+
+class TimeoutHeapTest(unittest.TestCase):
+    def drain(self, heap, current_time=float('inf')):
+        items = []
+        while True:
+            item = heap.pop_expired(current_time)
+            if item is None: return items
+            items.append(item)
+
+    def testOrder(self):
+        '''Items pop in order of expiration, those of the same expiration in order of push, and only once expired.'''
+        heap, items = multitask._TimeoutHeap(), [Expiring(t) for t in (3, 1, 2, 1)]
+        for item in items: heap.push(item)
+        self.assertEqual((len(heap), heap.first_expiration()), (4, 1))
+        self.assertEqual(self.drain(heap, 1), [items[1], items[3]])
+        self.assertEqual(self.drain(heap), [items[2], items[0]])
+        self.assertEqual(len(heap), 0)
+
+    def testCancel(self):
+        '''A cancelled item stays in the heap, dead, until it reaches the top, where it is skipped. Pushing an item again
+        cancels its previous entry.'''
+        heap, items = multitask._TimeoutHeap(), [Expiring(t) for t in xrange(5)]
+        for item in items: heap.push(item)
+        heap.cancel(items[0]); heap.cancel(items[2]); heap.cancel(items[2])
+        self.assertEqual((len(heap), len(heap._heap)), (3, 5))
+        self.assertEqual(heap.first_expiration(), 1)
+        self.assertEqual(len(heap._heap), 4) # the dead top was discarded
+        items[1].expiration = 10
+        heap.push(items[1])
+        self.assertEqual(len(heap), 3)
+        self.assertEqual(self.drain(heap), [items[3], items[4], items[1]])
+        self.assertEqual(heap._heap, [])
+
+    def testCompact(self):
+        '''Once more than half of the entries, and more than _COMPACT_MIN, are dead, the heap keeps only the live ones.'''
+        heap, items = multitask._TimeoutHeap(), [Expiring(t) for t in xrange(300)]
+        for item in items: heap.push(item)
+        for item in items[::2]: heap.cancel(item)
+        self.assertEqual((len(heap), len(heap._heap)), (150, 300)) # half dead
+        heap.cancel(items[1])
+        self.assertEqual((len(heap), len(heap._heap)), (149, 149))
+        self.assertEqual(self.drain(heap), items[3::2])
+
+    def testMerge(self):
+        '''merge() pushes the live items of another heap, in order with those of this one.'''
+        heap, other = multitask._TimeoutHeap(), multitask._TimeoutHeap()
+        items = [Expiring(t) for t in xrange(6)]
+        for item in items[::2]: heap.push(item)
+        for item in items[1::2]: other.push(item)
+        other.cancel(items[3])
+        heap.merge(other)
+        self.assertEqual(len(heap), 5)
+        self.assertEqual(self.drain(heap), [items[0], items[1], items[2], items[4], items[5]])
+
+class QueueTest(unittest.TestCase):
+    def testHandoffOrder(self):
+        '''Items given with put_nowait() to a task parked in get_many(), or queued before it runs, arrive in order.'''
+        manager, queue, got = multitask.TaskManager(), multitask.Queue(), []
+        def consumer():
+            while len(got) < 10: got.extend((yield queue.get_many(3)))
+        manager.add(consumer())
+        manager.run_next(timeout=0.0) # parked in get_many()
+        for i in xrange(5): self.assertTrue(queue.put_nowait(i))
+        manager.run_next(timeout=0.0)
+        for i in xrange(5, 10): self.assertTrue(queue.put_nowait(i))
+        manager.run()
+        self.assertEqual(got, range(10))
+
+    def testWaitingPutters(self):
+        '''put_nowait() and put() do not overtake the tasks waiting in put() for room in a full queue. The producer waits
+        to put 2 when the other one puts 'later', which therefore goes before 3.'''
+        manager, queue, got = multitask.TaskManager(), multitask.Queue(maxsize=2), []
+        def producer(items):
+            for item in items: yield queue.put(item)
+        manager.add(producer([0, 1, 2, 3]))
+        manager.run_next(timeout=0.0) # 0 and 1 queued, waits to put 2
+        self.assertFalse(queue.put_nowait('late'))
+        manager.add(producer(['later']))
+        def consumer():
+            got.extend((yield queue.get_many(2)))
+            self.assertFalse(queue.put_nowait('late')) # the room went to the waiting put()s
+            while len(got) < 5: got.extend((yield queue.get_many(2)))
+        manager.add(consumer())
+        manager.run()
+        self.assertEqual(got, [0, 1, 2, 'later', 3])
+
+    def testForce(self):
+        '''put_nowait() with force adds the item ahead of the items of the tasks waiting in put(), even to a full queue.'''
+        manager, queue = multitask.TaskManager(), multitask.Queue(maxsize=1)
+        def producer():
+            yield queue.put('waiting')
+        self.assertTrue(queue.put_nowait('first'))
+        manager.add(producer())
+        manager.run_next(timeout=0.0) # waits for room
+        self.assertFalse(queue.put_nowait('late'))
+        self.assertTrue(queue.put_nowait('rest', force=True))
+        got = []
+        def consumer():
+            while len(got) < 3: got.append((yield queue.get()))
+        manager.add(consumer())
+        manager.run()
+        self.assertEqual(got, ['first', 'rest', 'waiting'])
+
+class SmartQueueTest(unittest.TestCase):
+    def testKeyedOrder(self):
+        '''In keyed mode, get() without a key returns the oldest item whatever the gets by key took before, and the
+        entries of the items taken by key do not accumulate.'''
+        manager, queue, got = multitask.TaskManager(), multitask.SmartQueue(key=lambda item: item[0]), []
+        def producer(items):
+            for item in items:
+                yield queue.put(item)
+        def consumer(keys):
+            for key in keys:
+                got.append((yield queue.get() if key is None else queue.get(key=key)))
+        manager.add(producer([(i % 3, i) for i in xrange(10)]))
+        manager.add(consumer([1, None, 2, None, None, 1, None]))
+        manager.run()
+        self.assertEqual(got, [(1, 1), (0, 0), (2, 2), (0, 3), (1, 4), (1, 7), (2, 5)])
+        for i in xrange(1000):
+            manager.add(producer([(i, i)]))
+            manager.add(consumer([i]))
+            manager.run()
+        self.assertTrue(len(queue._order) <= 2 * len(queue) + 16)
+        self.assertEqual(len(queue), 3)
+
+class ProfilerTest(unittest.TestCase):
+    def testCounters(self):
+        '''Every resumption is counted once, under the name of its generator, or of the class defining a generator
+        method, and the times of each name add up.'''
+        manager, profiler, queue = multitask.TaskManager(), multitask.Profiler(), multitask.Queue(maxsize=1)
+        manager.set_profiler(profiler)
+        class Consumer(object):
+            def run(self, count):
+                for i in xrange(count):
+                    yield queue.get()
+        def producer(count):
+            for i in xrange(count):
+                yield queue.put(i)
+            time.sleep(0.05)
+        manager.add(Consumer().run(20))
+        manager.add(producer(20))
+        start = time.time(); manager.run(); elapsed = time.time() - start
+        stats = dict((row[0], row[1:]) for row in profiler.stats())
+        self.assertEqual(sorted(stats), ['Consumer.run', 'producer'])
+        self.assertEqual(stats['Consumer.run'][0], 21) # 20 items and the StopIteration
+        self.assertEqual(stats['producer'][0], 21)
+        for name, (count, wall, cpu, latency, max_latency, max_wall) in stats.iteritems():
+            self.assertTrue(0.0 <= max_wall <= wall, name)
+            self.assertTrue(0.0 <= latency <= max_latency, name)
+        self.assertTrue(stats['producer'][5] >= 0.05) # the last step sleeps
+        self.assertTrue(stats['producer'][1] < stats['producer'][5] + 0.05)
+        self.assertTrue(sum(row[1] for row in stats.itervalues()) <= elapsed) # the steps do not overlap
+        self.assertEqual(profiler.stats()[0][0], 'producer' if stats['producer'][2] >= stats['Consumer.run'][2] else 'Consumer.run')
+        self.assertEqual(profiler._enqueued, {}) # every task that became runnable has run
+
+class WatchdogTest(unittest.TestCase):
+    def testStall(self):
+        '''A task that blocks past the threshold is reported once, with the stack the watching thread captured while it
+        blocked, and every step and loop iteration is counted in the histograms.'''
+        manager, output, reported = multitask.TaskManager(), StringIO(), []
+        watchdog = multitask.Watchdog(threshold=0.05, file=output)
+        report = watchdog.report
+        def collect(name, duration, stack):
+            reported.append((name, duration, stack))
+            report(name, duration, stack)
+        watchdog.report = collect
+        manager.set_watchdog(watchdog)
+        def quick():
+            for i in xrange(10):
+                yield
+        def blocking():
+            yield
+            time.sleep(0.2) # the stall
+            yield
+        manager.add(quick())
+        manager.add(blocking())
+        manager.run()
+        manager.set_watchdog(None)
+        self.assertTrue(watchdog._thread is None)
+        self.assertEqual(len(reported), 1)
+        name, duration, stack = reported[0]
+        self.assertTrue('blocking' in name, name)
+        self.assertTrue(0.2 <= duration < 0.5, duration)
+        self.assertEqual(stack[-1][2:], ('blocking', 'time.sleep(0.2) # the stall')) # where it blocked, not where it yielded
+        self.assertEqual(list(watchdog.stalls)[0][1:], reported[0])
+        self.assertTrue('multitask stall' in output.getvalue() and 'time.sleep(0.2)' in output.getvalue())
+        rows = watchdog.histograms()
+        self.assertEqual(len(rows), len(multitask.Watchdog.BUCKETS) + 1)
+        self.assertEqual(sum(steps for bound, steps, lags in rows), 11 + 3) # resumptions, StopIterations included
+        self.assertEqual([steps for bound, steps, lags in rows if bound is not None and 0.2 < bound <= 0.4], [1])
+        self.assertTrue(sum(lags for bound, steps, lags in rows) >= 1)
+
+if __name__ == '__main__':
+    unittest.main()
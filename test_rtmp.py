@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the rtmp module. Run with:
+$ python -m unittest discover
+'''
+
+import time, socket, struct, unittest
+import multitask, rtmp
+
+def media(type, data, time=0, streamId=1):
+    return rtmp.Message(rtmp.Header(time=time, size=len(data), type=type, streamId=streamId), data)
+
+class CodecTest(unittest.TestCase):
+    def roundtrip(self, messages, piece=None, encoder=None):
+        '''Encode the messages, decode the bytes fed in pieces of the given size, and return the encoded messages and the
+        decoded ones.'''
+        encoder, decoder = encoder or rtmp.Codec(), rtmp.Codec()
+        encoded = [encoder.encode(message) for message in messages]
+        data, decoded = ''.join(encoded), []
+        for offset in xrange(0, len(data), piece or len(data)):
+            decoder.feed(data[offset:offset + (piece or len(data))]); decoded.extend(decoder.receive())
+        self.assertEqual(decoder.buffer[decoder.offset:], '')
+        self.assertEqual([(m.type, m.streamId, m.time, m.data) for m in decoded], [(m.type, m.streamId, m.time, m.data) for m in messages])
+        return encoded, decoded
+
+    def testHeaderTypes(self):
+        '''The encoder leaves out the fields equal to those of the previous message on the chunk stream, which the decoder
+        restores, also when the bytes arrive a few at a time.'''
+        messages = [media(rtmp.Message.VIDEO, 'a' * 10, 0), media(rtmp.Message.VIDEO, 'b' * 12, 40), media(rtmp.Message.VIDEO, 'c' * 12, 100),
+                    media(rtmp.Message.VIDEO, 'd' * 12, 160), media(rtmp.Message.VIDEO, 'e' * 300, 220), media(rtmp.Message.VIDEO, 'f' * 300, 280)]
+        for piece in (None, 1, 7):
+            encoded, decoded = self.roundtrip(messages, piece)
+            self.assertEqual([ord(data[0]) & rtmp.Header.MASK for data in encoded],
+                             [rtmp.Header.FULL, rtmp.Header.MESSAGE, rtmp.Header.TIME, rtmp.Header.SEPARATOR, rtmp.Header.MESSAGE, rtmp.Header.SEPARATOR])
+
+    def testChannels(self):
+        '''Chunk streams of one, two and three byte basic headers.'''
+        messages = [media(rtmp.Message.AUDIO, 'audio%d' % i, i, streamId=i) for i in xrange(1, 400)]
+        encoded, decoded = self.roundtrip(messages)
+        self.assertEqual(set(len(data) - 11 - len(message.data) for data, message in zip(encoded, messages)), set([1, 2, 3]))
+
+    def testExtendedTime(self):
+        '''A time or delta of 0xFFFFFF or more is sent in the extended timestamp, which the continuation chunks repeat.'''
+        base = 0x1000000
+        for size in (10, 300):
+            self.roundtrip([media(rtmp.Message.VIDEO, 'a' * size, base), media(rtmp.Message.VIDEO, 'b' * size, 2 * base),
+                            media(rtmp.Message.VIDEO, 'c' * size, 2 * base + 40), media(rtmp.Message.VIDEO, 'd' * size, 2 * base + 80)], 5)
+
+    def testChunkSize(self):
+        '''The messages after a set chunk size are chunked and decoded at the new size, also when the codec raises it
+        by itself up to maxWriteChunkSize.'''
+        chunkSize = rtmp.Message(rtmp.Header(time=0, size=4, type=rtmp.Message.CHUNK_SIZE), struct.pack('>L', 1000))
+        messages = [media(rtmp.Message.VIDEO, 'a' * 300), chunkSize, media(rtmp.Message.VIDEO, 'b' * 2500, 40)]
+        encoded, decoded = self.roundtrip(messages, 3)
+        self.assertEqual([len(encoded[0]), len(encoded[2])], [12 + 300 + 2, 8 + 2500 + 2]) # two continuation chunks of 128 and of 1000 bytes
+        encoder = rtmp.Codec(); encoder.maxWriteChunkSize = 4096
+        messages = [media(rtmp.Message.VIDEO, 'a' * 100), media(rtmp.Message.VIDEO, 'b' * 3000, 40), media(rtmp.Message.VIDEO, 'c' * 5000, 80)]
+        encoder.encode(messages[0]); encoder.encode(messages[1])
+        self.assertEqual(encoder.writeChunkSize, 4096)
+        encoder = rtmp.Codec(); encoder.maxWriteChunkSize = 4096
+        decoder = rtmp.Codec(); decoder.feed(''.join(encoder.encode(message) for message in messages))
+        decoded = decoder.receive()
+        self.assertEqual([m.type for m in decoded], [rtmp.Message.VIDEO, rtmp.Message.CHUNK_SIZE, rtmp.Message.VIDEO, rtmp.Message.VIDEO])
+        self.assertEqual([m.data for m in decoded if m.type == rtmp.Message.VIDEO], [m.data for m in messages])
+        self.assertEqual(decoder.readChunkSize, 4096)
+
+    def testPartialHeader(self):
+        '''The decoder waits for the whole chunk header, extended timestamp included, then for the payload, and tells how
+        many bytes it needs from the first byte not decoded.'''
+        data = rtmp.Codec().encode(media(rtmp.Message.VIDEO, 'v' * 100, 0x1000000))
+        self.assertEqual(len(data), 1 + 11 + 4 + 100)
+        decoder, buf, messages = rtmp.Codec(), bytearray(), []
+        for end, need in ((1, 12), (10, 12), (12, 16), (14, 16), (16, 116), (115, 116)):
+            buf[len(buf):] = data[len(buf):end]
+            self.assertEqual((decoder.decode(buf, 0, len(buf), messages), decoder.need, messages), (0, need, []))
+        buf[len(buf):] = data[len(buf):] + 'next'
+        self.assertEqual(decoder.decode(buf, 0, len(buf), messages), len(data))
+        self.assertEqual([(m.time, m.data) for m in messages], [(0x1000000, 'v' * 100)])
+
+    def testReassembly(self):
+        '''The chunks of messages interleaved on several chunk streams are kept per chunk stream, as a list joined once
+        when the message is complete, and a new message on a chunk stream abandons the incomplete one.'''
+        encode, FULL, SEPARATOR = rtmp.Header.encode, rtmp.Header.FULL, rtmp.Header.SEPARATOR
+        a, b = 'a' * 300, 'b' * 200
+        chunks = [encode(4, FULL, 0, 300, rtmp.Message.VIDEO, 1) + a[:128], encode(5, FULL, 0, 200, rtmp.Message.AUDIO, 1) + b[:128],
+                  encode(4, SEPARATOR, 0, 0, 0, 0) + a[128:256], encode(5, SEPARATOR, 0, 0, 0, 0) + b[128:],
+                  encode(4, SEPARATOR, 0, 0, 0, 0) + a[256:]]
+        decoder = rtmp.Codec(); decoder.feed(''.join(chunks[:3]))
+        self.assertEqual(decoder.receive(), [])
+        self.assertEqual((decoder.lastReadHeaders[4].packet, decoder.lastReadHeaders[4].received), (['a' * 128] * 2, 256))
+        decoder.feed(''.join(chunks[3:]))
+        self.assertEqual([(m.type, m.data) for m in decoder.receive()], [(rtmp.Message.AUDIO, b), (rtmp.Message.VIDEO, a)])
+        self.assertEqual((decoder.lastReadHeaders[4].packet, decoder.lastReadHeaders[4].received), (None, 0))
+        decoder.feed(encode(6, FULL, 0, 300, rtmp.Message.VIDEO, 1) + a[:128] + encode(6, FULL, 40, 10, rtmp.Message.VIDEO, 1) + 'c' * 10)
+        self.assertEqual([(m.time, m.data) for m in decoder.receive()], [(40, 'c' * 10)])
+        self.assertEqual((decoder.lastReadHeaders[6].packet, decoder.lastReadHeaders[6].received), (None, 0))
+
+    def testNoHeader(self):
+        '''A chunk of type 2 or 3 on a chunk stream without a header yet raises ProtocolError, which closes the
+        connection like ConnectionClosed.'''
+        for data in ('\x83\x00\x00\x28' + 'a' * 10, '\xc4' + 'a' * 10):
+            decoder = rtmp.Codec(); decoder.feed(data)
+            self.assertRaises(rtmp.ProtocolError, decoder.receive)
+        self.assertTrue(issubclass(rtmp.ProtocolError, rtmp.ConnectionClosed))
+
+class AggregateTest(unittest.TestCase):
+    @staticmethod
+    def tag(type, time, data):
+        '''An FLV tag with its back pointer, as in the data of an aggregate message.'''
+        return struct.pack('>II', type << 24 | len(data), (time & 0xFFFFFF) << 8 | time >> 24) + '\x00\x00\x00' + data + struct.pack('>I', 11 + len(data))
+
+    def testSplit(self):
+        '''The sub-messages take the stream of the aggregate message, and the times of the tags from its time on.'''
+        data = self.tag(rtmp.Message.VIDEO, 0x1000010, '\x17\x01key') + self.tag(rtmp.Message.AUDIO, 0x1000030, '\xaf\x01audio')
+        header = rtmp.Header(5, 5000, len(data), rtmp.Message.AGGREGATE, 3)
+        self.assertEqual([(m.header.channel, m.type, m.streamId, m.time, m.data) for m in rtmp.aggregateMessages(header, data)],
+                         [(5, rtmp.Message.VIDEO, 3, 5000, '\x17\x01key'), (5, rtmp.Message.AUDIO, 3, 5032, '\xaf\x01audio')])
+
+    def testDecode(self):
+        '''The codec delivers the sub-messages of an aggregate message received in several chunks, not itself.'''
+        data = ''.join(self.tag(rtmp.Message.VIDEO, 40 * i, '\x27\x01' + 'v' * 100) for i in xrange(3))
+        decoder = rtmp.Codec(); decoder.feed(rtmp.Codec().encode(media(rtmp.Message.AGGREGATE, data, 1000)))
+        self.assertEqual([(m.type, m.streamId, m.time, len(m.data)) for m in decoder.receive()], [(rtmp.Message.VIDEO, 1, 1000 + 40 * i, 102) for i in xrange(3)])
+
+class SockStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.default, self.manager = multitask.get_default_task_manager(), multitask.TaskManager()
+        multitask.set_default_task_manager(self.manager)
+        self.a, self.b = socket.socketpair()
+        self.stream = rtmp.SockStream(self.a)
+
+    def tearDown(self):
+        self.stream.close(); self.b.close()
+        multitask.set_default_task_manager(self.default)
+
+    def fill(self, count):
+        done = []
+        def filler():
+            yield self.stream.fill(count)
+            done.append(True)
+        self.manager.add(filler())
+        while not done: self.manager.run_next(timeout=1.0)
+
+    def unread(self):
+        return str(self.stream.buffer[self.stream.offset:self.stream.length])
+
+    def testReserve(self):
+        '''_reserve() keeps the unread bytes, moving them to the front only when recvSize bytes do not fit after them, and
+        replaces the buffer only when it is too small, or much too large once everything is read.'''
+        stream = self.stream
+        self.b.send('0123456789'); self.fill(10)
+        stream.take(4)
+        buffer = stream.buffer
+        stream._reserve(6) # room after the unread bytes
+        self.assertTrue(stream.buffer is buffer)
+        self.assertEqual((stream.offset, self.unread()), (4, '456789'))
+        stream.recvSize = len(buffer) - 8
+        stream._reserve(6) # room once the unread bytes move to the front
+        self.assertTrue(stream.buffer is buffer)
+        self.assertEqual((stream.offset, self.unread()), (0, '456789'))
+        stream.recvSize = len(buffer)
+        stream._reserve(6) # no room: a larger buffer
+        self.assertTrue(stream.buffer is not buffer and len(stream.buffer) == 6 + stream.recvSize)
+        self.assertEqual((stream.offset, self.unread()), (0, '456789'))
+        stream.take(6)
+        buffer = stream.buffer
+        stream._reserve(1) # everything read: start over at the front of the same buffer
+        self.assertTrue(stream.buffer is buffer)
+        self.assertEqual((stream.offset, stream.length), (0, 0))
+        stream.recvSize = 1024
+        stream._reserve(1) # much too large now
+        self.assertEqual(len(stream.buffer), 1025)
+
+    def testUnread(self):
+        '''unread() puts the bytes back in front of the unread ones, in place when they fit before them.'''
+        stream = self.stream
+        self.b.send('0123456789'); self.fill(10)
+        self.assertEqual(stream.take(6), '012345')
+        buffer = stream.buffer
+        stream.unread('ab')
+        self.assertTrue(stream.buffer is buffer)
+        self.assertEqual(self.unread(), 'ab6789')
+        stream.unread('x' * 10)
+        self.assertEqual(self.unread(), 'x' * 10 + 'ab6789')
+        self.assertTrue(len(stream.buffer) >= stream.length + stream.recvSize)
+        self.b.send('!'); self.fill(17)
+        self.assertEqual(stream.take(17), 'x' * 10 + 'ab6789!')
+
+    def testRecvSize(self):
+        '''recvSize doubles when a recv_into() fills it, up to MAX_RECV_SIZE, and halves when one gets a quarter of it or
+        less, down to MIN_RECV_SIZE, after which the buffer of an idle connection shrinks back.'''
+        stream, saved = self.stream, rtmp.SockStream.MAX_RECV_SIZE
+        rtmp.SockStream.MAX_RECV_SIZE = 16384
+        try:
+            self.assertEqual(stream.recvSize, 4096)
+            self.b.sendall('a' * (4096 + 8192 + 16384 + 16384 + 100))
+            for size, recvSize in ((4096, 8192), (8192, 16384), (16384, 16384), (16384, 16384), (100, 8192)):
+                self.fill(1)
+                self.assertEqual((stream.length - stream.offset, stream.recvSize), (size, recvSize))
+                stream.take(size)
+            self.assertEqual(stream.recvCalls, 5)
+            large = len(stream.buffer)
+            self.assertTrue(large >= 16384)
+            for recvSize in (4096, 2048, 1024, 1024):
+                self.b.send('b'); self.fill(1); stream.take(1)
+                self.assertEqual(stream.recvSize, recvSize)
+            self.assertTrue(len(stream.buffer) < large / 4)
+            self.assertEqual(stream.bytesRead, 4096 + 8192 + 16384 + 16384 + 100 + 4)
+        finally:
+            rtmp.SockStream.MAX_RECV_SIZE = saved
+
+    def testErrors(self):
+        '''fill() raises ConnectionClosed when the peer closes, and lets the generator be closed while it waits.'''
+        reader = self.stream.fill(1)
+        reader.next() # waits for the socket
+        reader.close()
+        self.b.close()
+        self.assertRaises(rtmp.ConnectionClosed, self.fill, 1)
+
+class ProtocolTest(unittest.TestCase):
+    def setUp(self):
+        self.default, self.manager = multitask.get_default_task_manager(), multitask.TaskManager()
+        multitask.set_default_task_manager(self.manager)
+        self.a, self.b = socket.socketpair()
+        for sock, option in ((self.a, socket.SO_SNDBUF), (self.b, socket.SO_RCVBUF)): sock.setsockopt(socket.SOL_SOCKET, option, 4096)
+        self.protocol = rtmp.Protocol(self.a)
+
+    def tearDown(self):
+        self.protocol.stream.close(); self.b.close()
+        multitask.set_default_task_manager(self.default)
+
+    def testPartialSendOrder(self):
+        '''A message sent while the write task holds the rest of one sent in part goes after it on the wire, even when the
+        socket has room again before the write task runs.'''
+        first, second = media(rtmp.Message.VIDEO, ''.join(chr(i % 251) for i in xrange(200000))), media(rtmp.Message.AUDIO, 'audio')
+        self.manager.add(self.protocol.write())
+        self.manager.run_next(timeout=0.0) # the write task parks on the empty queue
+        self.assertTrue(self.protocol.sendMessage(first))
+        received = bytearray(self.b.recv(65536))
+        self.assertTrue(self.protocol.sendMessage(second))
+        self.b.setblocking(0)
+        for i in xrange(1000):
+            try: received += self.b.recv(65536)
+            except socket.error: pass
+            if not self.protocol.writing: break
+            self.manager.run_next(timeout=0.01)
+        try: received += self.b.recv(65536)
+        except socket.error: pass
+        codec = rtmp.Codec(); codec.feed(received)
+        messages = codec.receive()
+        self.assertEqual([(message.type, len(message.data)) for message in messages], [(first.type, len(first.data)), (second.type, len(second.data))])
+        self.assertTrue(messages[0].data == first.data and messages[1].data == second.data)
+
+    def testWaitingWriters(self):
+        '''sendMessage() refuses a message while tasks wait in writeMessage() for room, and loses none.'''
+        self.protocol.writeQueue = queue = multitask.Queue(maxsize=1)
+        self.protocol.writing = True # no write task, so everything sent stays in the write queue
+        first, second, third = [media(rtmp.Message.AUDIO, data) for data in ('first', 'second', 'third')]
+        self.assertTrue(self.protocol.sendMessage(first))
+        self.manager.add(self.protocol.writeMessage(second))
+        self.manager.run_next(timeout=0.0) # waits for room
+        self.assertFalse(self.protocol.sendMessage(third))
+        got = []
+        def writer():
+            while len(got) < 2: got.append((yield queue.get()))
+        self.manager.add(writer())
+        self.manager.run()
+        self.assertEqual((got, len(queue)), ([first, second], 0))
+
+    def testRelease(self):
+        '''With the free list enabled, only the header of a message sent with release is reused, not that of a message
+        the application may keep.'''
+        size, rtmp.Header.FREE_LIST_SIZE, rtmp.Header._freeList[:] = rtmp.Header.FREE_LIST_SIZE, 16, []
+        try:
+            kept, copy = media(rtmp.Message.DATA, 'meta'), media(rtmp.Message.DATA, 'meta')
+            self.assertTrue(self.protocol.sendMessage(kept))
+            self.assertEqual(rtmp.Header._freeList, [])
+            self.assertTrue(self.protocol.sendMessage(copy, release=True))
+            self.assertEqual(rtmp.Header._freeList, [copy.header])
+        finally:
+            rtmp.Header.FREE_LIST_SIZE, rtmp.Header._freeList[:] = size, []
+
+class WriteBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.default, self.manager = multitask.get_default_task_manager(), multitask.TaskManager()
+        multitask.set_default_task_manager(self.manager)
+        self.saved = rtmp.Protocol.WRITE_BATCH_SIZE, rtmp.Protocol.WRITE_BUFFER_SIZE, rtmp.Protocol.WRITE_DELAY
+        self.a, self.b = socket.socketpair()
+        self.protocol, self.sends = rtmp.Protocol(self.a), [] # (time, size) of each send of the write task
+        send = self.protocol.stream._send
+        def record(view):
+            self.sends.append((time.time(), len(view)))
+            return send(view)
+        self.protocol.stream._send = record
+        self.protocol.writing = True # everything sent is queued for the write task
+        self.manager.add(self.protocol.write())
+
+    def tearDown(self):
+        rtmp.Protocol.WRITE_BATCH_SIZE, rtmp.Protocol.WRITE_BUFFER_SIZE, rtmp.Protocol.WRITE_DELAY = self.saved
+        self.protocol.stream.close(); self.b.close()
+        multitask.set_default_task_manager(self.default)
+
+    def received(self):
+        self.b.setblocking(0)
+        data = bytearray()
+        while True:
+            try: data += self.b.recv(1 << 20)
+            except socket.error: break
+        codec = rtmp.Codec(); codec.feed(data)
+        return [message.data for message in codec.receive()]
+
+    def testBatch(self):
+        '''The write task takes up to WRITE_BATCH_SIZE queued messages per resumption, and sends their chunks together.'''
+        rtmp.Protocol.WRITE_BATCH_SIZE = 16
+        payloads = ['%03d' % (i,) for i in xrange(40)]
+        for data in payloads: self.assertTrue(self.protocol.sendMessage(media(rtmp.Message.AUDIO, data)))
+        self.manager.run_next(timeout=0.0)
+        self.assertEqual(len(self.sends), 1)
+        while self.protocol.writing: self.manager.run_next(timeout=0.0)
+        self.assertEqual(len(self.sends), 3) # 16, 16 and 8 messages
+        self.assertEqual(self.received(), payloads)
+
+    def testBufferSize(self):
+        '''The chunks of a batch are sent once they reach WRITE_BUFFER_SIZE bytes, so no send is much larger.'''
+        rtmp.Protocol.WRITE_BUFFER_SIZE = 1000
+        payloads = [chr(65 + i) * 300 for i in xrange(20)]
+        for data in payloads: self.assertTrue(self.protocol.sendMessage(media(rtmp.Message.AUDIO, data)))
+        while self.protocol.writing: self.manager.run_next(timeout=0.0)
+        sizes = [size for when, size in self.sends]
+        self.assertEqual(sum(sizes), self.protocol.stream.bytesWritten)
+        self.assertTrue(len(sizes) > 1 and all(1000 <= size < 1000 + 320 for size in sizes[:-1]), sizes)
+        self.assertEqual(self.received(), payloads)
+
+    def testDelay(self):
+        '''With a WRITE_DELAY, the messages queued within that many seconds of the first are sent together, no later than
+        that, unless they reach WRITE_BUFFER_SIZE bytes before.'''
+        rtmp.Protocol.WRITE_DELAY, rtmp.Protocol.WRITE_BUFFER_SIZE = 0.1, 4096
+        self.manager.run_next(timeout=0.0) # the write task waits for messages
+        start = time.time()
+        self.assertTrue(self.protocol.sendMessage(media(rtmp.Message.AUDIO, 'first')))
+        self.manager.run_next(timeout=0.02)
+        self.assertTrue(self.protocol.sendMessage(media(rtmp.Message.AUDIO, 'second')))
+        for i in xrange(100):
+            if self.sends: break
+            self.manager.run_next(timeout=0.01)
+        self.assertTrue(0.1 <= self.sends[0][0] - start < 0.15, self.sends[0][0] - start)
+        while self.protocol.writing: self.manager.run_next(timeout=0.01)
+        self.assertEqual(len(self.sends), 1)
+        self.assertEqual(self.received(), ['first', 'second'])
+        self.protocol.writing = True
+        start = time.time() # the budget is reached: no wait
+        self.assertTrue(self.protocol.sendMessage(media(rtmp.Message.VIDEO, 'x' * 5000)))
+        for i in xrange(100):
+            if len(self.sends) > 1: break
+            self.manager.run_next(timeout=0.01)
+        self.assertTrue(self.sends[1][0] - start < 0.05)
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.default, self.manager = multitask.get_default_task_manager(), multitask.TaskManager()
+        multitask.set_default_task_manager(self.manager)
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0)); self.listener.listen(64)
+        self.batch, self.peers = rtmp.Server.ACCEPT_BATCH, []
+
+    def tearDown(self):
+        rtmp.Server.ACCEPT_BATCH = self.batch
+        for sock in self.peers: sock.close()
+        for i in xrange(10): self.manager.run_next(timeout=0.0) # the clients accepted see the connection closed
+        self.listener.close()
+        multitask.set_default_task_manager(self.default)
+
+    def connect(self, count):
+        for i in xrange(count):
+            sock = socket.socket(); sock.connect(self.listener.getsockname())
+            self.peers.append(sock)
+
+    def runUntil(self, until, timeout=5.0):
+        start = time.time()
+        while not until() and time.time() < start + timeout: self.manager.run_next(timeout=0.05)
+        return time.time() - start
+
+    def testBatch(self):
+        '''Every wakeup accepts the pending connections, at most ACCEPT_BATCH of them.'''
+        rtmp.Server.ACCEPT_BATCH = 4
+        self.connect(10)
+        server = rtmp.Server(self.listener)
+        self.runUntil(lambda: server.wakeups)
+        self.assertEqual((server.wakeups, server.accepted), (1, 4))
+        self.runUntil(lambda: server.accepted == 10)
+        self.assertEqual((server.wakeups, server.accepted, server.maxBatch), (3, 10, 4))
+
+    def testRate(self):
+        '''With a rate, a burst of that many connections is accepted at once, and the others at that rate.'''
+        self.connect(15)
+        server = rtmp.Server(self.listener, rate=10)
+        self.runUntil(lambda: server.wakeups)
+        self.assertEqual(server.accepted, 10)
+        elapsed = self.runUntil(lambda: server.accepted == 15)
+        self.assertEqual(server.accepted, 15)
+        self.assertTrue(0.4 <= elapsed < 1.0, elapsed)
+
+    def testAcceptQueue(self):
+        '''acceptQueue() returns the connections in the listen backlog and its size, where TCP_INFO is available.'''
+        server = rtmp.Server(self.listener)
+        if server.acceptQueue() is None: return # not Linux
+        self.connect(3)
+        self.assertEqual(server.acceptQueue(), (3, 64))
+        self.runUntil(lambda: server.accepted == 3)
+        self.assertEqual(server.acceptQueue(), (0, 64))
+
+class Application(object):
+    def __init__(self): self.players = {}
+    def onPlayData(self, client, stream, message): return True
+
+class FanoutTest(unittest.TestCase):
+    def setUp(self):
+        self.default = multitask.get_default_task_manager()
+        multitask.set_default_task_manager(multitask.TaskManager())
+        self.a, self.b = socket.socketpair()
+        self.protocol = rtmp.Protocol(self.a)
+        self.protocol.writing = True # no write task, so everything sent stays in the write queue
+        self.publisher, self.player, self.inst = rtmp.Stream(None), rtmp.Stream(self.protocol), Application()
+        self.publisher.name = self.player.name = 'stream'
+        self.inst.players['stream'] = [self.player]
+        self.fanout = rtmp.Fanout(self.inst, self.publisher)
+
+    def tearDown(self):
+        self.protocol.stream.close(); self.b.close()
+        multitask.set_default_task_manager(self.default)
+
+    def play(self, *messages):
+        for message in messages: self.fanout.play(message)
+
+    def queued(self):
+        queue, data = self.protocol.writeQueue, []
+        while len(queue): data.append(queue._get().data)
+        return data
+
+    def testSlowPlayer(self):
+        '''A player with a full write queue gets no media but the headers until the next key frame.'''
+        KEY, INTER, AUDIO = media(rtmp.Message.VIDEO, '\x17\x01key'), media(rtmp.Message.VIDEO, '\x27\x01inter'), media(rtmp.Message.AUDIO, '\xaf\x01audio')
+        self.play(KEY)
+        while len(self.protocol.writeQueue) < rtmp.Fanout.QUEUE_SIZE: self.play(INTER)
+        self.play(INTER, AUDIO, media(rtmp.Message.VIDEO, '\x17\x00avc'))
+        self.assertEqual((self.fanout.dropped, self.player.lagging), (2, True))
+        self.assertEqual(self.queued()[-2:], ['\x27\x01inter', '\x17\x00avc'])
+        self.play(INTER, AUDIO, KEY, INTER, AUDIO)
+        self.assertEqual(self.queued(), ['\x17\x01key', '\x27\x01inter', '\xaf\x01audio'])
+        self.assertEqual((self.fanout.dropped, self.player.lagging), (4, False))
+
+    def testAudioOnly(self):
+        '''Without video, a lagging player resumes with the next audio message.'''
+        self.player.lagging = True
+        self.play(media(rtmp.Message.AUDIO, '\xaf\x01audio'))
+        self.assertEqual(self.queued(), ['\xaf\x01audio'])
+
+class PublishTest(unittest.TestCase):
+    def setUp(self):
+        self.default, self.manager = multitask.get_default_task_manager(), multitask.TaskManager()
+        multitask.set_default_task_manager(self.manager)
+        self.socks = [socket.socketpair() for i in xrange(2)]
+        self.server, self.inst = rtmp.FlashServer(), rtmp.App()
+        self.publisher = rtmp.Client(self.socks[0][0], self.server); self.publisher.path = 'live'
+        self.server.clients['live'] = [self.inst, self.publisher]
+        self.stream = rtmp.Stream(self.publisher); self.stream.id = 1; self.publisher.streams[1] = self.stream
+        self.protocol = rtmp.Protocol(self.socks[1][0])
+        self.protocol.writing = True # no write task, so everything sent stays in the write queue
+        self.player = rtmp.Stream(self.protocol); self.player.id, self.player.name = 1, 'stream'
+        self.inst.players['stream'] = [self.player]
+
+    def tearDown(self):
+        for a, b in self.socks: b.close()
+        for i in xrange(10): self.manager.run_next(timeout=0.0) # the tasks of the publisher end with the connection
+        self.publisher.stream.close(); self.protocol.stream.close()
+        multitask.set_default_task_manager(self.default)
+
+    def testMediaAfterPublish(self):
+        '''The media received in the same read as the publish command reach the player in order, whether the stream
+        listener or the parser dispatches them.'''
+        publish = rtmp.Command(name='publish', id=2, args=['stream', 'live']).toMessage(); publish.streamId = 1
+        messages = [media(rtmp.Message.DATA, 'meta')] + [media(rtmp.Message.VIDEO, ('\x12' if i % 10 == 0 else '\x22') + '%d' % i, 40 * i) for i in xrange(30)]
+        def parser(): # decodes them at once, like Protocol.parseMessages
+            for message in [publish] + messages: yield self.publisher.messageReceived(message)
+        self.manager.add(self.server.streamlistener(self.stream), multitask.PRIORITY_HIGH)
+        self.manager.add(parser(), multitask.PRIORITY_HIGH)
+        queue, got = self.protocol.writeQueue, []
+        for i in xrange(100):
+            self.manager.run_next(timeout=0.0)
+            while len(queue): got.append(queue._get().data)
+        self.assertEqual(got, [message.data for message in messages])
+
+if __name__ == '__main__':
+    unittest.main()